@@ -0,0 +1,305 @@
+#!/usr/bin/env python3.8
+
+import argparse
+import gzip
+import math
+import os
+import re
+import struct
+import threading
+from bisect import bisect_right
+from time import perf_counter, sleep, time
+import logging as log
+
+__all__ = ['CaptureWriter', 'CaptureReader', 'segments', 'replay']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+_HEADER = struct.Struct('=4sBH')
+_MAGIC = b'UCAP'
+_VERSION = 1
+
+# Index entry: capture time and number of the first record written at that time
+_ENTRY = struct.Struct('=dQ')
+
+class CaptureWriter:
+    '''Writes a raw record stream to segment files with a time index.
+
+    A new segment starts every segment_seconds, or once it holds segment_bytes of records.
+    Segments are named <name>-<start time in ms>.cap, with .gz appended if compressed, and
+    start with a header holding the record size. Next to each segment, <segment>.idx holds
+    (capture time, record number) entries written at most every index_interval seconds,
+    which replay uses to seek and to reproduce the original timing.
+
+    Positional arguments:\n
+    directory -- directory to create the segments in\n
+
+    Keyword arguments:\n
+    name -- prefix of the segment files, e.g. the processor name\n
+    record_size -- length of a record in bytes\n
+    segment_seconds -- seconds after which a new segment is started\n
+    segment_bytes -- bytes of records after which a new segment is started, 0 for no limit\n
+    compress -- whether to gzip the segments\n
+    compress_level -- gzip compression level, low levels keep up with high record rates\n
+    index_interval -- minimum seconds between index entries\n
+    clock -- source of the capture time'''
+
+    def __init__(self, directory: str, *, name: str, record_size: int, segment_seconds: float=3600,
+                 segment_bytes: int=0, compress: bool=False, compress_level: int=1,
+                 index_interval: float=1.0, clock=time):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        self.directory = directory
+        self.name = name
+        self.record_size = record_size
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.compress = compress
+        self.compress_level = compress_level
+        self.index_interval = index_interval
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._index = None
+        self._started = 0
+        self._indexed = 0
+        self._records = 0
+        self._bytes = 0
+
+    def write(self, data: bytes):
+        '''Appends data, which must hold a whole number of records.'''
+
+        now = self._clock()
+
+        with self._lock:
+            if self._file is None or now - self._started >= self.segment_seconds or \
+               (self.segment_bytes and self._bytes >= self.segment_bytes):
+                self._start_segment(now)
+
+            if now - self._indexed >= self.index_interval:
+                self._index.write(_ENTRY.pack(now, self._records))
+                self._index.flush()
+                self._indexed = now
+
+            self._file.write(data)
+            self._records += len(data) // self.record_size
+            self._bytes += len(data)
+
+    def _start_segment(self, now: float):
+        self._close_segment()
+
+        path = os.path.join(self.directory, f'{self.name}-{int(now * 1000):014d}.cap')
+        if self.compress:
+            path += '.gz'
+            self._file = gzip.open(path, 'wb', compresslevel=self.compress_level)
+        else:
+            self._file = open(path, 'wb')
+
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, self.record_size))
+        self._index = open(f'{path}.idx', 'wb')
+
+        self._started = now
+        self._indexed = -math.inf
+        self._records = 0
+        self._bytes = 0
+
+        log.debug('Started capture segment %s.', path)
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = self._index = None
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+class CaptureReader:
+    '''Reads the records of a segment written by CaptureWriter.
+
+    Positional arguments:\n
+    path -- the segment file'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+        magic, version, self.record_size = _HEADER.unpack(self._file.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            self._file.close()
+            raise ValueError(f'{path} is not a capture segment.')
+
+        with open(f'{path}.idx', 'rb') as index:
+            # A writer that was killed may leave a partial entry behind
+            data = index.read()
+            entries = list(_ENTRY.iter_unpack(data[:len(data) - len(data) % _ENTRY.size]))
+
+        if not entries:
+            entries = [(0.0, 0)]
+
+        self._times = [entry[0] for entry in entries]
+        self._records = [entry[1] for entry in entries]
+
+    def time_of(self, record: int) -> float:
+        '''Capture time of a record, interpolated between the index entries around it.'''
+
+        i = max(bisect_right(self._records, record) - 1, 0)
+        if i + 1 >= len(self._records):
+            return self._times[i]
+
+        fraction = (record - self._records[i]) / (self._records[i+1] - self._records[i])
+        return self._times[i] + fraction * (self._times[i+1] - self._times[i])
+
+    def record_at(self, timestamp: float) -> int:
+        '''Number of the first record captured at or after timestamp.'''
+
+        i = bisect_right(self._times, timestamp) - 1
+        if i < 0:
+            return 0
+
+        if i + 1 >= len(self._times):
+            return self._records[i]
+
+        fraction = (timestamp - self._times[i]) / (self._times[i+1] - self._times[i])
+        return self._records[i] + math.ceil(fraction * (self._records[i+1] - self._records[i]))
+
+    def chunks(self, records: int=4096, *, start: float=None, end: float=None):
+        '''Yields (capture time, data) pairs of up to records records captured between start
+        and end. A chunk never spans an index entry, so its records share the capture time.'''
+
+        position = 0 if start is None else self.record_at(start)
+        self._file.seek(_HEADER.size + position * self.record_size)
+
+        while True:
+            timestamp = self.time_of(position)
+            if end is not None and timestamp > end:
+                return
+
+            following = bisect_right(self._records, position)
+            count = records
+            if following < len(self._records):
+                count = min(count, self._records[following] - position)
+
+            try:
+                data = self._file.read(count * self.record_size)
+            except EOFError:
+                # Compressed segment of a capture that was not closed
+                log.warning('Capture segment %s is truncated.', self.path)
+                return
+
+            data = data[:len(data) - len(data) % self.record_size]
+            if not data:
+                return
+
+            yield timestamp, data
+            position += len(data) // self.record_size
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def segments(directory: str, name: str) -> list:
+    '''Returns the segments of a capture in the order they were written.'''
+
+    # Names may be prefixes of each other, e.g. btle and btle-adv
+    pattern = re.compile(rf'{re.escape(name)}-\d+\.cap(\.gz)?')
+
+    return sorted(os.path.join(directory, file) for file in os.listdir(directory)
+                  if pattern.fullmatch(file))
+
+def replay(processor, paths: list, *, speed: float=1.0, start: float=None, end: float=None,
+           report_interval: float=15, on_result=None) -> int:
+    '''Feeds captured records to processor, at speed times the original pace or as fast as
+    possible if speed is 0.
+
+    The processor's clock follows the capture time of the records, so fingerprints age and
+    expire as they did live. Every report_interval seconds of capture time, and once at the
+    end, the result is taken and passed to on_result along with the capture time. Replaying
+    into a ShardedProcessor is not supported, its workers keep the system clock.
+
+    Returns the number of records fed.'''
+
+    current = math.nan
+    first = None
+    records = 0
+
+    def report():
+        results = processor.result
+        if on_result is not None:
+            on_result(current, results)
+
+    for path in paths:
+        with CaptureReader(path) as reader:
+            if reader.record_size != processor._packet_length:
+                raise ValueError(f'{path} holds records of {reader.record_size} bytes, '
+                                 f'{processor.name} expects {processor._packet_length}.')
+
+            for timestamp, data in reader.chunks(start=start, end=end):
+                if first is None:
+                    first, started, current = timestamp, perf_counter(), timestamp
+                    processor.set_clock(lambda: current)
+                    due = timestamp + report_interval if report_interval else math.inf
+
+                if speed and (delay := started + (timestamp - first) / speed - perf_counter()) > 0:
+                    sleep(delay)
+
+                while timestamp >= due:
+                    current = due
+                    report()
+                    due += report_interval
+
+                current = timestamp
+                records += processor.feed(data)
+
+    if first is not None:
+        report()
+
+    return records
+
+if __name__ == '__main__':
+    from sniffer import BtbrProcessor, BtleProcessor, BtleAdvProcessor
+
+    processors = {cls.name: cls for cls in (BtbrProcessor, BtleProcessor, BtleAdvProcessor)}
+
+    parser = argparse.ArgumentParser(description='Replay a capture through a sniffer processor.')
+    parser.add_argument('directory', type=str, help='Directory holding the capture.')
+    parser.add_argument('mode', type=str, choices=list(processors), help='Processor to replay into.')
+    parser.add_argument('-s', '--speed', type=float, default=0,
+                        help='Multiple of the original pace, as fast as possible if 0.')
+    parser.add_argument('--start', type=float, default=None, help='Capture time to start at.')
+    parser.add_argument('--end', type=float, default=None, help='Capture time to stop at.')
+    parser.add_argument('--report-interval', type=float, default=15,
+                        help='Seconds of capture time between results.')
+    parser.add_argument('--seen-for', type=int, default=None,
+                        help='seen_for of the btbr and btle-adv processors.')
+    parser.add_argument('--seen-threshold', type=int, default=None,
+                        help='seen_threshold of the btle processor.')
+    parser.add_argument('--columnar', action='store_true', help='Use the columnar store.')
+
+    args = parser.parse_args()
+
+    options = {name: value for name, value in [('seen_for', args.seen_for),
+                                               ('seen_threshold', args.seen_threshold)]
+               if value is not None}
+    if args.columnar:
+        options['columnar'] = True
+
+    processor = processors[args.mode](pipe_path=None, **options)
+
+    def print_result(timestamp: float, results: list):
+        print(f'{timestamp:.0f}: {len(results)} fingerprints')
+
+    start = perf_counter()
+    count = replay(processor, segments(args.directory, args.mode), speed=args.speed,
+                   start=args.start, end=args.end, report_interval=args.report_interval,
+                   on_result=print_result)
+
+    print(f'{count} records replayed in {perf_counter() - start:.1f} s.')
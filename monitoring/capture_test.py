@@ -0,0 +1,120 @@
+import struct
+from time import perf_counter
+import pytest
+import sniffer
+from capture import CaptureWriter, CaptureReader, segments, replay
+from loadgen import MODES
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+def btle_adv_record(mac: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(MODES['btle-adv'], 0, True, mac.to_bytes(6, 'little'), timestamp, rssi,
+                       0xfd6f, 0x4c)
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def write_capture(directory, chunks: list, *, name='btle', record_size=12,
+                  **options) -> CaptureWriter:
+    '''Writes (capture time, data) pairs and closes the writer.'''
+
+    clock = Clock(0)
+    writer = CaptureWriter(str(directory), name=name, record_size=record_size, clock=clock,
+                           **options)
+    for now, data in chunks:
+        clock.now = now
+        writer.write(data)
+
+    writer.close()
+    return writer
+
+
+class TestCapture:
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_segments_roundtrip(self, tmp_path, compress):
+        chunks = [(1000 + i, b''.join(btle_record(i, 1000 + i, -50) for _ in range(10)))
+                  for i in range(10)]
+        write_capture(tmp_path, chunks, compress=compress, segment_bytes=400)
+        # Names that merely start with the capture name belong to another capture
+        write_capture(tmp_path, chunks, name='btle-adv', record_size=20)
+
+        paths = segments(str(tmp_path), 'btle')
+        assert len(paths) == 3, 'Segments not started after segment_bytes'
+        assert all(path.endswith('.gz') == compress for path in paths), 'Wrong compression'
+
+        data = b''
+        for path in paths:
+            with CaptureReader(path) as reader:
+                data += b''.join(chunk for _, chunk in reader.chunks())
+
+        assert data == b''.join(chunk for _, chunk in chunks), 'Records not preserved'
+
+    def test_index_gives_capture_times(self, tmp_path):
+        write_capture(tmp_path, [(1000, btle_record(1, 0, -50) * 100),
+                                 (1000.5, btle_record(2, 0, -50) * 100),
+                                 (1010, btle_record(3, 0, -50) * 100)])
+
+        with CaptureReader(segments(str(tmp_path), 'btle')[0]) as reader:
+            assert reader.time_of(0) == 1000 and reader.time_of(200) == 1010, 'Wrong index'
+            # The second chunk came less than index_interval after the first one
+            assert reader.time_of(150) == pytest.approx(1007.5), 'Not interpolated'
+            assert reader.record_at(1010) == 200, 'Wrong record at time'
+
+            chunks = list(reader.chunks(start=1010))
+            assert [(timestamp, len(data)) for timestamp, data in chunks] == [(1010, 1200)], \
+                'Seeking to start failed'
+
+            assert sum(len(data) for _, data in reader.chunks(end=1005)) == 2400, \
+                'Records after end replayed'
+
+
+class TestReplay:
+    def test_processor_follows_capture_time(self, tmp_path):
+        # Two devices in the past, one of which disappears after the first minute
+        start = 1_600_000_000
+        macs = [0x010101010101, 0x020202020202]
+        write_capture(tmp_path, [(start + t, b''.join(btle_adv_record(mac, start + t, -60)
+                                                      for mac in (macs if t < 60 else macs[:1])))
+                                 for t in range(0, 300, 5)], name='btle-adv', record_size=20)
+
+        processor = sniffer.BtleAdvProcessor(pipe_path=None, seen_for=30)
+        reports = []
+        records = replay(processor, segments(str(tmp_path), 'btle-adv'), speed=0,
+                         report_interval=100,
+                         on_result=lambda now, results: reports.append(
+                             (now, sorted(fp.mac for fp in results))))
+
+        assert records == 12 * 2 + 48, 'Not all records replayed'
+        assert [now for now, _ in reports] == [start + 100, start + 200, start + 295], \
+            'Results not taken on capture time'
+        assert reports[0][1] == macs, 'Both devices were seen for more than seen_for'
+        assert reports[1][1] == macs[:1], 'Departed device should have expired'
+        assert all(fp.first_seen >= start for fp in processor._tracked().values()), \
+            'First seen should follow the capture time'
+
+    def test_speed(self, tmp_path):
+        write_capture(tmp_path, [(1000 + t, btle_record(1, 1000 + t, -50)) for t in range(3)])
+        paths = segments(str(tmp_path), 'btle')
+
+        started = perf_counter()
+        replay(sniffer.BtleProcessor(pipe_path=None), paths, speed=10)
+        elapsed = perf_counter() - started
+
+        assert 0.15 < elapsed < 1, 'Two seconds of capture should take 0.2 s at 10x'
+
+    def test_processor_tees_records(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path), name='btle', record_size=12)
+        processor = sniffer.BtleProcessor(pipe_path=None, capture=writer)
+        data = b''.join(btle_record(i, 1000, -50) for i in range(10))
+
+        processor.feed(data[:17])
+        processor.feed(data[17:])
+        writer.close()
+
+        with CaptureReader(segments(str(tmp_path), 'btle')[0]) as reader:
+            assert b''.join(chunk for _, chunk in reader.chunks()) == data, 'Records not captured'
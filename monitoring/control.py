@@ -0,0 +1,104 @@
+#!/usr/bin/env python3.8
+
+import json
+import os
+import signal
+import socketserver
+import threading
+from contextlib import suppress
+import logging as log
+
+__all__ = ['apply_config', 'load_config', 'reload_on_sighup', 'serve_control']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+# Changes from the control socket and from SIGHUP are applied one at a time
+_lock = threading.Lock()
+
+def apply_config(sniffers: list, config: dict) -> dict:
+    '''Reconfigures the processors of running sniffers, see Processor.reconfigure.
+
+    config maps a mode to the parameters to change, e.g. {"btle": {"seen_threshold": 3}}.
+    The parameters of all modes are validated before any processor is changed, so an
+    invalid config changes nothing. Returns the previous values by mode.
+
+    Raises ValueError for unknown modes, parameters and invalid values.'''
+
+    if not isinstance(config, dict):
+        raise ValueError('The config has to map modes to parameters.')
+
+    processors = {sniffer._processor.name: sniffer._processor for sniffer in sniffers}
+    for mode, settings in config.items():
+        if mode not in processors:
+            raise ValueError(f'No sniffer in mode {mode}.')
+        if not isinstance(settings, dict):
+            raise ValueError(f'The parameters of {mode} have to be an object.')
+
+        processors[mode]._validate(settings)
+
+    with _lock:
+        return {mode: processors[mode].reconfigure(**settings)
+                for mode, settings in config.items()}
+
+def load_config(path: str) -> dict:
+    '''Reads a config for apply_config from a JSON file.'''
+
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError as error:
+            raise ValueError(f'Invalid config {path}: {error}.') from None
+
+def reload_on_sighup(sniffers: list, path: str):
+    '''Applies the config file at path whenever the process receives SIGHUP. Has to be
+    called from the main thread.'''
+
+    def reload():
+        try:
+            apply_config(sniffers, load_config(path))
+        except (OSError, EOFError, ValueError) as error:
+            log.error('Config %s not applied: %s', path, str(error) or type(error).__name__)
+
+    # Reconfiguring waits for the processing locks, which the handler must not block on
+    def handler(signum, frame):
+        threading.Thread(target=reload, name='reload', daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handler)
+
+def serve_control(sniffers: list, path: str) -> socketserver.BaseServer:
+    '''Serves reconfiguration on the Unix domain socket at path from a daemon thread. Call
+    shutdown() on the returned server to stop it.
+
+    Each line received is a JSON config for apply_config and is answered by a line with
+    {"ok": true, "previous": ..., "settings": ...}, the previous values of the changed
+    parameters and all current parameters by mode, or {"ok": false, "error": ...}. An
+    empty config {} only returns the current parameters.'''
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+
+                try:
+                    previous = apply_config(sniffers, json.loads(line))
+                    reply = {'ok': True, 'previous': previous,
+                             'settings': {sniffer._processor.name: sniffer._processor.settings()
+                                          for sniffer in sniffers}}
+                except (OSError, EOFError, ValueError) as error:
+                    reply = {'ok': False, 'error': str(error) or type(error).__name__}
+
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+
+    log.debug('Serving control on %s.', path)
+
+    return server
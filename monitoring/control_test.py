@@ -0,0 +1,101 @@
+import json
+import os
+import signal
+import socket
+from time import sleep, time
+import pytest
+import sniffer
+from control import apply_config, reload_on_sighup, serve_control
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return sniffer.struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+@pytest.fixture
+def sniffers(tmp_path):
+    sniffers = [sniffer.Sniffer(processor=sniffer.BtleProcessor(
+                    pipe_path=str(tmp_path / 'pipes' / 'btle'), seen_threshold=5)),
+                sniffer.Sniffer(processor=sniffer.BtleAdvProcessor(
+                    pipe_path=str(tmp_path / 'pipes' / 'btle-adv'), seen_for=60))]
+    yield sniffers
+
+    for s in sniffers:
+        s._processor.stop()
+
+
+class TestApplyConfig:
+    def test_invalid_config_changes_nothing(self, sniffers):
+        for config in [{'btle': {'seen_threshold': 3}, 'btbr': {'seen_for': 10}},
+                       {'btle': {'seen_threshold': 3}, 'btle-adv': {'seen_for': -1}},
+                       {'btle': 3}, []]:
+            with pytest.raises(ValueError):
+                apply_config(sniffers, config)
+
+        assert sniffers[0]._processor.seen_threshold == 5, 'Config partially applied'
+
+    def test_sighup_reloads_file(self, sniffers, tmp_path):
+        path = tmp_path / 'config.json'
+        path.write_text(json.dumps({'btle': {'seen_threshold': 2}, 'btle-adv': {'seen_for': 5}}))
+
+        previous = signal.getsignal(signal.SIGHUP)
+        try:
+            reload_on_sighup(sniffers, str(path))
+            os.kill(os.getpid(), signal.SIGHUP)
+
+            for _ in range(100):
+                if sniffers[0]._processor.seen_threshold == 2:
+                    break
+                sleep(0.01)
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+
+        assert sniffers[0]._processor.seen_threshold == 2, 'btle not reconfigured'
+        assert sniffers[1]._processor.seen_for == 5, 'btle-adv not reconfigured'
+
+
+class TestControlSocket:
+    def test_reconfigure_over_socket(self, sniffers, tmp_path):
+        now = int(time())
+        processor = sniffers[0]._processor
+        processor.feed(btle_record(1, now, -50) * 3)
+
+        server = serve_control(sniffers, str(tmp_path / 'control'))
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(str(tmp_path / 'control'))
+                replies = client.makefile('rb')
+
+                client.sendall(b'{"btle": {"seen_threshold": 3}}\n')
+                reply = json.loads(replies.readline())
+                client.sendall(b'{"btle": {"seen_threshold": 0}}\n')
+                error = json.loads(replies.readline())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert reply['ok'] and reply['previous'] == {'btle': {'seen_threshold': 5}}, \
+            'Previous values not returned'
+        assert reply['settings']['btle']['seen_threshold'] == 3, 'Settings not returned'
+        assert not error['ok'] and 'seen_threshold' in error['error'], 'Error not returned'
+        assert [fp.aa for fp in processor.result] == [1], 'Fingerprint lost or not requalified'
+
+    def test_worker_errors_are_replied(self, sniffers, tmp_path, monkeypatch):
+        def reconfigure(**settings):
+            raise BrokenPipeError(32, 'Broken pipe')
+
+        monkeypatch.setattr(sniffers[0]._processor, 'reconfigure', reconfigure)
+        server = serve_control(sniffers, str(tmp_path / 'control'))
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(str(tmp_path / 'control'))
+                replies = client.makefile('rb')
+
+                client.sendall(b'{"btle": {"seen_threshold": 3}}\n')
+                error = json.loads(replies.readline())
+                client.sendall(b'{}\n')
+                reply = json.loads(replies.readline())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert not error['ok'] and 'Broken pipe' in error['error'], 'Error not returned'
+        assert reply['ok'], 'Connection not kept after an error'
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3.8
+
+import itertools
+import threading
+from collections import OrderedDict
+import logging as log
+
+__all__ = ['Dispatcher']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+class Dispatcher:
+    '''Runs a callback on a pool of worker threads, fed through a bounded queue so the
+    processing thread never waits for it.
+
+    When the queue is full, events are dropped according to policy and counted in dropped:\n
+    coalesce -- an event replaces the pending one for the same key, events for new keys are
+    dropped while the queue is full\n
+    drop-newest -- the new event is dropped\n
+    drop-oldest -- the oldest pending event is dropped to make room
+
+    Positional arguments:\n
+    callback -- called with each event\n
+
+    Keyword arguments:\n
+    workers -- number of worker threads\n
+    maxsize -- maximum number of pending events\n
+    policy -- one of coalesce, drop-newest, drop-oldest\n
+    name -- prefix of the worker thread names'''
+
+    POLICIES = ('coalesce', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, callback, *, workers: int=1, maxsize: int=1024, policy: str='coalesce',
+                 name: str='callback'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown policy: {policy}.')
+
+        self.callback = callback
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name=f'{name}{i}', daemon=True)
+                         for i in range(workers)]
+
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, event) -> bool:
+        '''Queues event without blocking. Returns whether it was queued.'''
+
+        with self._condition:
+            if self._closed:
+                return False
+
+            if self.policy != 'coalesce':
+                key = next(self._sequence)
+            elif key in self._pending:
+                self._pending[key] = event
+                self.coalesced += 1
+                return True
+
+            if len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                if self.policy != 'drop-oldest':
+                    return False
+
+                self._pending.popitem(last=False)
+
+            self._pending[key] = event
+            self._condition.notify()
+
+            return True
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+
+                if not self._pending:
+                    return
+
+                _, event = self._pending.popitem(last=False)
+
+            try:
+                self.callback(event)
+            except Exception:
+                log.exception('Callback failed.')
+
+    def close(self, *, drain: bool=True):
+        '''Stops the workers once the pending events are delivered, or drops them if not drain.'''
+
+        with self._condition:
+            self._closed = True
+            if not drain:
+                self.dropped += len(self._pending)
+                self._pending.clear()
+
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+    def __len__(self) -> int:
+        return len(self._pending)
@@ -0,0 +1,84 @@
+import threading
+import pytest
+from dispatch import Dispatcher
+
+class BlockedCallback:
+    '''Callback that holds its worker until released, recording the events.'''
+
+    def __init__(self):
+        self.events = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, event):
+        self.started.set()
+        self.release.wait(5)
+        self.events.append(event)
+
+
+class TestDispatcher:
+    def blocked(self, policy: str) -> tuple:
+        '''Dispatcher with a queue of two whose only worker is busy with event 0.'''
+
+        callback = BlockedCallback()
+        dispatcher = Dispatcher(callback, maxsize=2, policy=policy)
+        dispatcher.submit('busy', 0)
+        assert callback.started.wait(5), 'Worker did not take the first event'
+
+        return callback, dispatcher
+
+    def test_coalesce_replaces_pending_events(self):
+        callback, dispatcher = self.blocked('coalesce')
+
+        for event, key in enumerate(['a', 'b', 'a', 'c', 'b'], 1):
+            dispatcher.submit(key, event)
+
+        callback.release.set()
+        dispatcher.close()
+
+        assert callback.events == [0, 3, 5], 'Pending events should take the newest value'
+        assert dispatcher.coalesced == 2 and dispatcher.dropped == 1, 'Wrong counters'
+
+    @pytest.mark.parametrize('policy, delivered', [('drop-newest', [0, 1, 2]),
+                                                   ('drop-oldest', [0, 3, 4])])
+    def test_full_queue_drops(self, policy, delivered):
+        callback, dispatcher = self.blocked(policy)
+
+        for event in range(1, 5):
+            dispatcher.submit('same', event)
+
+        assert len(dispatcher) == 2, 'Queue exceeded maxsize'
+        callback.release.set()
+        dispatcher.close()
+
+        assert callback.events == delivered, 'Wrong events dropped'
+        assert dispatcher.dropped == 2, 'Dropped events not counted'
+
+    def test_close_without_drain_drops_pending(self):
+        callback, dispatcher = self.blocked('drop-newest')
+        dispatcher.submit('a', 1)
+
+        callback.release.set()
+        dispatcher.close(drain=False)
+
+        assert callback.events == [0] and dispatcher.dropped == 1, 'Pending event delivered'
+        assert not dispatcher.submit('b', 2), 'Closed dispatcher accepted an event'
+
+    def test_failing_callback_keeps_worker(self):
+        events = []
+
+        def callback(event):
+            if event == 'fail':
+                raise RuntimeError(event)
+            events.append(event)
+
+        dispatcher = Dispatcher(callback, policy='drop-newest')
+        dispatcher.submit(None, 'fail')
+        dispatcher.submit(None, 'ok')
+        dispatcher.close()
+
+        assert events == ['ok'], 'Worker stopped after a failing callback'
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            Dispatcher(print, policy='block')
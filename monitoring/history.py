@@ -0,0 +1,219 @@
+#!/usr/bin/env python3.8
+
+import sys
+import threading
+from array import array
+
+__all__ = ['RssiHistory', 'HistoryPool', 'delta_encode', 'delta_decode']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+# Sample of an interval in which the device was not seen
+_MISSING = -0x8000
+
+class RssiHistory:
+    '''Fixed-size ring of the RSSI of a device, one sample per interval seconds of record time.
+
+    A sample is the mean RSSI of the records within its interval. Intervals without records
+    are kept as gaps, so the samples are evenly spaced in time. Records older than the
+    current interval are ignored. Once length samples are held, the oldest are overwritten.
+
+    Rings taken from a HistoryPool return their share of its budget when they are freed.
+
+    Keyword arguments:\n
+    length -- number of samples kept\n
+    interval -- seconds covered by a sample'''
+
+    __slots__ = ('interval', '_samples', '_next', '_size', '_slot', '_sum', '_count', '_pool')
+
+    def __init__(self, *, length: int=60, interval: int=10):
+        self.interval = interval
+        self._samples = array('h', bytes(2 * length))
+        self._next = 0
+        self._size = 0
+        # Interval the records currently summed up belong to, None before the first
+        self._slot = None
+        self._sum = 0
+        self._count = 0
+        self._pool = None
+
+    def update(self, timestamp: int, rssi: int):
+        slot = timestamp // self.interval
+        if slot != self._slot:
+            if self._slot is not None:
+                if slot < self._slot:
+                    return
+                self._close(slot)
+            self._slot = slot
+
+        self._sum += rssi
+        self._count += 1
+
+    def _close(self, slot: int):
+        '''Stores the sample of the current interval and gaps up to slot.'''
+
+        self._push(round(self._sum / self._count))
+        for _ in range(min(slot - self._slot - 1, len(self._samples))):
+            self._push(_MISSING)
+
+        self._sum = self._count = 0
+
+    def _push(self, value: int):
+        samples = self._samples
+        samples[self._next] = value
+        self._next = (self._next + 1) % len(samples)
+        self._size = min(self._size + 1, len(samples))
+
+    @property
+    def length(self) -> int:
+        return len(self._samples)
+
+    def samples(self) -> list:
+        '''Returns the samples from the oldest to the current interval, None for gaps. The
+        current interval is included with the mean of the records so far.'''
+
+        samples, size = self._samples, self._size
+        start = (self._next - size) % len(samples)
+        values = [samples[(start + i) % len(samples)] for i in range(size)]
+        if self._count:
+            values.append(round(self._sum / self._count))
+            values = values[-len(samples):]
+
+        return [None if value == _MISSING else value for value in values]
+
+    @property
+    def start(self) -> int:
+        '''Timestamp at which the interval of the oldest sample starts, None if empty.'''
+
+        if self._slot is None:
+            return None
+
+        return (self._slot - len(self.samples()) + 1) * self.interval
+
+    def encode(self) -> dict:
+        '''Compact form of the samples for JSON, see delta_encode.'''
+        return {'start': self.start, 'interval': self.interval,
+                'rssi': delta_encode(self.samples())}
+
+    # Fixed size encoding used in fingerprint records, keeping the latest length samples
+    @staticmethod
+    def record_format(length: int) -> str:
+        return f'?HqqqH{length}h'
+
+    @staticmethod
+    def pack_missing(length: int) -> tuple:
+        return (False, 0, 0, 0, 0, 0, *[0] * length)
+
+    def pack(self, length: int) -> tuple:
+        values = [_MISSING if value is None else value for value in self.samples()[-length:]]
+        return (True, self.interval, -1 if self._slot is None else self._slot, self._sum,
+                self._count, len(values), *values, *[0] * (length - len(values)))
+
+    @classmethod
+    def unpack(cls, values: tuple) -> 'RssiHistory':
+        '''Creates a ring from the values of record_format, None if none was packed.'''
+
+        present, interval, slot, total, count, size, *samples = values
+        if not present:
+            return None
+
+        history = cls(length=len(samples), interval=interval)
+        # The current interval is stored as a sample and continued from it
+        stored = samples[:size - 1] if count else samples[:size]
+        for value in stored:
+            history._push(value)
+        history._slot = None if slot < 0 else slot
+        history._sum, history._count = total, count
+
+        return history
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool._release()
+
+def delta_encode(values: list) -> list:
+    '''Encodes a series as its first value followed by the differences between consecutive
+    values. Gaps stay None and the next value is relative to the last one before the gap.'''
+
+    encoded = []
+    previous = None
+    for value in values:
+        if value is None:
+            encoded.append(None)
+        else:
+            encoded.append(value if previous is None else value - previous)
+            previous = value
+
+    return encoded
+
+def delta_decode(encoded: list) -> list:
+    '''Inverse of delta_encode.'''
+
+    values = []
+    previous = None
+    for delta in encoded:
+        if delta is None:
+            values.append(None)
+        else:
+            previous = delta if previous is None else previous + delta
+            values.append(previous)
+
+    return values
+
+class HistoryPool:
+    '''Hands out RssiHistory rings to the fingerprints of a processor within a memory budget.
+
+    Devices first seen while the rings in use take up the budget get no history. Rings
+    return their share when they are freed, i.e. when their fingerprint was dropped from
+    the table and is no longer referenced by a result. That happens on whichever thread
+    drops the last reference, so the count of rings in use is kept under a lock.
+
+    Keyword arguments:\n
+    length, interval -- of the rings, see RssiHistory\n
+    max_bytes -- budget of all rings together, 0 for none'''
+
+    def __init__(self, *, length: int=60, interval: int=10, max_bytes: int=0):
+        self.length = length
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.rings = 0
+        self.denied = 0
+        # Reentrant, a ring may be freed by the garbage collector while ring() holds it
+        self._lock = threading.RLock()
+
+        ring = RssiHistory(length=length, interval=interval)
+        self.ring_bytes = sys.getsizeof(ring) + sys.getsizeof(ring._samples)
+
+    def ring(self) -> RssiHistory:
+        '''Returns a new ring, or None if the budget is used up.'''
+
+        with self._lock:
+            if self.max_bytes and (self.rings + 1) * self.ring_bytes > self.max_bytes:
+                self.denied += 1
+                return None
+
+            self.rings += 1
+
+        ring = RssiHistory(length=self.length, interval=self.interval)
+        ring._pool = self
+
+        return ring
+
+    def _release(self):
+        with self._lock:
+            self.rings -= 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.rings * self.ring_bytes
+
+    def __getstate__(self) -> dict:
+        # Workers of a sharded processor start with an empty pool
+        state = {**self.__dict__, 'rings': 0, 'denied': 0}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
@@ -0,0 +1,95 @@
+import copy
+import pickle
+import struct
+import threading
+from history import RssiHistory, HistoryPool, delta_encode, delta_decode
+
+
+class TestRssiHistory:
+    def test_downsamples_and_keeps_gaps(self):
+        history = RssiHistory(length=10, interval=10)
+        for timestamp, rssi in [(1000, -60), (1005, -70), (1012, -50), (1041, -80), (1003, -99)]:
+            history.update(timestamp, rssi)
+
+        assert history.samples() == [-65, -50, None, None, -80], 'Wrong samples'
+        assert history.start == 1000, 'Wrong start of the oldest sample'
+
+    def test_ring_keeps_latest_samples(self):
+        history = RssiHistory(length=4, interval=1)
+        for timestamp in range(10):
+            history.update(timestamp, -timestamp)
+
+        assert history.samples() == [-6, -7, -8, -9], 'Oldest samples should be overwritten'
+        assert history.start == 6, 'Start should follow the ring'
+
+        # A long absence only leaves gaps
+        history.update(1000, -50)
+        assert history.samples() == [None, None, None, -50], 'Gaps not capped at the length'
+
+    def test_record_roundtrip(self):
+        history = RssiHistory(length=8, interval=5)
+        for timestamp, rssi in [(100, -60), (106, -61), (117, -70), (118, -72)]:
+            history.update(timestamp, rssi)
+
+        record = struct.Struct('=' + RssiHistory.record_format(6))
+        copy = RssiHistory.unpack(record.unpack(record.pack(*history.pack(6))))
+        assert copy.samples() == history.samples() and copy.start == history.start, \
+            'Samples not preserved'
+
+        # The current interval continues where it left off
+        history.update(119, -74)
+        copy.update(119, -74)
+        assert copy.samples() == history.samples(), 'Current interval not preserved'
+
+        assert RssiHistory.unpack(record.unpack(record.pack(*RssiHistory.pack_missing(6)))) is None, \
+            'Missing history should stay missing'
+
+    def test_delta_encoding(self):
+        values = [-60, -62, None, -58, -58]
+        assert delta_encode(values) == [-60, -2, None, 4, 0], 'Wrong deltas'
+        assert delta_decode(delta_encode(values)) == values, 'Decoding is not the inverse'
+
+        history = RssiHistory(length=4, interval=10)
+        history.update(1000, -60)
+        history.update(1010, -62)
+        assert history.encode() == {'start': 1000, 'interval': 10, 'rssi': [-60, -2]}, \
+            'Wrong JSON form'
+
+
+class TestHistoryPool:
+    def test_budget_and_release(self):
+        pool = HistoryPool(length=32)
+        pool.max_bytes = 3 * pool.ring_bytes
+
+        rings = [pool.ring() for _ in range(4)]
+        assert rings[3] is None and all(rings[:3]), 'Budget allows three rings'
+        assert pool.nbytes == 3 * pool.ring_bytes and pool.denied == 1, 'Wrong accounting'
+
+        del rings[0]
+        assert pool.ring() is not None, 'Freed ring should return its share'
+
+    def test_rings_freed_on_other_threads(self):
+        pool = HistoryPool(length=8)
+        batches = [[pool.ring() for _ in range(2000)] for _ in range(4)]
+
+        def free(rings: list):
+            while rings:
+                rings.pop()
+                pool.ring()
+
+        threads = [threading.Thread(target=free, args=[rings]) for rings in batches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert pool.rings == 0, 'Rings freed concurrently were miscounted'
+
+    def test_copies_start_empty(self):
+        pool = HistoryPool(length=8, max_bytes=1 << 20)
+        ring = pool.ring()
+
+        for clone in [copy.copy(pool), pickle.loads(pickle.dumps(pool))]:
+            assert clone.rings == 0 and clone.max_bytes == 1 << 20, 'Copy should start empty'
+            assert clone.ring() is not None and clone.rings == 1, 'Copy cannot hand out rings'
+        assert pool.rings == 1 and ring is not None, 'Copying changed the pool'
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3.8
+
+import argparse
+import random
+import struct
+import sys
+from time import perf_counter, sleep, time
+
+__all__ = ['RecordGenerator', 'write_paced', 'MODES', 'RSSI_DISTRIBUTIONS']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+# Record formats written by ubertooth-rx -m, ubertooth-btle -m and ubertooth-btle -M
+MODES = {
+    'btbr': 'HBII',
+    'btle': 'IIi',
+    'btle-adv': 'B?6sIiHH',
+}
+
+RSSI_DISTRIBUTIONS = {
+    # Devices at a typical distance
+    'gauss': lambda rng: rng.gauss(-70, 8),
+    'uniform': lambda rng: rng.uniform(-100, -30),
+    # A few devices close to the antenna among many far away ones
+    'bimodal': lambda rng: rng.gauss(-50, 5) if rng.random() < 0.2 else rng.gauss(-85, 5),
+}
+
+class RecordGenerator:
+    '''Generates a stream of synthetic records in the format of one of the sniffer modes.
+
+    Addresses are drawn uniformly from a fixed set of the given size, or taken from it in
+    turn if sequential, so each address occurs once per round. Timestamps follow a
+    clock starting at start and advancing by 1 / rate per record, each shifted by up to
+    skew seconds in either direction, so records with skew arrive out of order. A fraction
+    noise of the records carries a random address instead, like addresses decoded from bit
+    errors, which are practically never seen twice.
+
+    Positional arguments:\n
+    mode -- one of btbr, btle, btle-adv\n
+
+    Keyword arguments:\n
+    addresses -- number of distinct addresses\n
+    rssi -- name of the RSSI distribution, see RSSI_DISTRIBUTIONS\n
+    skew -- maximum deviation of timestamps from the clock in seconds\n
+    rate -- records per second of the timestamp clock\n
+    start -- first timestamp, defaults to now\n
+    seed -- seed of the random number generator\n
+    sequential -- take the addresses in turn instead of at random\n
+    noise -- fraction of records with a random address'''
+
+    def __init__(self, mode: str, *, addresses: int=1000, rssi: str='gauss', skew: float=0,
+                 rate: float=1000, start: float=None, seed: int=0, sequential: bool=False,
+                 noise: float=0):
+        self.mode = mode
+        self.record_size = struct.calcsize(MODES[mode])
+        self._struct = struct.Struct(MODES[mode])
+        self._rng = random.Random(seed)
+        self._rssi = RSSI_DISTRIBUTIONS[rssi]
+        self._skew = skew
+        self._rate = rate
+        self._start = time() if start is None else start
+        self._index = 0
+        self._sequential = sequential
+        self._noise = noise
+        self._preloaded = memoryview(b'')
+
+        # Spread the addresses over the key space, sniffers shard and hash on them
+        self._addresses = [(i * 2654435761) & 0xffffffffffff for i in range(addresses)]
+
+    def preload(self, count: int):
+        '''Generates the next count records up front, so serving them later only costs a copy.
+        Keeps the generator from competing with the sniffer for the CPU while measuring.'''
+
+        self._preloaded = memoryview(self._generate(count))
+
+    def records(self, count: int) -> bytes:
+        '''Returns the next count records of the stream.'''
+
+        length = count * self.record_size
+        data, self._preloaded = self._preloaded[:length], self._preloaded[length:]
+        if len(data) < length:
+            return bytes(data) + self._generate(count - len(data) // self.record_size)
+
+        return data
+
+    def _generate(self, count: int) -> bytes:
+        rng = self._rng
+        pack = self._struct.pack
+        records = []
+
+        for i in range(self._index, self._index + count):
+            address = self._addresses[i % len(self._addresses)] if self._sequential else \
+                rng.choice(self._addresses)
+            if self._noise and rng.random() < self._noise:
+                address = rng.getrandbits(48)
+            timestamp = int(self._start + i / self._rate + rng.uniform(-self._skew, self._skew))
+            rssi = max(-128, min(0, int(self._rssi(rng))))
+
+            if self.mode == 'btbr':
+                records.append(pack(0b1, address >> 24 & 0xff, address & 0xffffff, timestamp))
+            elif self.mode == 'btle':
+                records.append(pack(address & 0xffffffff, timestamp, rssi))
+            else:
+                records.append(pack(0, True, address.to_bytes(6, 'little'), timestamp, rssi,
+                                    0xfd6f, 0x4c))
+
+        self._index += count
+
+        return b''.join(records)
+
+def write_paced(pipe, generator: RecordGenerator, rate: float, *, duration: float=None,
+                count: int=None, batches_per_second: int=100, on_batch=None) -> tuple:
+    '''Writes records from generator to pipe at rate records per second until duration
+    seconds passed or count records were written.
+
+    Records are written in batches on a fixed schedule. A slow reader blocks the writes, so
+    the writer falls behind schedule instead of the reader dropping records. on_batch is
+    called with the total number of records after each write.
+
+    Returns the number of records written and the seconds it took.'''
+
+    batch = max(1, int(rate / batches_per_second))
+    interval = batch / rate
+    written = 0
+    start = perf_counter()
+
+    while (duration is None or perf_counter() - start < duration) and \
+          (count is None or written < count):
+        size = batch if count is None else min(batch, count - written)
+        pipe.write(generator.records(size))
+        written += size
+
+        if on_batch is not None:
+            on_batch(written)
+
+        # Sleep until the next batch is due, batches that are late are written immediately
+        if (delay := start + written / batch * interval - perf_counter()) > 0:
+            sleep(delay)
+
+    return written, perf_counter() - start
+
+if __name__ == '__main__':
+    # Stand-in for ubertooth-rx -m / ubertooth-btle -m / ubertooth-btle -M writing to a FIFO
+    parser = argparse.ArgumentParser(description='Write synthetic sniffer records to a pipe.')
+    parser.add_argument('mode', type=str, choices=list(MODES), help='Record format to write.')
+    parser.add_argument('pipe', type=str, nargs='?', default='/dev/stdout',
+                        help='FIFO or file to write to.')
+    parser.add_argument('-r', '--rate', type=float, default=1000, help='Records per second.')
+    parser.add_argument('-d', '--duration', type=float, default=None, help='Seconds to write for.')
+    parser.add_argument('-n', '--records', type=int, default=None, help='Number of records to write.')
+    parser.add_argument('-a', '--addresses', type=int, default=1000,
+                        help='Number of distinct addresses.')
+    parser.add_argument('--rssi', type=str, choices=list(RSSI_DISTRIBUTIONS), default='gauss',
+                        help='RSSI distribution.')
+    parser.add_argument('--skew', type=float, default=0,
+                        help='Maximum deviation of timestamps from the clock in seconds.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--noise', type=float, default=0,
+                        help='Fraction of records with a random address.')
+
+    args = parser.parse_args()
+
+    generator = RecordGenerator(args.mode, addresses=args.addresses, rssi=args.rssi,
+                                skew=args.skew, rate=args.rate, seed=args.seed, noise=args.noise)
+
+    if args.records or args.duration:
+        generator.preload(args.records or int(args.rate * args.duration))
+
+    with open(args.pipe, 'wb', buffering=0) as pipe:
+        written, elapsed = write_paced(pipe, generator, args.rate, duration=args.duration,
+                                       count=args.records)
+
+    print(f'{written} records in {elapsed:.3f} s, {written / elapsed:.0f} rec/s.', file=sys.stderr)
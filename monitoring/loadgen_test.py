@@ -0,0 +1,44 @@
+import io
+import struct
+import pytest
+import sniffer
+from loadgen import RecordGenerator, write_paced
+
+PROCESSORS = [sniffer.BtbrProcessor, sniffer.BtleProcessor, sniffer.BtleAdvProcessor]
+
+
+class TestRecordGenerator:
+    @pytest.mark.parametrize('processor_cls', PROCESSORS)
+    def test_records_match_processor_format(self, tmp_path, processor_cls):
+        generator = RecordGenerator(processor_cls.name, addresses=50, start=1000, rate=100)
+        processor = processor_cls(pipe_path=str(tmp_path / 'pipe'))
+
+        assert generator.record_size == processor._packet_length, 'Record size differs'
+        assert processor.feed(generator.records(1000)) == 1000, 'Records not decoded'
+        assert len(processor._tracked()) == 50, 'Wrong number of distinct addresses'
+
+    def test_timestamps_are_skewed(self):
+        generator = RecordGenerator('btle', start=1000, rate=10, skew=3, rssi='uniform')
+        records = list(struct.iter_unpack(sniffer.BtleProcessor._fmt, generator.records(1000)))
+        deviations = [timestamp - (1000 + i / 10) for i, (_, timestamp, _) in enumerate(records)]
+
+        assert min(deviations) >= -4 and max(deviations) <= 3, 'Skew exceeded'
+        assert any(b[1] < a[1] for a, b in zip(records, records[1:])), 'Records should be out of order'
+        assert all(-100 <= rssi <= -30 for *_, rssi in records), 'RSSI outside distribution'
+
+    def test_preloaded_records_continue_the_stream(self):
+        preloaded = RecordGenerator('btle', start=1000, seed=1)
+        preloaded.preload(10)
+        generated = RecordGenerator('btle', start=1000, seed=1)
+
+        assert bytes(preloaded.records(15)) == generated.records(15), 'Streams differ'
+
+
+class TestWritePaced:
+    def test_writes_at_rate(self):
+        pipe = io.BytesIO()
+        written, elapsed = write_paced(pipe, RecordGenerator('btle'), 2000, duration=0.5)
+
+        assert len(pipe.getvalue()) == written * 12, 'Records not written'
+        assert 900 <= written <= 1100, 'Rate not kept'
+        assert elapsed == pytest.approx(0.5, abs=0.1), 'Duration not kept'
@@ -10,8 +10,16 @@ import sys
 from datetime import date
 import json
 import getmac
-from sniffer import Sniffer, BtbrProcessor, BtleProcessor, BtleAdvProcessor, \
-    BtbrFingerprint, BtleFingerprint, BtleAdvFingerprint, mac_bytes_to_str
+from sniffer import Sniffer, AsyncRuntime, BtbrProcessor, BtleProcessor, BtleAdvProcessor, \
+    BtbrFingerprint, BtleFingerprint, BtleAdvFingerprint, mac_int_to_str
+from sharding import ShardedProcessor
+from stats import serve_prometheus
+from capture import CaptureWriter
+from dispatch import Dispatcher
+from sketch import AdmissionFilter
+from history import HistoryPool
+from scheduler import Scheduler
+from control import apply_config, load_config, reload_on_sighup, serve_control
 from networking import RequestHandler, Endpoint
 
 ANTENNA = 0
@@ -59,22 +67,39 @@ def report_btbr_result(fingerprint: BtbrFingerprint):
     data = dict(zip(keys, vals))
     RequestHandler.make_post_request(Endpoint.BTBR, data)
 
+def add_quantiles(data: dict, fingerprint):
+    '''Adds the RSSI median and interquartile range if the processor keeps them.'''
+
+    if (median := fingerprint.median) is not None:
+        data['median'] = median
+        data['iqr'] = fingerprint.iqr
+
+def add_history(data: dict, fingerprint):
+    '''Adds the delta encoded RSSI history if the processor keeps one, see history.RssiHistory.'''
+
+    if fingerprint.history is not None:
+        data['rssiHistory'] = fingerprint.history.encode()
+
 def report_btle_result(fingerprint: BtleFingerprint):
     keys = ['accessAddress', 'rssi', 'std', 'mean', 'firstSeen', 'lastSeen', 'antennaId']
     vals = [f'{fingerprint.aa:06X}', fingerprint.rssi, fingerprint.std, fingerprint.mean,
             fingerprint.first_seen, fingerprint.last_seen, ANTENNA]
 
     data = dict(zip(keys, vals))
+    add_quantiles(data, fingerprint)
+    add_history(data, fingerprint)
     RequestHandler.make_post_request(Endpoint.BTLE, data)
     log.debug('Received fingerprint %s', fingerprint)
 
 def report_btle_adv_result(fingerprint: BtleAdvFingerprint):
     keys = ['macAddress', 'rssi', 'std', 'mean', 'firstSeen', 'lastSeen', 'serviceUUID', 'companyId', 'random', 'antennaId']
-    vals = [mac_bytes_to_str(fingerprint.mac), fingerprint.rssi, fingerprint.std, fingerprint.mean,
+    vals = [mac_int_to_str(fingerprint.mac), fingerprint.rssi, fingerprint.std, fingerprint.mean,
             fingerprint.first_seen, fingerprint.last_seen, fingerprint.service_uuid,
             fingerprint.company_id, 1 if fingerprint.random else 0, ANTENNA]
 
     data = dict(zip(keys, vals))
+    add_quantiles(data, fingerprint)
+    add_history(data, fingerprint)
     RequestHandler.make_post_request(Endpoint.MAC, data)
     log.debug('Received fingerprint %s', fingerprint)
 
@@ -92,24 +117,70 @@ def num_uberteeth():
 
     return uberteeth
 
-def create_sniffers(modes: list):
+def create_sniffers(modes: list, *, columnar: bool=False, runtime: AsyncRuntime=None,
+                    workers: int=0, capture: str=None, compress: bool=False,
+                    notify: bool=False, notify_workers: int=1, notify_policy: str='coalesce',
+                    max_entries: int=0, max_bytes: int=0, ttl: float=0, admit: int=0,
+                    quantiles: bool=False, history: int=0, history_interval: int=10,
+                    history_bytes: int=0, stall_timeout: float=0, max_backoff: float=30):
 
     sniffers = []
 
     for i, mode in enumerate(modes):
         if mode == 'btbr':
-            sniffers.append(Sniffer(processor=BtbrProcessor(callback=report_btbr_result, seen_for=60, ut_id=i)))
+            processor_cls, callback, options = BtbrProcessor, report_btbr_result, {'seen_for': 60}
         elif mode == 'btle':
-            sniffers.append(Sniffer(processor=BtleProcessor(callback=report_btle_result, ut_id=i)))
+            processor_cls, callback, options = BtleProcessor, report_btle_result, \
+                {'columnar': columnar, 'admission': AdmissionFilter(admit) if admit else None,
+                 'quantiles': quantiles}
         elif mode == 'btle-adv':
-            sniffers.append(Sniffer(processor=BtleAdvProcessor(callback=report_btle_adv_result, seen_for=60,
-                                                               ut_id=i)))
+            processor_cls, callback, options = BtleAdvProcessor, report_btle_adv_result, \
+                {'seen_for': 60, 'columnar': columnar, 'quantiles': quantiles}
         else:
             log.error('Unrecognized operating mode: %s.', mode)
             sys.exit(-1)
 
+        options.update(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+        if history and mode != 'btbr':
+            options['history'] = HistoryPool(length=history, interval=history_interval,
+                                             max_bytes=history_bytes)
+
+        # Report new devices and btle devices crossing the threshold as they happen
+        if notify:
+            options['callback'] = Dispatcher(callback, workers=notify_workers,
+                                             policy=notify_policy, name=f'{mode}.callback')
+
+        if capture:
+            options['capture'] = CaptureWriter(capture, name=mode, compress=compress,
+                                               record_size=processor_cls._packet_length)
+
+        if workers:
+            # Only btle produces enough records to be worth sharding
+            processor = ShardedProcessor(processor_cls, workers=workers if mode == 'btle' else 1,
+                                         ut_id=i, **options)
+        else:
+            processor = processor_cls(ut_id=i, **options)
+
+        sniffers.append(Sniffer(processor=processor, runtime=runtime, stall_timeout=stall_timeout,
+                                max_backoff=max_backoff))
+
     return sniffers
 
+def parse_per_mode(values: list, cast, default) -> dict:
+    '''Parses MODE=VALUE arguments into a dict by mode. A bare VALUE replaces the default,
+    which every mode without a value of its own gets.'''
+
+    per_mode = {}
+    for value in values:
+        mode, _, value = value.rpartition('=')
+        if mode:
+            per_mode[mode] = cast(value)
+        else:
+            default = cast(value)
+
+    return {mode: per_mode.get(mode, default) for mode in ['btbr', 'btle', 'btle-adv']}
+
 def report_results(sniffers: list):
     while True:
 
@@ -176,25 +247,125 @@ if __name__ == '__main__':
 
     parser.add_argument('modes', metavar='modes', type=str, nargs='+',
                         help='Operating modes. One or more of btbr, btle, btle-adv. \
-                              One Ubertooth is required per mode.')
+                              With fewer Uberteeth than modes, they take turns on them.')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Keep btle and btle-adv fingerprints in NumPy arrays.')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Run all sniffers on one asyncio event loop instead of two threads each.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run each processor in its own process, sharding btle over this many.')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve sniffer stats in Prometheus format on this local port.')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='Record the raw records of every sniffer to this directory.')
+    parser.add_argument('--compress', action='store_true', help='Gzip the captured records.')
+    parser.add_argument('--notify', action='store_true',
+                        help='Report new devices as they are seen, in addition to periodically.')
+    parser.add_argument('--notify-workers', type=int, default=1,
+                        help='Threads reporting new devices.')
+    parser.add_argument('--notify-policy', type=str, default='coalesce', choices=Dispatcher.POLICIES,
+                        help='What to drop when reporting new devices falls behind.')
+    parser.add_argument('--max-entries', type=int, default=0,
+                        help='Most fingerprints each processor keeps, evicting the least recently seen.')
+    parser.add_argument('--max-mb', type=float, default=0,
+                        help='Memory budget of each processor\'s fingerprint table in MB.')
+    parser.add_argument('--quantiles', action='store_true',
+                        help='Report the RSSI median and interquartile range of btle and '
+                             'btle-adv devices, not supported with --columnar.')
+    parser.add_argument('--history', type=int, default=0,
+                        help='Report the last this many RSSI samples of btle and btle-adv '
+                             'devices, not supported with --columnar.')
+    parser.add_argument('--history-interval', type=int, default=10,
+                        help='Seconds averaged into one RSSI history sample.')
+    parser.add_argument('--history-mb', type=float, default=0,
+                        help='Memory budget of the RSSI histories of each processor in MB.')
+    parser.add_argument('--dwell', type=str, nargs='+', default=[],
+                        help='Seconds a mode keeps an Ubertooth when they take turns, as SECONDS '
+                             f'or MODE=SECONDS. Defaults to {Scheduler.DEFAULT_DWELL}.')
+    parser.add_argument('--weight', type=str, nargs='+', default=[],
+                        help='Relative share of turns of a mode as MODE=WEIGHT. Defaults to 1.')
+    parser.add_argument('--admit', type=int, default=0,
+                        help='Only track btle access addresses seen this many times within 10 s. '
+                             'The sightings before admission count towards seen_threshold but '
+                             'not towards times_seen.')
+    parser.add_argument('--ttl', type=float, default=0,
+                        help='Drop fingerprints not seen for this many seconds between reports.')
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON file of processor parameters by mode, e.g. '
+                             '{"btle": {"seen_threshold": 3}}. Applied at start and reloaded on '
+                             'SIGHUP.')
+    parser.add_argument('--control', type=str, default=None,
+                        help='Unix domain socket accepting the same JSON, one object per line, '
+                             'to change parameters while capturing.')
+    parser.add_argument('--stall-timeout', type=float, default=0,
+                        help='Restart an ubertooth tool that produced no data for this many seconds.')
+    parser.add_argument('--max-backoff', type=float, default=30,
+                        help='Longest delay in seconds between restarts of a failing ubertooth tool.')
 
     args = parser.parse_args()
 
-    if (required := len(args.modes)) > (present := num_uberteeth()):
-        log.critical('Too few Uberteeth connected. %i required, %i present.', required, present)
-        print(f'Too few Uberteeth connected. {required} required, {present} present.')
+    if (present := num_uberteeth()) < 1:
+        log.critical('No Ubertooth connected.')
+        print('No Ubertooth connected.')
         sys.exit(-1)
 
+    if (required := len(args.modes)) > present:
+        if args.asyncio:
+            log.critical('Too few Uberteeth connected for --asyncio. %i required, %i present.',
+                         required, present)
+            print(f'Too few Uberteeth connected. {required} required, {present} present.')
+            sys.exit(-1)
+
+        log.warning('%i Uberteeth for %i modes, the modes take turns.', present, required)
+
     RequestHandler()
 
     get_antenna_id()
     with cv:
         cv.wait()
 
-    sniffers = create_sniffers(args.modes)
+    runtime = AsyncRuntime() if args.asyncio else None
+    sniffers = create_sniffers(args.modes, columnar=args.columnar, runtime=runtime,
+                               workers=args.workers, capture=args.capture, compress=args.compress,
+                               notify=args.notify, notify_workers=args.notify_workers,
+                               notify_policy=args.notify_policy, max_entries=args.max_entries,
+                               max_bytes=int(args.max_mb * 2**20), ttl=args.ttl,
+                               admit=args.admit, quantiles=args.quantiles, history=args.history,
+                               history_interval=args.history_interval,
+                               history_bytes=int(args.history_mb * 2**20),
+                               stall_timeout=args.stall_timeout, max_backoff=args.max_backoff)
+
+    if args.config:
+        try:
+            apply_config(sniffers, load_config(args.config))
+        except (OSError, ValueError) as error:
+            log.critical('Config %s not applied: %s', args.config, error)
+            print(f'Config {args.config} not applied: {error}')
+            sys.exit(-1)
+
+        reload_on_sighup(sniffers, args.config)
 
-    for sniffer in sniffers:
-        sniffer.start()
+    try:
+        scheduler = Scheduler(sniffers, dongles=present,
+                              dwell=parse_per_mode(args.dwell, float, Scheduler.DEFAULT_DWELL),
+                              weights=parse_per_mode(args.weight, float, 1)) \
+            if not runtime else None
+    except ValueError as error:
+        log.critical('Unable to schedule the sniffers: %s', error)
+        print(f'Unable to schedule the sniffers: {error}')
+        sys.exit(-1)
+
+    if scheduler:
+        scheduler.start()
+    else:
+        for sniffer in sniffers:
+            sniffer.start()
+
+    if args.metrics_port:
+        serve_prometheus(sniffers, args.metrics_port, uplink=RequestHandler.stats)
+
+    if args.control:
+        serve_control(sniffers, args.control)
 
     location_reporter = threading.Thread(target=report_location,
                                         args=[2],
@@ -210,8 +381,21 @@ if __name__ == '__main__':
 
     input("Enter to stop")
 
+    if scheduler:
+        scheduler.stop()
+    else:
+        for sniffer in sniffers:
+            sniffer.stop()
+
+    if runtime:
+        runtime.close()
+
     for sniffer in sniffers:
-        sniffer.stop()
+        if sniffer._processor._capture is not None:
+            sniffer._processor._capture.close()
+
+    # Send the reports still waiting to be batched
+    RequestHandler.shutdown()
 
     for sniffer in sniffers:
         print(sniffer)
@@ -4,14 +4,28 @@
 # mozilla/VeriSign_Universal_Root_Certification_Authority.crt
 
 import json
+import gzip
 import datetime
 import logging as log
-from queue import Queue
+from queue import Queue, Empty
+from time import monotonic
 from enum import Enum, IntEnum
 import threading
 import requests
+from spool import Spool
+from requests.adapters import HTTPAdapter
 
-__all__ = ['Endpoint', 'Method', 'RequestHandler']
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['Endpoint', 'Method', 'RequestHandler', 'available_encodings', 'encode', 'decode']
 
 __author__ = "Severin Marti <severin.marti@ost.ch"
 __status__  = "development"
@@ -34,14 +48,105 @@ class Method(IntEnum):
     PUT = 2
     DELETE = 3
 
+# Responses to an array telling that the endpoint may not accept arrays, that one of the
+# items was not accepted, and that the array was too large
+_UNSUPPORTED = {404, 405, 415}
+_INVALID = {400, 422}
+_TOO_LARGE = 413
+
+# Encodings of request bodies are named FORMAT or FORMAT+COMPRESSION. The formats are json,
+# table, which sends an array as the keys of its objects once and a row of values per
+# object, and msgpack, which sends the same in MessagePack. Compressions are gzip and zstd.
+_FORMATS = {'json': 'application/json', 'table': 'application/x-table+json',
+            'msgpack': 'application/msgpack'}
+_COMPRESSIONS = ['', 'gzip', 'zstd']
+
+def available_encodings() -> list:
+    '''Returns the encodings supported by the installed packages.'''
+
+    formats = [name for name in _FORMATS if name != 'msgpack' or msgpack is not None]
+    compressions = [name for name in _COMPRESSIONS if name != 'zstd' or zstandard is not None]
+
+    return [f'{format}+{compression}' if compression else format
+            for format in formats for compression in compressions]
+
+def _table(items: list) -> dict:
+    '''Packs objects into the keys of the first and a row of values per object. Objects with
+    other keys are kept as they are.'''
+
+    keys = list(items[0]) if items else []
+    return {'keys': keys, 'rows': [list(item.values()) if list(item) == keys else item
+                                   for item in items]}
+
+def _untable(table: dict) -> list:
+    keys = table['keys']
+    return [dict(zip(keys, row)) if isinstance(row, list) else row for row in table['rows']]
+
+def encode(encoding: str, payload) -> tuple:
+    '''Returns the body and the headers sending payload in encoding.
+
+    Positional arguments:\n
+    encoding -- one of available_encodings()\n
+    payload -- a JSON text, or a list of them sent as an array. The table formats send a
+    single object as it is.'''
+
+    format, _, compression = encoding.partition('+')
+    batch = isinstance(payload, list)
+
+    if format == 'json' or (format == 'table' and not batch):
+        format = 'json'
+        body = ('[' + ','.join(payload) + ']' if batch else payload).encode()
+    else:
+        content = _table([json.loads(item) for item in payload]) if batch else \
+            json.loads(payload)
+        body = msgpack.packb(content) if format == 'msgpack' else \
+            json.dumps(content, separators=(',', ':')).encode()
+
+    headers = {'Content-Type': _FORMATS[format]}
+    if compression == 'gzip':
+        body = gzip.compress(body)
+    elif compression == 'zstd':
+        body = zstandard.ZstdCompressor().compress(body)
+    if compression:
+        headers['Content-Encoding'] = compression
+
+    return body, headers
+
+def decode(body: bytes, headers) -> object:
+    '''Reference decoder of the bodies made by encode. Returns the object or the list of
+    objects sent. Raises ValueError if the encoding is not supported.'''
+
+    compression = headers.get('Content-Encoding')
+    if compression == 'gzip':
+        body = gzip.decompress(body)
+    elif compression == 'zstd' and zstandard is not None:
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif compression:
+        raise ValueError(f'Unsupported content encoding {compression}.')
+
+    content_type = headers.get('Content-Type', _FORMATS['json'])
+    if content_type == _FORMATS['json']:
+        return json.loads(body)
+    if content_type == _FORMATS['table']:
+        content = json.loads(body)
+    elif content_type == _FORMATS['msgpack'] and msgpack is not None:
+        content = msgpack.unpackb(body)
+    else:
+        raise ValueError(f'Unsupported content type {content_type}.')
+
+    # Single objects are sent as they are
+    return _untable(content) if set(content) == {'keys', 'rows'} else content
+
 class Request:
     def __init__(self, method: Method, endpoint: Endpoint,
-                 data: dict=None, cb_success=None, cb_error=None):
+                 data: dict=None, cb_success=None, cb_error=None, spooled: tuple=None):
         self.method = method
         self.endpoint = endpoint
         self.data = data
         self.cb_success = cb_success
         self.cb_error = cb_error
+        # Item of the spool the request was taken from, if any
+        self.spooled = spooled
 
 class RequestHandler:
 
@@ -50,11 +155,39 @@ class RequestHandler:
     # Enable/disable SSL certificate verification
     _verify = False
 
+    _scheme = 'https'
     _hostname = None
     _port = None
     __queue = None
     __sender_thread = None
 
+    # Threads sending the requests, each over a session keeping its connection alive
+    _workers = 4
+    __senders = None
+
+    # Requests to these endpoints are sent by the first sender, in the order they were made
+    _ordered = {Endpoint.ID.value, Endpoint.ANTENNA.value}
+
+    # Requests to these endpoints are sent as JSON arrays of up to _batch_size items, at the
+    # latest _batch_age seconds after the first of them was queued
+    _batched = {Endpoint.BTBR.value, Endpoint.BTLE.value, Endpoint.MAC.value}
+    _batch_size = 100
+    _batch_age = 1.0
+
+    # Endpoints that rejected arrays, their requests are sent one by one
+    _unbatched = set()
+
+    # Encodings of the request bodies by preference, an endpoint answering 415 Unsupported
+    # Media Type falls back to the next one
+    _encodings = ['json']
+    # Index into _encodings of the encoding used for each endpoint, the first if missing
+    _negotiated = {}
+
+    # Optional spool.Spool keeping the requests without callbacks on disk until they were
+    # sent, checked for new requests every _spool_poll seconds
+    __spool = None
+    _spool_poll = 0.1
+
     __successtive_fails = 0
 
     __delaying = False
@@ -74,6 +207,8 @@ class RequestHandler:
         RequestHandler._hostname, RequestHandler._port = RequestHandler.__load_settings()
 
         RequestHandler.__queue = Queue(-1)
+        RequestHandler.__senders = [RequestHandler.__start_sender(i)
+                                    for i in range(max(RequestHandler._workers, 1))]
         RequestHandler.__sender_thread = threading.Thread(target=RequestHandler.__send,
                                                           name="NETWORK", daemon=True)
         RequestHandler.__sender_thread.start()
@@ -86,10 +221,36 @@ class RequestHandler:
     @staticmethod
     def make_post_request(endpoint: Endpoint, data: dict, cb_success=None, cb_error=None):
 
+        # Callbacks do not survive a restart, requests with callbacks stay in memory
+        if RequestHandler.__spool is not None and cb_success is None and cb_error is None:
+            RequestHandler.__spool.put(endpoint.value, json.dumps(data))
+            return
+
         request = Request(method=Method.POST, endpoint=endpoint.value, data=json.dumps(data),
                           cb_success=cb_success, cb_error=cb_error)
         RequestHandler.__queue.put_nowait(request)
 
+    @staticmethod
+    def stats() -> dict:
+        ''' Returns the number of requests queued in memory, and the requests in the spool with
+        their size, those being sent and the size of its file. '''
+
+        stats = {'queued': RequestHandler.__queue.qsize(), 'backlog_items': 0,
+                 'backlog_bytes': 0, 'in_flight': 0, 'spool_bytes': 0}
+        if RequestHandler.__spool is not None:
+            stats.update(RequestHandler.__spool.stats())
+
+        return stats
+
+    @staticmethod
+    def shutdown(timeout: float=10):
+        ''' Sends the pending batches and stops the sender threads. '''
+
+        RequestHandler.__queue.put_nowait(None)
+        RequestHandler.__retry_send()
+        RequestHandler.__sender_thread.join(timeout)
+        RequestHandler.__instance = None
+
     @staticmethod
     def __retry_send():
         RequestHandler.__delaying = False
@@ -100,6 +261,23 @@ class RequestHandler:
 
     @staticmethod
     def __send():
+        # Requests waiting to be sent as an array and when the first was queued, by endpoint
+        pending = {}
+        spool = RequestHandler.__spool
+
+        def add(request: Request):
+            if request.method != Method.POST:
+                raise NotImplementedError(f'Unknown method: {request.method}.')
+
+            endpoint = request.endpoint
+            if endpoint in RequestHandler._batched and endpoint not in RequestHandler._unbatched:
+                batch = pending.setdefault(endpoint, (monotonic(), []))[1]
+                batch.append(request)
+                if len(batch) >= RequestHandler._batch_size:
+                    RequestHandler.__dispatch(endpoint, pending.pop(endpoint)[1])
+            else:
+                RequestHandler.__dispatch(endpoint, request)
+
         while True:
 
             log.debug('Grabbing request...')
@@ -107,42 +285,249 @@ class RequestHandler:
                 with RequestHandler._cv:
                     RequestHandler._cv.wait()
 
-            request = RequestHandler.__queue.get()
+            timeout = None if spool is None else RequestHandler._spool_poll
+            if pending:
+                queued = min(queued for queued, _ in pending.values())
+                timeout = min(max(queued + RequestHandler._batch_age - monotonic(), 0),
+                              timeout or float('inf'))
+
+            try:
+                request = RequestHandler.__queue.get(timeout=timeout)
+            except Empty:
+                request = False
+
+            # Shutting down
+            if request is None:
+                for endpoint, (_, batch) in pending.items():
+                    RequestHandler.__dispatch(endpoint, batch)
+
+                for queue, thread in RequestHandler.__senders:
+                    queue.put_nowait(None)
+                for queue, thread in RequestHandler.__senders:
+                    thread.join()
+
+                if spool is not None:
+                    spool.close()
+                    RequestHandler.__spool = None
+                return
+
+            if request:
+                add(request)
+
+            if spool is not None:
+                spool.sync()
+                for item in spool.take():
+                    add(Request(Method.POST, item[1], item[2], spooled=item))
+
+            now = monotonic()
+            for endpoint, (queued, batch) in list(pending.items()):
+                if now - queued >= RequestHandler._batch_age:
+                    del pending[endpoint]
+                    RequestHandler.__dispatch(endpoint, batch)
+
+    @staticmethod
+    def __start_sender(index: int) -> tuple:
+        queue = Queue(-1)
+        thread = threading.Thread(target=RequestHandler.__work, args=[queue],
+                                  name=f'NETWORK.sender{index}', daemon=True)
+        thread.start()
+
+        return queue, thread
+
+    @staticmethod
+    def __dispatch(endpoint: str, job):
+        ''' Hands a request, or a list of requests to send as an array, to a sender. '''
+
+        if endpoint in RequestHandler._ordered:
+            queue = RequestHandler.__senders[0][0]
+        else:
+            queue = min((queue for queue, _ in RequestHandler.__senders), key=Queue.qsize)
 
-            if request.method == Method.POST:
-                headers = {'Accept': 'text/plain', 'Content-Type': 'application/json'}
-                response = requests.post( url=f'https://{RequestHandler._hostname}:\
-{RequestHandler._port}/api/{request.endpoint}',
+        queue.put_nowait((endpoint, job))
+
+    @staticmethod
+    def __work(queue: Queue):
+        ''' Sends the jobs in queue until None is queued. '''
+
+        session = requests.Session()
+        # Content-Type and Content-Encoding are set per request by the encoding
+        session.headers.update({'Accept': 'text/plain'})
+        # One connection per sender, which sends one request at a time
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        with session:
+            while (job := queue.get()) is not None:
+                endpoint, requests_ = job
+
+                # Waiting for the backend to come back, dispatched requests are not tried
+                if RequestHandler.__delaying:
+                    RequestHandler.__requeue(requests_ if isinstance(requests_, list) else
+                                             [requests_])
+                elif isinstance(requests_, list):
+                    RequestHandler.__send_batch(session, endpoint, requests_)
+                else:
+                    RequestHandler.__send_single(session, requests_)
+
+    @staticmethod
+    def __post(session, endpoint: str, payload):
+        ''' Posts payload, a JSON text or a list of them sent as an array, in the encoding
+        negotiated with endpoint. Returns the response, None if the server could not be
+        reached. '''
+
+        encodings = RequestHandler._encodings
+        while True:
+            index = RequestHandler._negotiated.get(endpoint, 0)
+            data, headers = encode(encodings[index], payload)
+            try:
+                response = session.post(url=f'{RequestHandler._scheme}://\
+{RequestHandler._hostname}:{RequestHandler._port}/api/{endpoint}',
+                                        data=data,
                                         headers=headers,
-                                        data=request.data,
-                                        verify=RequestHandler._verify )
-            else:
-                raise NotImplementedError(f'Unknown method: {request.method}.')
+                                        # Session.verify is overridden by REQUESTS_CA_BUNDLE
+                                        verify=RequestHandler._verify)
+            except requests.RequestException as error:
+                log.debug('Request to %s failed: %s', endpoint, error)
+                return None
+
+            if response.status_code != 415 or index + 1 == len(encodings):
+                return response
+
+            log.warning('%s does not accept %s, falling back to %s.', endpoint,
+                        encodings[index], encodings[index + 1])
+            # Other senders may have fallen back further in the meantime
+            with RequestHandler._cv:
+                RequestHandler._negotiated[endpoint] = max(
+                    RequestHandler._negotiated.get(endpoint, 0), index + 1)
+
+    @staticmethod
+    def __send_single(session, request: Request) -> bool:
+        response = RequestHandler.__post(session, request.endpoint, request.data)
+
+        # Sending an invalid or too large request again would only fail again
+        if response is not None and (response.status_code in _INVALID or
+                                     response.status_code == _TOO_LARGE):
+            log.warning('%s rejected a request (%i), dropping it: %s', request.endpoint,
+                        response.status_code, request.data)
+            RequestHandler.__acknowledge([request])
+            if request.cb_error:
+                request.cb_error(response.content)
+            return False
+
+        if response is None or not response.ok:
+            RequestHandler.__failed([request], response)
+            return False
+
+        log.debug('Response (%i)\n%s', response.status_code, response.content)
+        RequestHandler.__successtive_fails = 0
+        RequestHandler.__acknowledge([request])
+        if request.cb_success:
+            request.cb_success(response.content)
+
+        return True
+
+    @staticmethod
+    def __send_batch(session, endpoint: str, batch: list):
+        ''' Sends the requests in batch as one JSON array. '''
+
+        response = RequestHandler.__post(session, endpoint, [request.data for request in batch])
+        status = response.status_code if response is not None else None
+
+        if status == _TOO_LARGE and len(batch) > 1:
+            log.debug('Array of %i requests too large for %s, splitting it.', len(batch),
+                      endpoint)
+            half = len(batch) // 2
+            RequestHandler.__send_batch(session, endpoint, batch[:half])
+            RequestHandler.__send_batch(session, endpoint, batch[half:])
+            return
+
+        if status in _UNSUPPORTED or status in _INVALID or status == _TOO_LARGE:
+            # Sending the requests one by one sets the invalid ones apart. The endpoint is no
+            # longer sent arrays if it may not take them at all and accepts single requests,
+            # or if it found the array invalid but none of its requests.
+            log.debug('Array of %i requests rejected by %s (%i).', len(batch), endpoint, status)
+            sent = [RequestHandler.__send_single(session, request) for request in batch]
+            if (status in _UNSUPPORTED and any(sent)) or (status in _INVALID and all(sent)):
+                log.warning('%s does not accept arrays, sending its requests one by one.',
+                            endpoint)
+                RequestHandler._unbatched.add(endpoint)
+            return
+
+        if response is None or not response.ok:
+            RequestHandler.__failed(batch, response)
+            return
+
+        log.debug('Response (%i) to %i requests\n%s', response.status_code, len(batch),
+                  response.content)
+        RequestHandler.__successtive_fails = 0
+        RequestHandler.__acknowledge(batch)
+        for request, content in zip(batch, RequestHandler.__split(response.content, len(batch))):
+            if request.cb_success:
+                request.cb_success(content)
+
+    @staticmethod
+    def __split(content: bytes, count: int) -> list:
+        ''' Returns the response to each of count requests sent as an array: the elements of
+        a JSON array with one per request, otherwise the whole response for each. '''
 
+        try:
+            items = json.loads(content)
+        except ValueError:
+            items = None
+
+        if isinstance(items, list) and len(items) == count:
+            return [json.dumps(item).encode() for item in items]
+
+        return [content] * count
+
+    @staticmethod
+    def __acknowledge(batch: list):
+        ''' Removes the requests in batch taken from the spool from it. '''
+
+        if spooled := [request.spooled for request in batch if request.spooled is not None]:
+            RequestHandler.__spool.ack(spooled)
+
+    @staticmethod
+    def __requeue(batch: list):
+        ''' Queues requests to be sent again, those taken from the spool in the spool. '''
 
-            if response.ok:
-                log.debug('Response (%i)\n%s', response.status_code, response.content)
-                RequestHandler.__successtive_fails = 0
-                if request.cb_success:
-                    request.cb_success(response.content)
+        spooled = []
+        for request in batch:
+            if request.spooled is not None:
+                spooled.append(request.spooled)
             else:
-                log.debug('Response (%i)', response.status_code)
                 RequestHandler.__queue.put_nowait(request)
 
-                if request.cb_error:
-                    request.cb_error(response.content)
+        if spooled:
+            RequestHandler.__spool.release(spooled)
+
+    @staticmethod
+    def __failed(batch: list, response):
+        ''' Queues the requests in batch again and reports the failure to their callbacks. '''
+
+        log.debug('Response (%s)', response.status_code if response is not None else 'none')
+        content = response.content if response is not None else b''
 
-                RequestHandler.__successtive_fails += 1
+        RequestHandler.__requeue(batch)
+        for request in batch:
+            if request.cb_error:
+                request.cb_error(content)
 
-                # If we've failed to send a message five times in a row, sleep for 10 seconds.
-                if RequestHandler.__successtive_fails >= 5:
-                    log.warning("Failed to send a request %i times in a row. \
+        # Senders fail concurrently
+        with RequestHandler._cv:
+            RequestHandler.__successtive_fails += 1
+
+            # If we've failed to send a message five times in a row, sleep for 10 seconds.
+            if RequestHandler.__successtive_fails >= 5 and not RequestHandler.__delaying:
+                log.warning("Failed to send a request %i times in a row. \
 Waiting for 10 seconds before retry.",
-                                RequestHandler.__successtive_fails)
-                    RequestHandler.__delaying = True
+                            RequestHandler.__successtive_fails)
+                RequestHandler.__delaying = True
 
-                    retry_delay = threading.Timer(10, RequestHandler.__retry_send)
-                    retry_delay.start()
+                retry_delay = threading.Timer(10, RequestHandler.__retry_send)
+                retry_delay.daemon = True
+                retry_delay.start()
 
     @staticmethod
     def __load_settings():
@@ -156,6 +541,23 @@ Waiting for 10 seconds before retry.",
             log.critical("Unable to load network settings from file.")
             raise RuntimeError("Unable to load network settings from file.") from None
 
+        # Optional settings
+        RequestHandler._scheme = settings.get('scheme', RequestHandler._scheme)
+        RequestHandler._batch_size = settings.get('batch_size', RequestHandler._batch_size)
+        RequestHandler._batch_age = settings.get('batch_age', RequestHandler._batch_age)
+        RequestHandler._workers = settings.get('workers', RequestHandler._workers)
+
+        encodings = settings.get('encodings', RequestHandler._encodings)
+        if missing := [name for name in encodings if name not in available_encodings()]:
+            log.warning('Encodings %s are not available, zstd needs zstandard and msgpack '
+                        'needs msgpack installed.', ', '.join(missing))
+        RequestHandler._encodings = [name for name in encodings
+                                     if name in available_encodings()] or ['json']
+        RequestHandler._negotiated = {}
+
+        if path := settings.get('spool'):
+            RequestHandler.__spool = Spool(path, memory_items=settings.get('spool_items', 10000))
+
         log.debug('Remote hostname: %s, remote port: %i.', hostname, port)
 
         return hostname, port
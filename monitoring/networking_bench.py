@@ -0,0 +1,228 @@
+#!/usr/bin/env python3.8
+
+import argparse
+import json
+import os
+import random
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from time import perf_counter, sleep
+import requests
+from networking import RequestHandler, Endpoint, available_encodings, encode
+
+def btle_report(aa: int) -> dict:
+    '''A report as monitor.report_btle_result posts it.'''
+
+    return {'accessAddress': f'{aa:06X}', 'rssi': -67, 'std': 4.123456789, 'mean': -65.98765,
+            'firstSeen': 1700000000, 'lastSeen': 1700000900, 'antennaId': 1}
+
+def btle_adv_report(rng: random.Random) -> dict:
+    '''A report with quantiles and RSSI history as monitor.report_btle_adv_result posts it.'''
+
+    rssi = [rng.randint(-90, -50)]
+    for _ in range(59):
+        rssi.append(None if rng.random() < 0.1 else rng.randint(-3, 3))
+    first_seen = 1700000000 + rng.randint(0, 900)
+
+    return {'macAddress': ':'.join(f'{rng.randrange(256):02X}' for _ in range(6)),
+            'rssi': rssi[0], 'std': rng.uniform(0, 10), 'mean': rng.uniform(-90, -50),
+            'firstSeen': first_seen, 'lastSeen': first_seen + rng.randint(0, 900),
+            'serviceUUID': rng.choice([None, 0xFE9F, 0xFD6F]),
+            'companyId': rng.choice([None, 0x004C, 0x0006]), 'random': rng.randint(0, 1),
+            'antennaId': 1, 'median': rng.randint(-90, -50), 'iqr': rng.randint(0, 12),
+            'rssiHistory': {'start': first_seen, 'interval': 10, 'rssi': rssi}}
+
+def wire_bytes(encodings: list, batch_size: int) -> dict:
+    '''Returns the bytes per fingerprint of batches of batch_size btle and btle-adv reports
+    by endpoint and encoding, headers not counted.'''
+
+    rng = random.Random(1)
+    reports = {Endpoint.BTLE.value: [{**btle_report(rng.randrange(1 << 24)),
+                                      'rssi': rng.randint(-90, -50), 'std': rng.uniform(0, 10),
+                                      'mean': rng.uniform(-90, -50),
+                                      'firstSeen': 1700000000 + rng.randint(0, 900),
+                                      'lastSeen': 1700000900 + rng.randint(0, 900)}
+                                     for _ in range(batch_size)],
+               Endpoint.MAC.value: [btle_adv_report(rng) for _ in range(batch_size)]}
+
+    # Reports are made with the default, not compact, separators of json.dumps
+    return {endpoint: {encoding: len(encode(encoding, [json.dumps(report) for report in batch]
+                                            if batch_size > 1 else json.dumps(batch[0]))[0])
+                       / batch_size for encoding in encodings}
+            for endpoint, batch in reports.items()}
+
+class StandIn:
+    '''Local HTTPS stand-in for the backend behind a constrained uplink.
+
+    Request bodies share one link of uplink bits per second, so concurrent requests do not
+    get more bandwidth, and every request takes rtt seconds on top. Connections are kept
+    alive and arrays are answered with one element per item.'''
+
+    def __init__(self, directory: str, *, rtt: float, uplink: float):
+        cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                       check=True, capture_output=True)
+        link = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if uplink:
+                    with link:
+                        sleep(len(body) * 8 / uplink)
+                sleep(rtt)
+
+                data = json.loads(body)
+                reply = json.dumps([{}] * len(data) if isinstance(data, list) else {}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class LegacySender:
+    '''The sender as it was before the pooled transport: one thread posting each request
+    with requests.post, opening a new connection every time.'''
+
+    def __init__(self, port: int):
+        self.url = f'https://localhost:{port}/api/{Endpoint.BTLE.value}'
+        self.queue = Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def post(self, data: dict, callback):
+        self.queue.put((json.dumps(data), callback))
+
+    def run(self):
+        headers = {'Accept': 'text/plain', 'Content-Type': 'application/json'}
+        while True:
+            data, callback = self.queue.get()
+            requests.post(url=self.url, headers=headers, data=data, verify=False)
+            callback(b'')
+
+class PooledSender:
+    '''RequestHandler configured through a network.conf in directory.'''
+
+    def __init__(self, port: int, directory: str, *, workers: int, batch_size: int,
+                 batch_age: float):
+        with open(os.path.join(directory, 'network.conf'), 'w') as file:
+            json.dump({'hostname': 'localhost', 'port': port, 'workers': workers,
+                       'batch_size': batch_size, 'batch_age': batch_age}, file)
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            RequestHandler()
+        finally:
+            os.chdir(cwd)
+
+    def post(self, data: dict, callback):
+        RequestHandler.make_post_request(Endpoint.BTLE, data, cb_success=callback)
+
+    def close(self):
+        RequestHandler.shutdown()
+
+def measure(sender, count: int, *, rate: float=0) -> tuple:
+    '''Posts count reports, all at once or rate per second. Returns the reports answered per
+    second and the latencies in seconds from posting a report to its answer.'''
+
+    latencies = [None] * count
+    done = threading.Semaphore(0)
+
+    def answered(i: int, posted: float):
+        def callback(content):
+            latencies[i] = perf_counter() - posted
+            done.release()
+        return callback
+
+    start = perf_counter()
+    for i in range(count):
+        if rate and (ahead := start + i / rate - perf_counter()) > 0:
+            sleep(ahead)
+        sender.post(btle_report(i), answered(i, perf_counter()))
+
+    for _ in range(count):
+        done.acquire()
+
+    return count / (perf_counter() - start), latencies
+
+def report(name: str, throughput: float, latencies: list, legacy: float):
+    latencies = sorted(latencies)
+    print(f'{name:>28}: {throughput:9,.0f} req/s  speedup {throughput/legacy:6.1f}x  '
+          f'p50 {statistics.median(latencies)*1e3:8.1f} ms  '
+          f'p99 {latencies[int(len(latencies) * 0.99)]*1e3:8.1f} ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report transport benchmark against a local '
+                                                 'HTTPS stand-in for the backend.')
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='Number of reports posted per configuration.')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 4],
+                        help='Numbers of sender workers to measure.')
+    parser.add_argument('-b', '--batch-size', type=int, nargs='+', default=[1, 100],
+                        help='Batch sizes to measure, 1 sends every report on its own.')
+    parser.add_argument('--batch-age', type=float, default=1.0,
+                        help='Seconds a report waits for its batch to fill up.')
+    parser.add_argument('--rtt', type=float, default=0.05,
+                        help='Round trip time of the uplink in seconds.')
+    parser.add_argument('--uplink', type=float, default=1e6,
+                        help='Bandwidth of the uplink in bit/s, 0 for unlimited.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Reports per second for the latency measurement, 0 to post all at '
+                             'once and measure throughput.')
+    parser.add_argument('-e', '--encodings', nargs='*',
+                        help='Measure the bytes per fingerprint sent in these encodings instead, '
+                             'all available ones if none are given. Uses the batch sizes.')
+
+    args = parser.parse_args()
+
+    if args.encodings is not None:
+        encodings = args.encodings or available_encodings()
+        for batch_size in args.batch_size:
+            print(f'batches of {batch_size}, bytes per fingerprint')
+            for endpoint, sizes in wire_bytes(encodings, batch_size).items():
+                for encoding, size in sizes.items():
+                    print(f'{endpoint:>16} {encoding:>14}: {size:8.1f}  '
+                          f'saved {1 - size / sizes[encodings[0]]:6.1%}')
+        raise SystemExit
+
+    with tempfile.TemporaryDirectory() as directory:
+        stand_in = StandIn(directory, rtt=args.rtt, uplink=args.uplink)
+        print(f'rtt {args.rtt*1e3:.0f} ms  uplink {args.uplink/1e3:,.0f} kbit/s  '
+              f'{args.requests:,} reports  '
+              f'{"at " + format(args.rate, ",.0f") + " req/s" if args.rate else "at once"}')
+
+        legacy, latencies = measure(LegacySender(stand_in.port), args.requests, rate=args.rate)
+        report('requests.post, 1 thread', legacy, latencies, legacy)
+
+        for workers in args.workers:
+            for batch_size in args.batch_size:
+                sender = PooledSender(stand_in.port, directory, workers=workers,
+                                      batch_size=batch_size, batch_age=args.batch_age)
+                throughput, latencies = measure(sender, args.requests, rate=args.rate)
+                sender.close()
+                report(f'{workers} workers, batches of {batch_size}', throughput, latencies,
+                       legacy)
+
+        stand_in.close()
@@ -0,0 +1,339 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+import pytest
+from networking import RequestHandler, Endpoint, available_encodings, encode, decode
+
+class StandIn:
+    '''Local stand-in for the backend. Records the payloads posted to each endpoint and
+    answers arrays with one element per item after delay seconds. Endpoints in rejects
+    refuse arrays with reject_status, arrays of more than max_items are answered with 413,
+    items with an invalid key with 400 and items with a large key with 413. Bodies are
+    decoded with decode, encodings other than accepts, pairs of Content-Type and
+    Content-Encoding, are answered with 415. Connections are kept alive.'''
+
+    def __init__(self, rejects=(), delay: float=0, accepts=None, max_items: int=0,
+                 reject_status: int=405):
+        self.posts = []
+        self.encodings = []
+        self.connections = set()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                endpoint = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                encoding = self.headers['Content-Type'], self.headers['Content-Encoding']
+                stand_in.encodings.append((endpoint, encoding, len(body)))
+                if accepts is not None and encoding not in accepts:
+                    self.send_error(415)
+                    return
+
+                data = decode(body, self.headers)
+                stand_in.posts.append((endpoint, data))
+                stand_in.connections.add(self.client_address)
+                sleep(delay)
+
+                if isinstance(data, list):
+                    if endpoint in rejects:
+                        self.send_error(reject_status)
+                        return
+                    if max_items and len(data) > max_items or \
+                            any('large' in item for item in data):
+                        self.send_error(413)
+                        return
+                    if any('invalid' in item for item in data):
+                        self.send_error(400)
+                        return
+                    body = json.dumps([{'id': item['id']} for item in data]).encode()
+                elif 'invalid' in data:
+                    self.send_error(400)
+                    return
+                elif 'large' in data:
+                    self.send_error(413)
+                    return
+                else:
+                    body = json.dumps({'id': data['id']}).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def sizes(self, endpoint: str) -> list:
+        return [len(data) if isinstance(data, list) else None
+                for name, data in self.posts if name == endpoint]
+
+def wait_for(condition, timeout: float=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        sleep(0.01)
+    return condition()
+
+def configure(directory, port: int, **settings):
+    (directory / 'network.conf').write_text(json.dumps({
+        'scheme': 'http', 'hostname': '127.0.0.1', 'port': port, 'batch_size': 5,
+        'batch_age': 0.2, 'workers': 4, **settings}))
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch, request):
+    params = dict(getattr(request, 'param', {}))
+    settings = params.pop('settings', {})
+    stand_in = StandIn(**params)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(RequestHandler, '_unbatched', set())
+    monkeypatch.setattr(RequestHandler, '_encodings', ['json'])
+    configure(tmp_path, stand_in.server.server_address[1], **settings)
+
+    RequestHandler()
+    yield stand_in
+
+    RequestHandler.shutdown()
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+class TestBatching:
+    def test_flushed_by_size_and_age(self, handler):
+        responses = {}
+        for i in range(12):
+            RequestHandler.make_post_request(
+                Endpoint.BTLE, {'id': i},
+                cb_success=lambda content, i=i: responses.__setitem__(i, json.loads(content)))
+
+        assert wait_for(lambda: len(responses) == 12), 'Not all requests answered'
+        assert handler.sizes('Btle') == [5, 5, 2], 'Expected two full arrays and one by age'
+        assert all(responses[i] == {'id': i} for i in range(12)), \
+            'Items did not get their own response'
+
+    def test_unbatched_endpoints(self, handler):
+        answered = threading.Event()
+        RequestHandler.make_post_request(Endpoint.ID, {'id': 1},
+                                         cb_success=lambda content: answered.set())
+
+        assert answered.wait(0.15), 'Request to an unbatched endpoint waited for a batch'
+        assert handler.sizes('Antenna') == [None], 'Request should not be sent as an array'
+
+    @pytest.mark.parametrize('handler', [{'rejects': {'Btbr'}},
+                                         {'rejects': {'Btbr'}, 'reject_status': 400}],
+                             indirect=True)
+    def test_falls_back_to_single_requests(self, handler):
+        answered = []
+        for i in range(3):
+            RequestHandler.make_post_request(Endpoint.BTBR, {'id': i},
+                                             cb_success=answered.append, cb_error=answered.append)
+
+        assert wait_for(lambda: len(answered) == 3), 'Not all requests answered'
+        RequestHandler.make_post_request(Endpoint.BTBR, {'id': 3}, cb_success=answered.append)
+        assert wait_for(lambda: len(answered) == 4), 'Request after the fallback not answered'
+
+        assert handler.sizes('Btbr') == [3, None, None, None, None], \
+            'Expected one rejected array, then single requests only'
+        assert [json.loads(content) for content in answered] == [{'id': i} for i in range(4)], \
+            'Wrong responses after the fallback'
+
+    def test_invalid_item_keeps_batching(self, handler):
+        answered, failed = [], []
+        for i in range(5):
+            data = {'id': i, 'invalid': True} if i == 2 else {'id': i}
+            RequestHandler.make_post_request(Endpoint.BTLE, data, cb_success=answered.append,
+                                             cb_error=failed.append)
+        assert wait_for(lambda: len(answered) + len(failed) == 5), 'Not all requests answered'
+
+        for i in range(5, 10):
+            RequestHandler.make_post_request(Endpoint.BTLE, {'id': i}, cb_success=answered.append)
+        assert wait_for(lambda: len(answered) == 9), 'Valid requests not answered'
+
+        assert len(failed) == 1, 'Invalid request should fail once and be dropped'
+        assert handler.sizes('Btle') == [5, None, None, None, None, None, 5], \
+            'Expected the array split once, then arrays again'
+
+    @pytest.mark.parametrize('handler', [{'max_items': 2}], indirect=True)
+    def test_large_arrays_are_split(self, handler):
+        answered = []
+        for i in range(5):
+            RequestHandler.make_post_request(Endpoint.BTLE, {'id': i}, cb_success=answered.append)
+
+        assert wait_for(lambda: len(answered) == 5), 'Not all requests answered'
+        assert handler.sizes('Btle') == [5, 2, 3, 1, 2], 'Arrays not split in halves'
+        assert [json.loads(content) for content in answered] == [{'id': i} for i in range(5)], \
+            'Wrong responses after splitting'
+        assert 'Btle' not in RequestHandler._unbatched, 'Endpoint should stay batched'
+
+    def test_too_large_request_is_dropped(self, handler):
+        answered, failed = [], []
+        for i in range(5):
+            data = {'id': i, 'large': True} if i == 2 else {'id': i}
+            RequestHandler.make_post_request(Endpoint.BTLE, data, cb_success=answered.append,
+                                             cb_error=failed.append)
+
+        assert wait_for(lambda: len(answered) + len(failed) == 5), 'Not all requests answered'
+        sleep(0.3)
+        assert len(failed) == 1, 'Too large request should fail once and be dropped'
+        assert handler.sizes('Btle') == [5, 2, 3, 1, None, 2], \
+            'Expected the arrays split down to the too large request'
+        assert 'Btle' not in RequestHandler._unbatched, 'Endpoint should stay batched'
+
+    def test_shutdown_sends_pending(self, handler, monkeypatch):
+        monkeypatch.setattr(RequestHandler, '_batch_age', 60)
+        for i in range(3):
+            RequestHandler.make_post_request(Endpoint.MAC, {'id': i})
+
+        RequestHandler.shutdown()
+
+        assert handler.sizes('MacAddr') == [3], 'Pending batch not sent on shutdown'
+
+
+class TestSenders:
+    @pytest.mark.parametrize('handler', [{'delay': 0.3}], indirect=True)
+    def test_batches_sent_concurrently(self, handler):
+        answered = []
+        start = perf_counter()
+        for i in range(20):
+            RequestHandler.make_post_request(Endpoint.BTLE, {'id': i}, cb_success=answered.append)
+
+        assert wait_for(lambda: len(answered) == 20), 'Not all requests answered'
+        # One after the other, the four arrays would take 1.2 s
+        assert perf_counter() - start < 0.9, 'Arrays not sent concurrently'
+
+    def test_connections_are_reused(self, handler):
+        answered = []
+        for i in range(50):
+            RequestHandler.make_post_request(Endpoint.ID, {'id': i}, cb_success=answered.append)
+            RequestHandler.make_post_request(Endpoint.MAC, {'id': i}, cb_success=answered.append)
+
+        assert wait_for(lambda: len(answered) == 100), 'Not all requests answered'
+        assert len(handler.connections) <= 4, 'Expected at most one connection per sender'
+
+    def test_ordered_endpoints_keep_order(self, handler):
+        answered = []
+        for i in range(30):
+            endpoint = Endpoint.ID if i % 2 else Endpoint.ANTENNA
+            RequestHandler.make_post_request(endpoint, {'id': i}, cb_success=answered.append)
+
+        assert wait_for(lambda: len(answered) == 30), 'Not all requests answered'
+        assert [data['id'] for name, data in handler.posts] == list(range(30)), \
+            'Requests to ordered endpoints reordered'
+
+
+class TestSpool:
+    def test_backlog_survives_outage_and_restart(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(RequestHandler, '_unbatched', set())
+        spool = str(tmp_path / 'spool.db')
+
+        # Nothing listens on the port of a closed server
+        stand_in = StandIn()
+        stand_in.server.shutdown()
+        stand_in.server.server_close()
+        configure(tmp_path, stand_in.server.server_address[1], spool=spool)
+
+        RequestHandler()
+        try:
+            for i in range(20):
+                RequestHandler.make_post_request(Endpoint.BTLE, {'id': i})
+            sleep(0.5)
+            stats = RequestHandler.stats()
+        finally:
+            RequestHandler.shutdown()
+
+        assert stats['backlog_items'] == 20, 'Requests lost during the outage'
+        assert stats['backlog_bytes'] == sum(len(json.dumps({'id': i})) for i in range(20)), \
+            'Backlog size wrong'
+
+        stand_in = StandIn()
+        configure(tmp_path, stand_in.server.server_address[1], spool=spool)
+        RequestHandler()
+        try:
+            assert wait_for(lambda: RequestHandler.stats()['backlog_items'] == 0), \
+                'Backlog not drained'
+        finally:
+            RequestHandler.shutdown()
+            stand_in.server.shutdown()
+            stand_in.server.server_close()
+
+        assert sorted(item['id'] for _, data in stand_in.posts for item in data) == \
+            list(range(20)), 'Backlog not replayed after the restart'
+        assert set(stand_in.sizes('Btle')) == {5}, 'Backlog not sent in full arrays'
+
+    def test_requests_with_callbacks_stay_in_memory(self, handler, tmp_path):
+        RequestHandler.shutdown()
+        configure(tmp_path, handler.server.server_address[1], spool=str(tmp_path / 'spool.db'))
+        RequestHandler()
+
+        answered = threading.Event()
+        RequestHandler.make_post_request(Endpoint.ID, {'id': 1},
+                                         cb_success=lambda content: answered.set())
+        RequestHandler.make_post_request(Endpoint.MAC, {'id': 2})
+
+        assert answered.wait(5), 'Request with a callback not answered'
+        assert wait_for(lambda: handler.sizes('MacAddr') == [1]), 'Spooled request not sent'
+
+
+class TestEncodings:
+    REPORTS = [{'id': i, 'accessAddress': f'{i:06X}', 'rssi': -60 - i, 'antennaId': 1}
+               for i in range(10)] + [{'id': 10, 'accessAddress': '00000A'}]
+
+    @pytest.mark.parametrize('encoding', available_encodings())
+    def test_round_trip(self, encoding):
+        payload = [json.dumps(report) for report in self.REPORTS]
+
+        body, headers = encode(encoding, payload)
+        assert decode(body, headers) == self.REPORTS, f'Array changed by {encoding}'
+        body, headers = encode(encoding, payload[0])
+        assert decode(body, headers) == self.REPORTS[0], f'Object changed by {encoding}'
+
+    def test_compact_encodings_are_smaller(self):
+        payload = [json.dumps(report) for report in self.REPORTS]
+        sizes = {encoding: len(encode(encoding, payload)[0])
+                 for encoding in ['json', 'table', 'table+gzip']}
+
+        assert sizes['json'] > sizes['table'] > sizes['table+gzip'], \
+            f'Compact encodings not smaller: {sizes}'
+
+    @pytest.mark.parametrize('handler', [{
+        'accepts': {('application/json', None)},
+        'settings': {'encodings': ['table+gzip', 'json']}}], indirect=True)
+    def test_falls_back_on_unsupported_media_type(self, handler):
+        answered = []
+        for i in range(5):
+            RequestHandler.make_post_request(Endpoint.BTLE, {'id': i}, cb_success=answered.append)
+        assert wait_for(lambda: len(answered) == 5), 'Requests not answered after the fallback'
+
+        for i in range(5, 10):
+            RequestHandler.make_post_request(Endpoint.BTLE, {'id': i}, cb_success=answered.append)
+        assert wait_for(lambda: len(answered) == 10), 'Requests not answered'
+
+        assert [encoding for _, encoding, _ in handler.encodings] == [
+            ('application/x-table+json', 'gzip'), ('application/json', None),
+            ('application/json', None)], 'Expected one rejected table, then plain JSON only'
+        assert handler.sizes('Btle') == [5, 5], 'Requests not sent as arrays after the fallback'
+
+    @pytest.mark.parametrize('handler', [{'settings': {'encodings': ['table+gzip']}}],
+                             indirect=True)
+    def test_compressed_table_accepted(self, handler):
+        for i in range(5):
+            RequestHandler.make_post_request(Endpoint.MAC, {'id': i, 'address': f'AA:BB:{i:02X}'})
+
+        assert wait_for(lambda: handler.sizes('MacAddr') == [5]), 'Array not sent'
+        assert handler.posts == [('MacAddr', [{'id': i, 'address': f'AA:BB:{i:02X}'}
+                                              for i in range(5)])], 'Array changed on the way'
+        assert handler.encodings[0][1] == ('application/x-table+json', 'gzip'), \
+            'Array not sent as a compressed table'
+
+    @pytest.mark.skipif('msgpack+zstd' in available_encodings(),
+                        reason='zstandard and msgpack are installed')
+    @pytest.mark.parametrize('handler', [{'settings': {'encodings': ['msgpack+zstd', 'table']}}],
+                             indirect=True)
+    def test_unavailable_encodings_are_skipped(self, handler):
+        assert RequestHandler._encodings == ['table'], 'Unavailable encoding not skipped'
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3.8
+
+import os
+import mmap
+import select
+import struct
+import errno
+import argparse
+from contextlib import suppress
+from time import sleep
+
+__all__ = ['RingBuffer']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+class RingBuffer:
+    '''Single-producer single-consumer ring buffer of fixed size records in a memory-mapped file.
+
+    The producer owns head and the drop counter, the consumer owns tail. Both are byte
+    counters that only grow, the buffer holds head - tail bytes. The capacity is a multiple
+    of the record size, so records never wrap around the end of the buffer and can be
+    handed to the consumer as a memoryview without copying.
+
+    When the buffer is full the producer drops records instead of blocking. A consumer
+    waiting for data sets a flag and blocks on a named FIFO, the doorbell, which the
+    producer writes a byte to when it sees the flag. A missed wake-up is bounded by the
+    timeout passed to consume.
+
+    Positional arguments:\n
+    path -- the file backing the buffer\n
+
+    Keyword arguments:\n
+    record_size -- length of a record in bytes, only needed when creating\n
+    capacity -- size of the buffer in bytes, rounded down to whole records\n
+    doorbell -- path of the FIFO used for wake-ups, defaults to path with .bell appended\n
+    create -- whether to create the buffer (consumer) or attach to it (producer)'''
+
+    _magic = 0x52494e47
+
+    # Producer and consumer fields live on separate cache lines
+    _layout = struct.Struct('=IIQ')
+    _producer_offset = 64
+    _consumer_offset = 128
+    _data_offset = 192
+
+    _counter = struct.Struct('=Q')
+
+    def __init__(self, path: str, *, record_size: int=0, capacity: int=16 << 20,
+                 doorbell: str=None, create: bool=False):
+        self.path = path
+        self.doorbell = doorbell if doorbell else f'{path}.bell'
+        self._bell = None
+
+        if create:
+            capacity -= capacity % record_size
+            with suppress(OSError):
+                os.remove(path)
+
+            with open(path, 'wb') as file:
+                file.truncate(self._data_offset + capacity)
+
+            with suppress(OSError):
+                os.remove(self.doorbell)
+            os.mkfifo(self.doorbell)
+
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+        if create:
+            self._layout.pack_into(self._map, 0, self._magic, record_size, capacity)
+
+        magic, self.record_size, self.capacity = self._layout.unpack_from(self._map, 0)
+        if magic != self._magic:
+            raise ValueError(f'{path} is not a ring buffer.')
+
+        self._view = memoryview(self._map)
+
+    def _get(self, offset: int) -> int:
+        return self._counter.unpack_from(self._map, offset)[0]
+
+    def _set(self, offset: int, value: int):
+        self._counter.pack_into(self._map, offset, value)
+
+    head = property(lambda self: self._get(self._producer_offset))
+    dropped = property(lambda self: self._get(self._producer_offset + 8))
+    tail = property(lambda self: self._get(self._consumer_offset))
+    backlog = property(lambda self: self.head - self.tail)
+
+    def write(self, data: bytes) -> int:
+        '''Appends whole records from data, dropping those that do not fit.
+        Returns the number of records written.'''
+
+        view = memoryview(data)
+        length = len(view) - len(view) % self.record_size
+        head = self.head
+        free = self.capacity - (head - self.tail)
+        count = min(length, free)
+
+        written = 0
+        while written < count:
+            start = (head + written) % self.capacity
+            chunk = min(count - written, self.capacity - start)
+            self._view[self._data_offset+start:self._data_offset+start+chunk] = \
+                view[written:written+chunk]
+            written += chunk
+
+        self._set(self._producer_offset, head + count)
+
+        if count < length:
+            self._set(self._producer_offset + 8,
+                      self.dropped + (length - count) // self.record_size)
+
+        if self._get(self._consumer_offset + 8):
+            self._ring()
+
+        return count // self.record_size
+
+    def _ring(self):
+        if self._bell is None:
+            try:
+                self._bell = os.open(self.doorbell, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as error:
+                # No consumer has the doorbell open
+                if error.errno == errno.ENXIO:
+                    return
+                raise
+
+        with suppress(BlockingIOError):
+            os.write(self._bell, b'\0')
+
+    def consume(self, callback, *, timeout: float=None) -> int:
+        '''Passes all buffered records to callback as memoryviews, waiting up to timeout
+        seconds for records if the buffer is empty. Returns the number of bytes consumed.
+
+        The views are only valid during the callback.'''
+
+        tail = self.tail
+        if self.head == tail:
+            self._wait(timeout)
+
+        head = self.head
+        consumed = 0
+        while tail + consumed < head:
+            start = (tail + consumed) % self.capacity
+            chunk = min(head - tail - consumed, self.capacity - start)
+
+            view = self._view[self._data_offset+start:self._data_offset+start+chunk]
+            try:
+                callback(view)
+            finally:
+                view.release()
+
+            consumed += chunk
+            self._set(self._consumer_offset, tail + consumed)
+
+        return consumed
+
+    def _wait(self, timeout: float):
+        if self._bell is None:
+            self._bell = os.open(self.doorbell, os.O_RDWR | os.O_NONBLOCK)
+
+        self._set(self._consumer_offset + 8, 1)
+        try:
+            if self.head == self.tail:
+                select.select([self._bell], [], [], timeout)
+
+            with suppress(BlockingIOError):
+                os.read(self._bell, 4096)
+        finally:
+            self._set(self._consumer_offset + 8, 0)
+
+    def close(self):
+        if self._bell is not None:
+            os.close(self._bell)
+            self._bell = None
+
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+if __name__ == '__main__':
+    # Stand-in producer: copies raw records, e.g. those ubertooth-btle -m writes to its FIFO,
+    # from a file or stdin into a ring buffer created by a processor.
+    parser = argparse.ArgumentParser(description='Write records into a ring buffer.')
+    parser.add_argument('ring', type=str, help='Ring buffer created by the consumer.')
+    parser.add_argument('input', type=str, nargs='?', default='/dev/stdin',
+                        help='File containing the raw records.')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='Records per second to write, unthrottled if 0.')
+
+    args = parser.parse_args()
+
+    ring = RingBuffer(args.ring)
+    batch = ring.record_size * (max(1, int(args.rate // 100)) if args.rate else 1024)
+
+    with open(args.input, 'rb') as source:
+        while data := source.read(batch):
+            ring.write(data)
+            if args.rate:
+                sleep(len(data) / ring.record_size / args.rate)
+
+    print(f'{ring.dropped} records dropped.')
+    ring.close()
@@ -0,0 +1,108 @@
+import os
+import struct
+import subprocess
+import sys
+import threading
+from time import time
+import pytest
+import sniffer
+from ringbuffer import RingBuffer
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+@pytest.fixture
+def ring_path(tmp_path):
+    return str(tmp_path / 'ring')
+
+
+class TestRingBuffer:
+    def test_records_wrap_around(self, ring_path):
+        consumer = RingBuffer(ring_path, record_size=4, capacity=40, create=True)
+        producer = RingBuffer(ring_path)
+        received = []
+
+        # Ten rounds of seven records through a ten record buffer wrap several times
+        for round in range(10):
+            data = b''.join(struct.pack('I', round * 7 + i) for i in range(7))
+            assert producer.write(data) == 7, 'Records dropped while buffer had space'
+            consumer.consume(lambda view: received.extend(struct.iter_unpack('I', view)),
+                             timeout=0)
+
+        assert [value for value, in received] == list(range(70)), 'Records lost or reordered'
+        assert consumer.backlog == 0, 'Consumer did not catch up'
+
+        producer.close()
+        consumer.close()
+
+    def test_full_buffer_drops_records(self, ring_path):
+        consumer = RingBuffer(ring_path, record_size=4, capacity=40, create=True)
+        producer = RingBuffer(ring_path)
+
+        assert producer.write(bytes(4 * 15)) == 10, 'Only the free space should be written'
+        assert producer.dropped == 5, 'Dropped records not counted'
+        assert producer.write(bytes(4)) == 0, 'Full buffer accepted a record'
+        assert consumer.dropped == 6, 'Drop counter not shared'
+
+        assert consumer.consume(lambda view: None, timeout=0) == 40, 'Buffer not drained'
+        assert producer.write(bytes(4)) == 1, 'Space not released by the consumer'
+
+        producer.close()
+        consumer.close()
+
+    def test_doorbell_wakes_consumer(self, ring_path):
+        consumer = RingBuffer(ring_path, record_size=4, capacity=40, create=True)
+        producer = RingBuffer(ring_path)
+        consumed = []
+
+        thread = threading.Thread(
+            target=lambda: consumed.append(consumer.consume(lambda view: None, timeout=10)))
+        thread.start()
+
+        # Write once the consumer is waiting, so only the doorbell can wake it
+        while not consumer._get(consumer._consumer_offset + 8):
+            pass
+
+        start = time()
+        producer.write(bytes(8))
+        thread.join()
+
+        assert consumed == [8], 'Records not consumed after wake-up'
+        assert time() - start < 5, 'Consumer not woken by the doorbell'
+
+        producer.close()
+        consumer.close()
+
+
+class TestRingTransport:
+    @pytest.mark.parametrize('processor_cls', [sniffer.BtbrProcessor, sniffer.BtleProcessor,
+                                               sniffer.BtleAdvProcessor])
+    def test_ring_size(self, tmp_path, processor_cls):
+        processor = processor_cls(pipe_path=str(tmp_path / 'pipe'), transport='ring',
+                                  ring_size=1 << 16)
+        try:
+            assert processor._ring.capacity == (1 << 16) - (1 << 16) % processor._packet_length, \
+                'Ring size not passed on'
+        finally:
+            processor._ring.close()
+
+    def test_processor_reads_from_producer(self, tmp_path):
+        processor = sniffer.BtleProcessor(pipe_path=str(tmp_path / 'pipe'), transport='ring')
+        records = 20000
+        source = tmp_path / 'records'
+        source.write_bytes(b''.join(btle_record(i % 100, 1000, -50) for i in range(records)))
+
+        processor.start()
+        producer = os.path.join(os.path.dirname(sniffer.__file__), 'ringbuffer.py')
+        output = subprocess.run([sys.executable, producer, processor._ring.path, str(source)],
+                                check=True, capture_output=True, text=True).stdout
+
+        while processor._ring.backlog:
+            processor._processing_thread.join(timeout=0.01)
+
+        processor.stop()
+        processor._ring.close()
+
+        assert output.startswith('0 records dropped'), 'Producer dropped records'
+        assert sum(fp.times_seen for fp in processor._fingerprints.values()) == records, \
+            'Records lost in the ring buffer'
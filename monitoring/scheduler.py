@@ -0,0 +1,148 @@
+#!/usr/bin/env python3.8
+
+import threading
+from time import monotonic
+import logging as log
+
+__all__ = ['Scheduler']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+class Scheduler:
+    '''Shares the available dongles between sniffers by giving each dongle to one sniffer at
+    a time, so a site with fewer dongles than modes still covers all of them.
+
+    With at least as many dongles as sniffers, every sniffer keeps a dongle of its own.
+    Otherwise each dongle runs time slices. When a slice ends, the dongle goes to the sniffer
+    picked by smooth weighted round robin among those not running on another dongle, so
+    over time every sniffer gets slices in proportion to its weight, spread out evenly. A
+    slice lasts the dwell time of its sniffer. Sniffers with weight 0 are never scheduled.
+
+    Between slices the sniffers are paused, their subprocess is terminated while their
+    processor and fingerprint tables stay alive and do not age. A slice has to last at
+    least the seen_for of its processor. Each sniffer reports its duty cycle in its stats.
+    Sniffers have to run on threads, not on an AsyncRuntime.
+
+    Positional arguments:\n
+    sniffers -- the sniffers to schedule, not started yet\n
+
+    Keyword arguments:\n
+    dongles -- number of dongles, used with ut_id 0 to dongles - 1\n
+    dwell -- seconds of a slice, or a dict of them by mode, modes missing from it use
+    DEFAULT_DWELL\n
+    weights -- dict of the relative share of slices by mode, 1 by default'''
+
+    # At least the default seen_for of the processors
+    DEFAULT_DWELL = 60
+
+    def __init__(self, sniffers: list, *, dongles: int, dwell=DEFAULT_DWELL, weights: dict=None):
+        if dongles < 1:
+            raise ValueError('At least one dongle is required.')
+
+        self.sniffers = list(sniffers)
+        self.dongles = dongles
+        self._dwell = dwell if isinstance(dwell, dict) else \
+            {sniffer._processor.name: dwell for sniffer in self.sniffers}
+        self._weights = weights or {}
+
+        if self.multiplexed:
+            for sniffer in self.sniffers:
+                seen_for = sniffer._processor.settings().get('seen_for', 0)
+                if self._weight(sniffer) > 0 and self._dwell_time(sniffer) < seen_for:
+                    raise ValueError(f'Dwell of {sniffer._processor.name} '
+                                     f'({self._dwell_time(sniffer)} s) is shorter than its '
+                                     f'seen_for ({seen_for} s).')
+        # Current weights of the smooth weighted round robin
+        self._credit = {sniffer: 0 for sniffer in self.sniffers}
+        # Sniffer and end of the current slice on each dongle
+        self._slices = [(None, 0.0)] * dongles
+        self.slices = {sniffer: 0 for sniffer in self.sniffers}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _weight(self, sniffer) -> float:
+        return self._weights.get(sniffer._processor.name, 1)
+
+    def _dwell_time(self, sniffer) -> float:
+        return self._dwell.get(sniffer._processor.name, self.DEFAULT_DWELL)
+
+    @property
+    def multiplexed(self) -> bool:
+        return self.dongles < len(self.sniffers)
+
+    def start(self):
+        for sniffer in self.sniffers:
+            sniffer.start(paused=True)
+
+        if not self.multiplexed:
+            for ut_id, sniffer in enumerate(self.sniffers):
+                sniffer.resume(ut_id)
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        for sniffer in self.sniffers:
+            sniffer.stop()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            now = monotonic()
+            for ut_id, (_, end) in enumerate(self._slices):
+                if end <= now:
+                    self._switch(ut_id, now)
+
+            self._stopping.wait(max(min(end for _, end in self._slices) - monotonic(), 0))
+
+    def _switch(self, ut_id: int, now: float):
+        '''Ends the slice on dongle ut_id and starts the next one.'''
+
+        current = self._slices[ut_id][0]
+        busy = {sniffer for i, (sniffer, _) in enumerate(self._slices) if i != ut_id}
+        candidates = [sniffer for sniffer in self.sniffers
+                      if sniffer not in busy and self._weight(sniffer) > 0]
+
+        if not candidates:
+            if current is not None:
+                current.pause()
+            self._slices[ut_id] = None, now + min(self._dwell.values(), default=self.DEFAULT_DWELL)
+            return
+
+        chosen = self._pick(candidates)
+        if chosen is not current:
+            if current is not None:
+                current.pause()
+
+            log.debug('Dongle %i switches to %s.', ut_id, chosen._processor.name)
+            chosen.resume(ut_id)
+
+        self.slices[chosen] += 1
+        self._slices[ut_id] = chosen, now + self._dwell_time(chosen)
+
+    def _pick(self, candidates: list):
+        '''Smooth weighted round robin: every candidate gains its weight, the one with the most
+        credit is picked and pays the weights of all candidates.'''
+
+        total = 0
+        for sniffer in candidates:
+            weight = self._weight(sniffer)
+            self._credit[sniffer] += weight
+            total += weight
+
+        chosen = max(candidates, key=self._credit.__getitem__)
+        self._credit[chosen] -= total
+
+        return chosen
+
+    def assignments(self) -> dict:
+        '''Returns the mode running on each dongle, None for idle ones.'''
+        return {ut_id: sniffer._processor.name if sniffer is not None else None
+                for ut_id, (sniffer, _) in enumerate(self._slices)}
@@ -0,0 +1,89 @@
+import sys
+from collections import Counter
+from time import sleep
+import pytest
+import sniffer
+from scheduler import Scheduler
+
+
+class FakeSniffer:
+    def __init__(self, name: str, seen_for: int=0):
+        self._processor = type('Processor', (), {
+            'name': name, 'settings': lambda self: {'seen_for': seen_for}})()
+        self.ut_id = None
+
+    def pause(self):
+        self.ut_id = None
+
+    def resume(self, ut_id: int=None):
+        assert self.ut_id is None, 'Resumed while running'
+        self.ut_id = ut_id
+
+
+class TestScheduler:
+    def test_slices_follow_weights(self):
+        sniffers = [FakeSniffer(name) for name in ['btbr', 'btle', 'btle-adv']]
+        scheduler = Scheduler(sniffers, dongles=1, weights={'btle': 2})
+
+        order = []
+        for now in range(40):
+            scheduler._switch(0, now)
+            order.append(scheduler.assignments()[0])
+
+        assert Counter(order) == {'btle': 20, 'btbr': 10, 'btle-adv': 10}, 'Shares differ from weights'
+        assert all(order[i:i+4].count('btle') == 2 for i in range(0, 40, 4)), \
+            'Slices should be spread out evenly'
+        assert sum(s.ut_id == 0 for s in sniffers) == 1, 'Exactly one sniffer should run'
+
+    def test_sniffer_never_on_two_dongles(self):
+        sniffers = [FakeSniffer(name) for name in ['btbr', 'btle', 'btle-adv']]
+        scheduler = Scheduler(sniffers, dongles=2, weights={'btbr': 0})
+
+        for now in range(20):
+            scheduler._switch(now % 2, now)
+            running = [s._processor.name for s in sniffers if s.ut_id is not None]
+            assert 'btbr' not in running, 'Weight 0 should never be scheduled'
+            assert len(running) == len(set(running)), 'Sniffer assigned twice'
+
+        assert sorted(scheduler.assignments().values()) == ['btle', 'btle-adv'], \
+            'Both dongles should be busy'
+
+    def test_dwell_shorter_than_seen_for(self):
+        sniffers = [FakeSniffer('btbr', seen_for=60), FakeSniffer('btle')]
+        with pytest.raises(ValueError):
+            Scheduler(sniffers, dongles=1, dwell=30)
+
+        Scheduler(sniffers, dongles=1, dwell={'btbr': 60, 'btle': 10})
+        Scheduler(sniffers, dongles=1, dwell=30, weights={'btbr': 0})
+        Scheduler(sniffers, dongles=2, dwell=30)
+
+    def test_one_dongle_covers_all_modes(self, tmp_path):
+        # Stand-in for the ubertooth tools, writes a record carrying the dongle id until killed
+        script = tmp_path / 'writer.py'
+        script.write_text('import struct, sys, time\n'
+                          'with open(sys.argv[1], "wb", buffering=0) as pipe:\n'
+                          '    while True:\n'
+                          '        pipe.write(struct.pack("IIi", 100 + int(sys.argv[2]), int(time.time()), -50))\n'
+                          '        time.sleep(0.02)\n')
+
+        sniffers = []
+        for name in ['a', 'b']:
+            processor = sniffer.BtleProcessor(pipe_path=str(tmp_path / name), seen_threshold=1)
+            processor.name = name
+            processor._cmd_fmt = f'{sys.executable} {script} {{pipe}} {{ut_id}}'
+            sniffers.append(sniffer.Sniffer(processor=processor))
+
+        scheduler = Scheduler(sniffers, dongles=1, dwell=0.5)
+        scheduler.start()
+        try:
+            sleep(4)
+            stats = [s.stats() for s in sniffers]
+        finally:
+            scheduler.stop()
+
+        for s, values in zip(sniffers, stats):
+            assert set(s._processor._tracked()) == {100}, 'Wrong dongle or table lost'
+            assert scheduler.slices[s] >= 2, 'Sniffers should take turns'
+            assert 0.2 < values['duty_cycle'] < 0.8, 'Wrong duty cycle'
+
+        assert sum(values['duty_cycle'] for values in stats) <= 1.01, 'One dongle only'
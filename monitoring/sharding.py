@@ -0,0 +1,394 @@
+#!/usr/bin/env python3.8
+
+import copy
+import pickle
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import logging as log
+from sniffer import Processor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['ShardedProcessor']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+# Messages from the parent to a worker, sent as a one byte tag followed by the payload
+_FEED = b'F'
+_RESULT = b'R'
+_STOP = b'S'
+_CONFIGURE = b'C'
+_SETTINGS = b'Q'
+_SUSPEND = b'P'
+_RESUME = b'U'
+
+# Fields of Processor.stats() that only the workers know, sent along with each result
+_WORKER_STATS = ['table_size', 'expirations', 'evictions', 'filtered', 'history_bytes']
+
+# Options each worker gets its share of
+_BOUNDS = ['max_entries', 'max_bytes']
+
+def _export(fingerprints: list, fingerprint_cls, segment):
+    '''Packs fingerprints into a shared memory segment, replacing it if it is too small.'''
+
+    record = fingerprint_cls._record
+    size = max(len(fingerprints) * record.size, 1)
+
+    if segment is None or segment.size < size:
+        if segment is not None:
+            segment.close()
+            segment.unlink()
+            # Grow geometrically to avoid replacing the segment on every report
+            size = max(size, 2 * segment.size)
+
+        segment = shared_memory.SharedMemory(create=True, size=size)
+
+    for i, fingerprint in enumerate(fingerprints):
+        record.pack_into(segment.buf, i * record.size, *fingerprint.to_record())
+
+    return segment
+
+def _work(processor_cls, options: dict, connection):
+    '''Entry point of a worker process. Owns one processor fed through connection.'''
+
+    processor = processor_cls(pipe_path=None, **options)
+    fingerprint_cls = processor.fingerprint_cls
+    segment = None
+
+    try:
+        while True:
+            message = connection.recv_bytes()
+            tag = message[:1]
+
+            if tag == _FEED:
+                processor.feed(memoryview(message)[1:])
+            elif tag == _RESULT:
+                results = processor.result
+                segment = _export(results, fingerprint_cls, segment)
+                stats = processor.stats()
+                connection.send((segment.name, len(results),
+                                 [stats[field] for field in _WORKER_STATS]))
+            elif tag == _CONFIGURE:
+                # Replies with the settings before the change, or the error raised
+                reply = processor.settings()
+                try:
+                    processor.reconfigure(**pickle.loads(message[1:]))
+                except ValueError as error:
+                    reply = error
+                connection.send(reply)
+            elif tag == _SETTINGS:
+                connection.send(processor.settings())
+            elif tag == _SUSPEND:
+                processor.suspend()
+            elif tag == _RESUME:
+                processor.resume()
+            elif tag == _STOP:
+                break
+    except EOFError:
+        pass
+    finally:
+        if segment is not None:
+            segment.close()
+            segment.unlink()
+
+class _Worker:
+    def __init__(self, processor_cls, options: dict, context, name: str):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_work, args=[processor_cls, options, child],
+                                       name=name, daemon=True)
+        self.segment = None
+        self.process.start()
+        child.close()
+
+    def attach(self, name: str):
+        '''Maps the result segment of the worker, which it may have replaced since last time.'''
+
+        if self.segment is None or self.segment.name != name:
+            if self.segment is not None:
+                self.segment.close()
+
+            # The worker owns the segment and unlinks it. Workers share the resource tracker
+            # of this process, so attaching does not register it a second time.
+            self.segment = shared_memory.SharedMemory(name=name)
+
+        return self.segment
+
+    def stop(self):
+        try:
+            self.connection.send_bytes(_STOP)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+        if self.segment is not None:
+            self.segment.close()
+
+        self.connection.close()
+
+class ShardedProcessor(Processor):
+    '''Runs the fingerprint aggregation of a processor in worker processes.
+
+    The pipe is read in this process and complete records are routed to the workers by
+    hashing the fingerprint key, so each worker owns a disjoint part of the table. With
+    a single worker, the processor simply runs outside of this interpreter's GIL.
+
+    Results are packed by the workers into shared memory segments and unpacked here,
+    so fingerprint tables are never pickled.
+
+    A worker that died is restarted with an empty table when it is next sent records or
+    asked for its result. Its fingerprints are lost and its shard is missing from that result.
+
+    Positional arguments:\n
+    processor_cls -- the processor to run, e.g. BtleProcessor\n
+
+    Keyword arguments:\n
+    workers -- number of worker processes\n
+    options -- further keyword arguments passed to processor_cls in the workers'''
+
+    def __init__(self, processor_cls, *, workers: int=1, pipe_path='', callback=None, ut_id=0,
+                 transport='fifo', ring_size=16 << 20, capture=None, **options):
+        self.name = processor_cls.name
+        self.default_pipe = processor_cls.default_pipe
+        self._packet_length = processor_cls._packet_length
+        self._fmt = processor_cls._fmt
+        self._key_offset = processor_cls._key_offset
+        self._key_size = processor_cls._key_size
+        self._reopen = processor_cls._reopen
+        self._cmd_fmt = processor_cls._cmd_fmt
+        self._processor_cls = processor_cls
+
+        # Events happen in the workers, which have no way to pass them back yet
+        if callback is not None:
+            log.warning('Callbacks are not supported by sharded processors, ignoring.')
+
+        Processor.__init__(self, pipe_path=pipe_path, ut_id=ut_id, transport=transport,
+                           ring_size=ring_size, capture=capture)
+        self.cmd = self._cmd_fmt.format(pipe=self._pipe, ut_id=ut_id).split(' ')
+        self.fingerprint_cls = processor_cls.fingerprint_cls
+
+        # Start the tracker before the workers so they share it with this process
+        resource_tracker.ensure_running()
+
+        # Each worker owns its share of the table bounds
+        options.update(self._share(options, workers))
+
+        if (pool := options.get('history')) is not None and pool.max_bytes:
+            options['history'] = copy.copy(pool)
+            options['history'].max_bytes = max(pool.max_bytes // workers, 1)
+
+        self._options = options
+        self._context = multiprocessing.get_context()
+        self._workers = [_Worker(processor_cls, options, self._context, f'{self.name}.worker{i}')
+                         for i in range(workers)]
+
+        # Stats of the workers as of the last result
+        self._worker_stats = [[0] * len(_WORKER_STATS)] * workers
+        # Settings applied with reconfigure(), for workers that are restarted
+        self._reconfigured = {}
+
+    def _decode(self, view: memoryview):
+        shards = [view] if len(self._workers) == 1 else self._route(view)
+
+        # Called with the lock held, connections are shared with result
+        for worker, shard in zip(self._workers, shards):
+            if shard:
+                try:
+                    worker.connection.send_bytes(_FEED + shard)
+                except OSError:
+                    self._restart(worker)
+
+    def _route(self, view: memoryview) -> list:
+        '''Splits records into one buffer per worker by their key modulo the number of workers.'''
+
+        workers = len(self._workers)
+        length = self._packet_length
+        start, end = self._key_offset, self._key_offset + self._key_size
+
+        if np is not None:
+            records = np.frombuffer(view, dtype=np.uint8).reshape(-1, length)
+            keys = np.zeros((len(records), 8), dtype=np.uint8)
+            keys[:, :self._key_size] = records[:, start:end]
+            shards = keys.view('<u8').ravel() % workers
+            return [records[shards == i].tobytes() for i in range(workers)]
+
+        shards = [bytearray() for _ in range(workers)]
+        for offset in range(0, len(view), length):
+            key = int.from_bytes(view[offset+start:offset+end], 'little')
+            shards[key % workers] += view[offset:offset+length]
+
+        return shards
+
+    @property
+    def result(self) -> list:
+        with self._report_lock:
+            asked = []
+            with self._lock:
+                for worker in self._workers:
+                    try:
+                        worker.connection.send_bytes(_RESULT)
+                        asked.append(worker)
+                    except OSError:
+                        self._restart(worker)
+
+            results = []
+            record = self.fingerprint_cls._record
+            for worker in asked:
+                try:
+                    name, count, stats = worker.connection.recv()
+                except (EOFError, OSError):
+                    with self._lock:
+                        self._restart(worker)
+                    continue
+
+                self._worker_stats[self._workers.index(worker)] = stats
+                segment = worker.attach(name)
+                data = bytes(segment.buf[:count * record.size])
+                results.extend(map(self.fingerprint_cls.from_record, record.iter_unpack(data)))
+
+            return results
+
+    def _restart(self, worker: _Worker):
+        '''Replaces a worker that died with a new one. Called with the lock held.'''
+
+        i = self._workers.index(worker)
+        log.error('%s died with exit code %s, restarting it. Its fingerprints are lost.',
+                  worker.process.name, worker.process.exitcode)
+        worker.stop()
+
+        self._workers[i] = _Worker(self._processor_cls, self._options, self._context,
+                                   worker.process.name)
+        self._worker_stats[i] = [0] * len(_WORKER_STATS)
+
+        # Settings changed since the processor was created, the reply is not needed
+        if self._reconfigured:
+            self._workers[i].connection.send_bytes(
+                _CONFIGURE + pickle.dumps(self._shares(self._reconfigured)))
+            self._workers[i].connection.recv()
+        if self._suspended is not None:
+            self._workers[i].connection.send_bytes(_SUSPEND)
+
+    @staticmethod
+    def _share(options: dict, workers: int) -> dict:
+        '''Returns the bounds in options divided among workers.'''
+        return {bound: max(options[bound] // workers, 1)
+                for bound in _BOUNDS if options.get(bound)}
+
+    def settings(self) -> dict:
+        return self._combine(self._ask(_SETTINGS))
+
+    def reconfigure(self, **settings) -> dict:
+        '''Like Processor.reconfigure. The settings are sent to the workers along with the
+        records, so each applies them between the same records. Table bounds are divided
+        among the workers as when the processor was created.'''
+
+        self._validate(settings)
+        previous = self._combine(self._ask(_CONFIGURE + pickle.dumps(self._shares(settings))))
+        self._reconfigured.update(settings)
+
+        log.info('Reconfigured %s: %s.', self.name, ', '.join(
+            f'{name} {previous[name]} -> {value}' for name, value in settings.items()))
+
+        return {name: previous[name] for name in settings}
+
+    def _validate(self, settings: dict):
+        self._processor_cls._validate(settings)
+
+    def _shares(self, settings: dict) -> dict:
+        '''Returns settings with the table bounds divided among the workers.'''
+        return {**settings, **self._share(settings, len(self._workers))}
+
+    def _ask(self, message: bytes) -> list:
+        '''Sends message to every worker and returns their replies. A worker that died is
+        restarted and its replacement asked once more. The replies of all workers asked are
+        read, so none is left over for the next message. A worker that could not be asked
+        twice replies a ChildProcessError.'''
+
+        replies = [None] * len(self._workers)
+        with self._report_lock:
+            for _ in range(2):
+                with self._lock:
+                    asked = {i: worker for i, worker in enumerate(self._workers)
+                             if replies[i] is None and self._deliver(worker, message)}
+
+                for i, worker in asked.items():
+                    try:
+                        replies[i] = worker.connection.recv()
+                    except (OSError, EOFError):
+                        with self._lock:
+                            # Unless it was already replaced while processing records
+                            if worker in self._workers:
+                                self._restart(worker)
+
+        return [ChildProcessError(f'Worker {i} of {self.name} died while asked.')
+                if reply is None else reply for i, reply in enumerate(replies)]
+
+    @staticmethod
+    def _combine(replies: list) -> dict:
+        '''Returns the settings replied by the workers with their table bounds added up.
+        Raises the error replied instead, if any.'''
+
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+
+        return {**replies[0], **{bound: sum(reply[bound] for reply in replies)
+                                 for bound in _BOUNDS}}
+
+    def suspend(self):
+        with self._lock:
+            if self._suspended is None:
+                self._suspended = self._clock()
+                self._send(_SUSPEND)
+
+    def resume(self):
+        with self._lock:
+            if self._suspended is not None:
+                self._suspended = None
+                self._send(_RESUME)
+
+    def _send(self, message: bytes):
+        '''Sends message to every worker. Called with the lock held.'''
+
+        for worker in list(self._workers):
+            self._deliver(worker, message)
+
+    def _deliver(self, worker: _Worker, message: bytes) -> bool:
+        '''Sends message to a worker, restarting it if it died. Returns whether the message
+        was sent. Called with the lock held.'''
+
+        try:
+            worker.connection.send_bytes(message)
+        except OSError:
+            self._restart(worker)
+            return False
+
+        return True
+
+    def stats(self) -> dict:
+        '''Like Processor.stats, with the table size and the counters of the workers as of the
+        last result. Decode time includes routing and sending records to the workers.'''
+
+        stats = Processor.stats(self)
+        for field, values in zip(_WORKER_STATS, zip(*self._worker_stats)):
+            stats[field] = sum(values)
+
+        return stats
+
+    def stop(self):
+        Processor.stop(self)
+
+        for worker in self._workers:
+            worker.stop()
+
+        log.debug('Stopped %i %s workers.', len(self._workers), self.name)
+        self._workers = []
+
+    def __str__(self):
+        return f'=== {self.name.upper()} ({len(self._workers)} workers) ==='
@@ -0,0 +1,186 @@
+import struct
+from time import time
+import pytest
+import sniffer
+from sharding import ShardedProcessor
+from loadgen import MODES
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+@pytest.fixture
+def pipe_path(tmp_path):
+    return str(tmp_path / 'pipes' / 'pipe')
+
+
+class TestShardedProcessor:
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_results_match_single_process(self, pipe_path, workers):
+        now = int(time())
+        data = b''.join(btle_record(aa % 97, now, -40 - aa % 13) for aa in range(5000))
+
+        reference = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=10)
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=workers, pipe_path=pipe_path,
+                                   seen_threshold=10)
+        try:
+            reference.feed(data)
+            for i in range(0, len(data), 1000):
+                sharded.feed(data[i:i+1000])
+
+            expected = {fp.aa: fp for fp in reference.result}
+            actual = {fp.aa: fp for fp in sharded.result}
+        finally:
+            sharded.stop()
+
+        assert actual.keys() == expected.keys(), 'Different fingerprints reported'
+        for aa, fingerprint in expected.items():
+            assert actual[aa].times_seen == fingerprint.times_seen, 'times_seen differs'
+            assert actual[aa].mean == pytest.approx(fingerprint.mean), 'mean differs'
+            assert actual[aa].std == pytest.approx(fingerprint.std), 'std differs'
+            assert isinstance(actual[aa], sniffer.BtleFingerprint), 'Wrong fingerprint type'
+
+    def test_shards_are_disjoint(self, pipe_path):
+        sharded = ShardedProcessor(sniffer.BtleAdvProcessor, workers=4, pipe_path=pipe_path)
+        try:
+            records = b''.join(struct.pack(MODES['btle-adv'], 0, True,
+                                           i.to_bytes(6, 'little'), 0, -50, 0, 0)
+                               for i in range(1000))
+            shards = sharded._route(memoryview(records))
+        finally:
+            sharded.stop()
+
+        macs = [set(record[2] for record in struct.iter_unpack(MODES['btle-adv'], shard))
+                for shard in shards]
+        assert sum(len(shard) for shard in macs) == 1000, 'Records lost while routing'
+        assert all(len(shard) > 0 for shard in macs), 'Every worker should get records'
+
+    def test_result_segment_grows(self, pipe_path):
+        now = int(time())
+        # first_seen is the wall clock, which may be a second ahead of the records
+        sharded = ShardedProcessor(sniffer.BtbrProcessor, pipe_path=pipe_path, seen_for=-10)
+        try:
+            sharded.feed(struct.pack(sniffer.BtbrProcessor._fmt, 1, 0x42, 1, now))
+            assert len(sharded.result) == 1, 'One fingerprint expected'
+
+            sharded.feed(b''.join(struct.pack(sniffer.BtbrProcessor._fmt, 0, 0, lap, now)
+                                  for lap in range(10000)))
+            results = sharded.result
+        finally:
+            sharded.stop()
+
+        assert len(results) == 10000, 'All fingerprints expected'
+        assert {fp.lap for fp in results} == set(range(10000)), 'Wrong fingerprints'
+
+    def test_stats_include_workers(self, pipe_path):
+        now = int(time())
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=2, pipe_path=pipe_path)
+        try:
+            sharded.feed(b''.join(btle_record(aa, now, -50) for aa in range(100)))
+            sharded.result
+            stats = sharded.stats()
+        finally:
+            sharded.stop()
+
+        assert stats['records'] == 100, 'Records read by the parent not counted'
+        assert stats['table_size'] == 100, 'Table sizes of the workers not summed'
+
+    def test_dead_worker_is_restarted(self, pipe_path):
+        now = int(time())
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=2, pipe_path=pipe_path,
+                                   seen_threshold=1)
+        try:
+            data = b''.join(btle_record(aa, now, -50) for aa in range(100))
+            sharded.feed(data)
+            killed = sharded._workers[0].process
+            killed.kill()
+            killed.join()
+
+            survivors = {fp.aa for fp in sharded.result}
+            sharded.feed(data)
+            results = {fp.aa for fp in sharded.result}
+        finally:
+            sharded.stop()
+
+        assert survivors == {aa for aa in range(100) if aa % 2}, \
+            'Shard of the living worker not reported'
+        assert results == set(range(100)), 'Dead worker not replaced'
+
+    def test_suspended_workers_keep_fingerprints(self, pipe_path):
+        now = int(time())
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=2, pipe_path=pipe_path,
+                                   seen_threshold=1)
+        try:
+            sharded.feed(b''.join(btle_record(aa, now, -50) for aa in range(10)))
+            sharded.suspend()
+            reported = [len(sharded.result) for _ in range(4)]
+            sharded.resume()
+            stats = sharded.stats()
+        finally:
+            sharded.stop()
+
+        assert reported == [10, 0, 0, 0], 'Qualifying fingerprints should be reported once'
+        assert (stats['table_size'], stats['expirations']) == (10, 0), \
+            'Workers expired fingerprints while suspended'
+
+    def test_settings_do_not_reconfigure(self, pipe_path, caplog):
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=2, pipe_path=pipe_path,
+                                   seen_threshold=10, max_entries=1000)
+        try:
+            with caplog.at_level('INFO'):
+                settings = sharded.settings()
+            sharded.reconfigure(seen_threshold=3)
+
+            killed = sharded._workers[1].process
+            killed.kill()
+            killed.join()
+            sharded.result
+            restarted = sharded.settings()
+        finally:
+            sharded.stop()
+
+        assert (settings['seen_threshold'], settings['max_entries']) == (10, 1000), \
+            'Wrong settings'
+        assert 'Reconfigured' not in caplog.text, 'Reading the settings reconfigured the workers'
+        assert (restarted['seen_threshold'], restarted['max_entries']) == (3, 1000), \
+            'Restarted worker lost the settings'
+
+    def test_dead_worker_is_asked_again(self, pipe_path):
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=3, pipe_path=pipe_path,
+                                   seen_threshold=10, max_entries=900)
+        try:
+            sharded.reconfigure(seen_threshold=3)
+            for i in [0, 2]:
+                killed = sharded._workers[i].process
+                killed.kill()
+                killed.join()
+
+            settings = sharded.settings()
+            previous = sharded.reconfigure(seen_threshold=4)
+            again = sharded.settings()
+        finally:
+            sharded.stop()
+
+        assert (settings['seen_threshold'], settings['max_entries']) == (3, 900), \
+            'Replies of the restarted workers missing'
+        assert previous == {'seen_threshold': 3}, 'Replies left over from the dead workers'
+        assert again['seen_threshold'] == 4, 'Restarted workers not reconfigured'
+
+    def test_reconfigure_workers(self, pipe_path):
+        now = int(time())
+        sharded = ShardedProcessor(sniffer.BtleProcessor, workers=2, pipe_path=pipe_path,
+                                   seen_threshold=10, max_entries=1000)
+        try:
+            sharded.feed(b''.join(btle_record(aa, now, -50) for aa in range(100)) * 3)
+            previous = sharded.reconfigure(seen_threshold=3, max_entries=500)
+            with pytest.raises(ValueError):
+                sharded.reconfigure(seen_for=10)
+
+            results = sharded.result
+            settings = sharded.settings()
+        finally:
+            sharded.stop()
+
+        assert previous == {'seen_threshold': 10, 'max_entries': 1000}, 'Wrong previous values'
+        assert len(results) == 100, 'Fingerprints of the workers lost or not requalified'
+        assert (settings['seen_threshold'], settings['max_entries']) == (3, 500), \
+            'Settings not applied in the workers'
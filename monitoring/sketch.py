@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.8
+
+import random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['CountMinSketch', 'AdmissionFilter']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+_MASK = (1 << 64) - 1
+# Counters are single bytes, admission only needs small counts
+_SATURATED = 255
+
+class CountMinSketch:
+    '''Approximate counts of integer keys in fixed memory.
+
+    Each of depth rows maps a key to one of width byte counters with its own multiply-shift
+    hash. Updates are conservative, only the smallest counters of a key are raised, which
+    keeps estimates close to the true count. Estimates never fall below it, but grow with
+    the number of distinct keys counted, so width should be well above the number of keys
+    added between resets. Counts saturate at 255.
+
+    Keyword arguments:\n
+    width -- counters per row, rounded up to a power of two\n
+    depth -- number of rows\n
+    seed -- seed of the hash functions'''
+
+    def __init__(self, *, width: int=1 << 18, depth: int=4, seed: int=0):
+        bits = max((width - 1).bit_length(), 1)
+        self.width = 1 << bits
+        self.depth = depth
+        self._shift = 64 - bits
+
+        rng = random.Random(seed)
+        self._hashes = [(row * self.width, rng.getrandbits(64) | 1) for row in range(depth)]
+        self._counters = bytearray(self.width * depth)
+
+    def add(self, key: int) -> int:
+        '''Counts key once. Returns the estimated count including this occurrence.'''
+
+        counters = self._counters
+        shift = self._shift
+        cells = [offset + ((key * multiplier & _MASK) >> shift)
+                 for offset, multiplier in self._hashes]
+
+        estimate = min([counters[cell] for cell in cells])
+        if estimate < _SATURATED:
+            estimate += 1
+            for cell in cells:
+                if counters[cell] < estimate:
+                    counters[cell] = estimate
+
+        return estimate
+
+    def add_many(self, keys, counts):
+        '''Counts distinct keys, given as a NumPy array, counts times each, as one conservative
+        update. Returns the estimated counts including these occurrences.'''
+
+        counters = np.frombuffer(self._counters, dtype=np.uint8)
+        keys = keys.astype(np.uint64)
+        cells = [offset + ((keys * np.uint64(multiplier)) >> np.uint64(self._shift)).astype(np.int64)
+                 for offset, multiplier in self._hashes]
+
+        estimates = np.minimum.reduce([counters[row] for row in cells]).astype(np.int64)
+        estimates = np.minimum(estimates + counts, _SATURATED)
+
+        # Keys sharing a counter within the batch raise it to the largest of their estimates
+        for row in cells:
+            np.maximum.at(counters, row, estimates.astype(np.uint8))
+
+        return estimates
+
+    def reset(self):
+        self._counters[:] = bytes(len(self._counters))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._counters)
+
+class AdmissionFilter:
+    '''Admits a key into a fingerprint table once it occurred count times within a window.
+
+    Keys that occur once, like access addresses decoded from bit errors, are only counted in
+    a CountMinSketch and never allocate a fingerprint. The sketch is cleared every window
+    seconds, so it does not fill up with old keys. A key needs count occurrences within one
+    window, a key whose occurrences straddle a reset needs a few more.
+
+    Records rejected by the filter are counted in rejected. The first count - 1 occurrences of
+    an admitted key are among them, so a table behind the filter sees that many fewer.
+
+    Positional arguments:\n
+    count -- occurrences within a window after which a key is admitted\n
+
+    Keyword arguments:\n
+    window -- seconds after which the counts are cleared, 0 to never clear them\n
+    width, depth, seed -- dimensions of the sketch, see CountMinSketch'''
+
+    def __init__(self, count: int, *, window: float=10, width: int=1 << 18, depth: int=4,
+                 seed: int=0):
+        self.count = count
+        self.window = window
+        self.sketch = CountMinSketch(width=width, depth=depth, seed=seed)
+        self.rejected = 0
+        self.resets = 0
+        self._started = None
+
+    def roll(self, now: float):
+        '''Clears the counts if the window started at least window seconds before now.'''
+
+        if self._started is None:
+            self._started = now
+        elif self.window and now - self._started >= self.window:
+            self.sketch.reset()
+            self.resets += 1
+            self._started = now
+
+    def __call__(self, key: int) -> bool:
+        '''Counts key and returns whether it is admitted.'''
+
+        if self.sketch.add(key) >= self.count:
+            return True
+
+        self.rejected += 1
+        return False
+
+    def admit_many(self, keys, counts):
+        '''Counts distinct keys occurring counts times each, given as NumPy arrays. Returns how
+        many of the occurrences of each key are admitted, the last ones, as calling the filter
+        once per occurrence would.'''
+
+        estimates = self.sketch.add_many(keys, counts)
+        admitted = (estimates - (self.count - 1)).clip(0, counts)
+        self.rejected += int((counts - admitted).sum())
+
+        return admitted
@@ -0,0 +1,75 @@
+import random
+import pytest
+from sketch import CountMinSketch, AdmissionFilter
+
+
+class TestCountMinSketch:
+    def test_estimates_never_undercount(self):
+        sketch = CountMinSketch(width=1024, depth=4)
+        rng = random.Random(1)
+        counts = {rng.getrandbits(32): rng.randint(1, 20) for _ in range(500)}
+
+        for key, count in counts.items():
+            for _ in range(count):
+                sketch.add(key)
+
+        for key, count in counts.items():
+            assert sketch.add(key) >= count + 1, 'Estimate below the true count'
+
+        exact = sum(sketch.add(key) == count + 2 for key, count in counts.items())
+        assert exact > 0.9 * len(counts), 'Estimates should mostly be exact at low load'
+
+    def test_saturates(self):
+        sketch = CountMinSketch(width=64, depth=2)
+        for _ in range(300):
+            estimate = sketch.add(7)
+
+        assert estimate == 255, 'Counters should saturate instead of wrapping'
+
+    def test_batch_update_matches_single_updates(self):
+        np = pytest.importorskip('numpy')
+        keys = np.array([3, 5, 1 << 40], dtype=np.uint64)
+        counts = np.array([1, 4, 2])
+
+        batch = CountMinSketch(width=1 << 16)
+        single = CountMinSketch(width=1 << 16)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            for _ in range(count):
+                single.add(key)
+
+        assert batch.add_many(keys, counts).tolist() == [1, 4, 2], 'Wrong batch estimates'
+        assert batch._counters == single._counters, 'Batch update differs from single updates'
+
+
+class TestAdmissionFilter:
+    def test_admits_after_count(self):
+        admission = AdmissionFilter(3)
+        assert [admission(42) for _ in range(4)] == [False, False, True, True], \
+            'Key should be admitted on its third occurrence'
+        assert admission.rejected == 2, 'Rejected records not counted'
+
+    def test_window_clears_counts(self):
+        admission = AdmissionFilter(2, window=10)
+        admission.roll(1000)
+        admission(42)
+
+        admission.roll(1009)
+        assert admission(42), 'Second occurrence within the window should be admitted'
+
+        admission.roll(1010)
+        assert not admission(42), 'Counts should have been cleared'
+        assert admission.resets == 1, 'Reset not counted'
+
+    def test_batch_admits_like_single_records(self):
+        np = pytest.importorskip('numpy')
+        batch = AdmissionFilter(3)
+        single = AdmissionFilter(3)
+        keys = np.array([3, 5, 7], dtype=np.uint64)
+
+        for counts in [[1, 4, 2], [1, 1, 2]]:
+            admitted = batch.admit_many(keys, np.array(counts))
+            expected = [sum(single(key) for _ in range(count))
+                        for key, count in zip(keys.tolist(), counts)]
+            assert admitted.tolist() == expected, 'Batch admits other records than single ones'
+
+        assert batch.rejected == single.rejected, 'Rejected records counted differently'
@@ -1,18 +1,35 @@
 #!/usr/bin/env python3.8
 
+import asyncio
 import threading
 import subprocess
-from time import sleep, time
+from time import monotonic, perf_counter, time
 import logging as log
 import os
+import fcntl
+import select
+import termios
 from contextlib import suppress
-from collections import namedtuple, defaultdict
+from collections import OrderedDict, namedtuple
 from collections.abc import Callable
+from functools import lru_cache, partial
 import struct
 import math
-
-__all__ = ['Sniffer', 'BtbrProcessor', 'BtleProcessor', 'BtleAdvProcessor',
-           'BtbrFingerprint', 'mac_bytes_to_str']
+from ringbuffer import RingBuffer
+from stats import DOWNTIME_BUCKETS, Histogram, ProcessorStats
+from dispatch import Dispatcher
+from tdigest import TDigest
+from history import RssiHistory
+from sketch import AdmissionFilter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['Sniffer', 'Supervisor', 'AsyncRuntime', 'BtbrProcessor', 'BtleProcessor',
+           'BtleAdvProcessor', 'BtbrFingerprint', 'ColumnarFingerprints', 'RunningStats',
+           'mac_bytes_to_str', 'mac_int_to_str']
 
 __author__ = "Severin Marti <severin.marti@ost.ch"
 __status__  = "development"
@@ -22,35 +39,151 @@ __status__  = "development"
 def mac_bytes_to_str(mac: bytes) -> str:
     return ':'.join(f'{byte:02x}' for byte in reversed(mac))
 
-class Std:
-    def __init__(self):
-        self.mean = 0
-        self._n = 0
-        self.std = 0
-
-    def update_std(self, value: int):
-        if self._n == 0:
-            self.mean = value
-            self.std = 0
-            self._n += 1
-            return
+@lru_cache(maxsize=1 << 16)
+def mac_int_to_str(mac: int) -> str:
+    '''Formats a MAC address decoded as a little-endian 48-bit integer, like mac_bytes_to_str.
+    Devices are reported over and over, so the strings are cached.'''
+
+    digits = f'{mac:012x}'
+    return ':'.join(digits[i:i+2] for i in range(0, 12, 2))
+
+class RunningStats:
+    '''Count, mean and sum of squared deviations from the mean (m2) of a stream of values.
+
+    Values are added with Welford's update, which neither takes a square root nor rescales
+    the variance, and does not drift over millions of values. Accumulators of disjoint parts
+    of a stream, e.g. from batches or other processes, are combined exactly with merge().
+    The standard deviation is only computed when read.
+
+    Keyword arguments:\n
+    count, mean, m2 -- statistics of the values added so far'''
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self, *, count: int=0, mean: float=0.0, m2: float=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def update_many(self, values):
+        '''Adds a batch of values, given as a NumPy array or a sequence.'''
+
+        if np is not None and isinstance(values, np.ndarray):
+            if not (count := len(values)):
+                return
+            mean = float(values.mean())
+            m2 = float(((values - mean) ** 2).sum())
+        else:
+            if not (count := len(values := list(values))):
+                return
+            mean = math.fsum(values) / count
+            m2 = math.fsum((value - mean) ** 2 for value in values)
+
+        self._add(count, mean, m2)
+
+    def merge(self, other: 'RunningStats'):
+        '''Adds the values of another accumulator.'''
+
+        if other.count:
+            self._add(other.count, other.mean, other.m2)
+
+    def _add(self, count: int, mean: float, m2: float):
+        self.count, self.mean, self.m2 = self.combine(self.count, self.mean, self.m2,
+                                                      count, mean, m2)
+
+    @staticmethod
+    def combine(count_a, mean_a, m2_a, count_b, mean_b, m2_b) -> tuple:
+        '''Chan's parallel formulas, the count, mean and m2 of two parts together. Works
+        element-wise on NumPy arrays. count_b must not be 0.'''
+
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * count_b / count
+        m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+        return count, mean, m2
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+class Quantiles:
+    '''RSSI median and interquartile range of fingerprints keeping a TDigest in digest,
+    None for fingerprints without one.'''
+
+    __slots__ = ()
+
+    # Centroids kept when the digest is encoded in a record
+    _record_centroids = 24
+
+    @property
+    def median(self) -> float:
+        return self.digest.quantile(0.5) if self.digest is not None else None
+
+    @property
+    def iqr(self) -> float:
+        if self.digest is None or (lower := self.digest.quantile(0.25)) is None:
+            return None
+
+        return self.digest.quantile(0.75) - lower
+
+    def _pack_digest(self) -> tuple:
+        if self.digest is None:
+            return False, b''
+
+        return True, self.digest.pack(self._record_centroids)
+
+    @staticmethod
+    def _unpack_digest(present: bool, data: bytes) -> TDigest:
+        return TDigest.unpack(data) if present else None
+
+_DIGEST_FORMAT = f'?{TDigest.packed_size(Quantiles._record_centroids)}s'
+
+class History:
+    '''RSSI trajectory of fingerprints keeping an RssiHistory in history, None for
+    fingerprints without one.'''
+
+    __slots__ = ()
+
+    # Latest samples kept when the history is encoded in a record
+    _record_samples = 60
+
+    def _pack_history(self) -> tuple:
+        if self.history is None:
+            return RssiHistory.pack_missing(self._record_samples)
+
+        return self.history.pack(self._record_samples)
 
-        new_mean = (self._n*self.mean + value) / (self._n+1)
-        new_std = math.sqrt((self._n*(self.std**2 + (new_mean-self.mean) ** 2) +
-                            (new_mean-value)**2) / (self._n+1))
-        self.mean = new_mean
-        self.std = new_std
-        self._n += 1
+    @staticmethod
+    def _unpack_history(values: tuple) -> RssiHistory:
+        return RssiHistory.unpack(values)
+
+_HISTORY_FORMAT = RssiHistory.record_format(History._record_samples)
 
 class BtFingerprint:
-    def __init__(self):
-        self.first_seen = int(time())
-        self.last_seen = self.first_seen
+    # Fingerprint tables hold hundreds of thousands of these, slots save the instance dict.
+    # The attributes are declared by the subclasses, a class can only inherit slots from
+    # one base and the statistics come from RunningStats
+    __slots__ = ()
+
+    def __init__(self, first_seen: int=None):
+        self.first_seen = int(time()) if first_seen is None else first_seen
+        self.last_seen = 0
 
 class BtbrFingerprint(BtFingerprint):
+    __slots__ = ('first_seen', 'last_seen', 'uap', 'lap', 'nap')
 
-    def __init__(self):
-        BtFingerprint.__init__(self)
+    def __init__(self, first_seen: int=None):
+        BtFingerprint.__init__(self, first_seen)
         self.uap = None
         self.lap = None
         self.nap = None
@@ -62,7 +195,8 @@ class BtbrFingerprint(BtFingerprint):
         if new := self.lap is None:
             self.lap = packet.lap
 
-        self.last_seen = packet.timestamp
+        if packet.timestamp > self.last_seen:
+            self.last_seen = packet.timestamp
 
         return new
 
@@ -70,24 +204,47 @@ class BtbrFingerprint(BtFingerprint):
         return f'{(self.uap if self.uap else 0):02x}{self.lap:06x}' \
                f'first_seen: {self.first_seen} last_seen: {self.last_seen}'
 
-class BtleFingerprint(BtFingerprint, Std):
-    def __init__(self):
-        Std.__init__(self)
-        BtFingerprint.__init__(self)
+    # Fixed size encoding used to pass results between processes
+    _record = struct.Struct('=?BIqq')
+
+    def to_record(self) -> tuple:
+        return self.uap is not None, self.uap or 0, self.lap, self.first_seen, self.last_seen
+
+    @classmethod
+    def from_record(cls, record: tuple):
+        fingerprint = cls()
+        has_uap, uap, fingerprint.lap, fingerprint.first_seen, fingerprint.last_seen = record
+        fingerprint.uap = uap if has_uap else None
+        return fingerprint
+
+class BtleFingerprint(BtFingerprint, RunningStats, Quantiles, History):
+    __slots__ = ('first_seen', 'last_seen', 'aa', 'times_seen', 'rssi', 'digest', 'history')
+
+    def __init__(self, first_seen: int=None, *, quantiles: bool=False, history=None):
+        RunningStats.__init__(self)
+        BtFingerprint.__init__(self, first_seen)
         self.aa = None
         self.times_seen = 0
         self.rssi = None
+        self.digest = TDigest() if quantiles else None
+        # Ring from a history.HistoryPool, None without a pool or once its budget is used up
+        self.history = history.ring() if history is not None else None
 
     def update(self, packet):
         if self.aa is None:
             self.aa = packet.aa
 
         self.rssi = packet.rssi
-        self.update_std(packet.rssi)
+        RunningStats.update(self, packet.rssi)
+        if self.digest is not None:
+            self.digest.update(packet.rssi)
+        if self.history is not None:
+            self.history.update(packet.timestamp, packet.rssi)
 
         self.times_seen += 1
 
-        self.last_seen = packet.timestamp
+        if packet.timestamp > self.last_seen:
+            self.last_seen = packet.timestamp
 
         return self.times_seen
 
@@ -95,16 +252,37 @@ class BtleFingerprint(BtFingerprint, Std):
         return f'{self.aa:06x} seen {self.times_seen} times, last_seen {self.last_seen}, '\
                f'rssi: {self.rssi}, mean: {self.mean}, std: {self.std}'
 
-class BtleAdvFingerprint(BtFingerprint, Std):
-    def __init__(self):
-        Std.__init__(self)
-        BtFingerprint.__init__(self)
+    _record = struct.Struct('=Iqqqidd' + _DIGEST_FORMAT + _HISTORY_FORMAT)
+
+    def to_record(self) -> tuple:
+        return (self.aa, self.first_seen, self.last_seen, self.times_seen, self.rssi,
+                self.mean, self.m2, *self._pack_digest(), *self._pack_history())
+
+    @classmethod
+    def from_record(cls, record: tuple):
+        fingerprint = cls()
+        fingerprint.aa, fingerprint.first_seen, fingerprint.last_seen, fingerprint.times_seen, \
+            fingerprint.rssi, fingerprint.mean, fingerprint.m2, *rest = record
+        fingerprint.count = fingerprint.times_seen
+        fingerprint.digest = cls._unpack_digest(*rest[:2])
+        fingerprint.history = cls._unpack_history(rest[2:])
+        return fingerprint
+
+class BtleAdvFingerprint(BtFingerprint, RunningStats, Quantiles, History):
+    __slots__ = ('first_seen', 'last_seen', 'type', 'random', 'mac', 'rssi', 'service_uuid',
+                 'company_id', 'digest', 'history')
+
+    def __init__(self, first_seen: int=None, *, quantiles: bool=False, history=None):
+        RunningStats.__init__(self)
+        BtFingerprint.__init__(self, first_seen)
         self.type = None
         self.random = None
         self.mac = None
         self.rssi = None
         self.service_uuid = None
         self.company_id = None
+        self.digest = TDigest() if quantiles else None
+        self.history = history.ring() if history is not None else None
 
     def update(self, packet):
         if new := self.mac is None:
@@ -113,36 +291,417 @@ class BtleAdvFingerprint(BtFingerprint, Std):
             self.company_id = packet.company_id
             self.random = packet.random
 
+        self.observe(packet.timestamp, packet.rssi)
 
-        self.rssi = packet.rssi
-        self.update_std(packet.rssi)
+        return new
 
-        self.last_seen = packet.timestamp
+    def observe(self, timestamp: int, rssi: int):
+        '''Adds a record of the known device, without the fields only read for new devices.'''
 
-        return new
+        self.rssi = rssi
+        RunningStats.update(self, rssi)
+        if self.digest is not None:
+            self.digest.update(rssi)
+        if self.history is not None:
+            self.history.update(timestamp, rssi)
+
+        if timestamp > self.last_seen:
+            self.last_seen = timestamp
 
     def __str__(self):
-        return f'{mac_bytes_to_str(self.mac)} random: {self.random} first_seen: {self.first_seen} '\
+        return f'{mac_int_to_str(self.mac)} random: {self.random} first_seen: {self.first_seen} '\
                f'last_seen: {self.last_seen} rssi: {self.rssi} mean: {self.mean} std: {self.std} '\
                f'service_uuid: {hex(self.service_uuid)} company_id: {hex(self.company_id)}'
 
+    _record = struct.Struct('=QB?HHqqqidd' + _DIGEST_FORMAT + _HISTORY_FORMAT)
+
+    def to_record(self) -> tuple:
+        return (self.mac, self.type or 0, self.random, self.service_uuid, self.company_id,
+                self.first_seen, self.last_seen, self.count, self.rssi, self.mean, self.m2,
+                *self._pack_digest(), *self._pack_history())
+
+    @classmethod
+    def from_record(cls, record: tuple):
+        fingerprint = cls()
+        fingerprint.mac, fingerprint.type, fingerprint.random, fingerprint.service_uuid, \
+            fingerprint.company_id, fingerprint.first_seen, fingerprint.last_seen, fingerprint.count, \
+            fingerprint.rssi, fingerprint.mean, fingerprint.m2, *rest = record
+        fingerprint.digest = cls._unpack_digest(*rest[:2])
+        fingerprint.history = cls._unpack_history(rest[2:])
+        return fingerprint
+
+class Generation(OrderedDict):
+    '''Fingerprints last seen at or after boundary, the time of the last report.
+
+    Processors keep two generations, which act as a bucketed last-seen index: the active
+    one and the previous one covering the interval before boundary. A fingerprint moves
+    into the active generation when a record at or after boundary arrives for it. Records
+    older than boundary that arrive late update the fingerprint where it is, so it expires
+    with its interval. Expiry therefore only drops the previous generation, and the previous
+    generation holds exactly the fingerprints seen least recently. Generations keep the
+    order fingerprints entered them, so the oldest can be evicted in constant time.
+
+    qualified holds the fingerprints that met the reporting criteria on their last update,
+    so selecting the result never scans fingerprints that did not change.
+
+    New fingerprints are first seen at the time returned by clock. If admit is given, it is
+    called with the key of an unknown fingerprint, which is only created if it returns True.'''
+
+    __slots__ = ('factory', 'previous', 'boundary', 'qualified', 'clock', 'admit')
+
+    def __init__(self, factory, previous: dict=None, boundary: int=0, clock=time, admit=None):
+        OrderedDict.__init__(self)
+        self.factory = factory
+        self.previous = previous
+        self.boundary = boundary
+        self.qualified = {}
+        self.clock = clock
+        self.admit = admit
+
+    def take(self, key, record):
+        '''Returns the fingerprint for a key missing from the generation. Returns None if
+        record is late and was applied to the fingerprint in the previous generation, or if
+        the key was not admitted.'''
+
+        fingerprint = self.previous.get(key) if self.previous is not None else None
+        if fingerprint is None:
+            if self.admit is not None and not self.admit(key):
+                return None
+
+            fingerprint = self.factory(int(self.clock()))
+        elif record.timestamp < self.boundary:
+            fingerprint.update(record)
+            return None
+        else:
+            del self.previous[key]
+
+        self[key] = fingerprint
+        return fingerprint
+
+class ColumnarFingerprints:
+    '''Fingerprint table keeping one row per key in parallel NumPy arrays.
+
+    Batches of records are applied with vectorized group-by updates. Mean and variance of
+    each group are combined with the stored values using the parallel merge formulas, so
+    the table holds the same statistics as updating a fingerprint per packet.
+
+    Positional arguments:\n
+    fingerprint_cls -- the class of the objects returned when reading the table\n
+
+    Keyword arguments:\n
+    key_field -- the fingerprint attribute holding the key\n
+    static_fields -- name and dtype of per-key values taken from the first record seen\n
+    encode_key, decode_key -- convert between the fingerprint key and the integer row key'''
+
+    _dynamic_fields = [('first_seen', 'i8'), ('last_seen', 'i8'), ('times_seen', 'i8'),
+                       ('rssi', 'i4'), ('mean', 'f8'), ('m2', 'f8')]
+
+    def __init__(self, fingerprint_cls, *, key_field: str, static_fields: list=(),
+                 encode_key=None, decode_key=None, capacity: int=1024):
+        if np is None:
+            raise RuntimeError('The columnar fingerprint store requires numpy.')
+
+        self._fingerprint_cls = fingerprint_cls
+        self._key_field = key_field
+        self._static_names = [name for name, _ in static_fields]
+        self._encode_key = encode_key if encode_key else lambda key: key
+        self._decode_key = decode_key if decode_key else lambda key: key
+
+        self._index = {}
+        self._keys = []
+        self._free = []
+        self.columns = {name: np.zeros(capacity, dtype=dtype)
+                        for name, dtype in self._dynamic_fields + list(static_fields)}
+        self.columns['live'] = np.zeros(capacity, dtype=bool)
+
+    @property
+    def size(self) -> int:
+        '''Number of allocated rows, live or free.'''
+        return len(self._keys)
+
+    def update(self, keys, timestamps, rssi, statics: dict=None, *, now: int=None, admit=None):
+        '''Applies a batch of records given as equally long arrays. New fingerprints are
+        first seen at now, the current time by default.
+
+        If admit is given, it is called with the unknown keys of the batch and how often each
+        occurs in it, and returns how many of the last records of each key to apply. Earlier
+        records of these keys are dropped, and keys without any get no row.
+
+        Returns the rows of the keys in the batch and how often they were seen before it.'''
+
+        unique, first, inverse, counts = np.unique(keys, return_index=True,
+                                                   return_inverse=True, return_counts=True)
+        rows = self._lookup(unique)
+
+        if admit is not None and len(new := np.flatnonzero(rows < 0)):
+            if ((rejected := counts[new] - admit(unique[new], counts[new])) > 0).any():
+                skip = np.zeros(len(unique), dtype=np.int64)
+                skip[new] = rejected
+
+                # Position of each record among the records of its key
+                order = np.argsort(inverse, kind='stable')
+                rank = np.empty(len(keys), dtype=np.int64)
+                rank[order] = np.arange(len(keys)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+                keep = rank >= skip[inverse]
+                return self.update(keys[keep], timestamps[keep], rssi[keep],
+                                   {name: values[keep] for name, values in (statics or {}).items()},
+                                   now=now)
+
+        last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+
+        rows = self._rows(unique, rows,
+                          {name: values[first] for name, values in (statics or {}).items()},
+                          int(time()) if now is None else now)
+
+        rssi = rssi.astype(np.float64)
+        batch_mean = np.bincount(inverse, weights=rssi) / counts
+        batch_m2 = np.bincount(inverse, weights=(rssi - batch_mean[inverse]) ** 2)
+
+        columns = self.columns
+        seen = columns['times_seen'][rows]
+        columns['times_seen'][rows], columns['mean'][rows], columns['m2'][rows] = \
+            RunningStats.combine(seen, columns['mean'][rows], columns['m2'][rows],
+                                 counts, batch_mean, batch_m2)
+        columns['rssi'][rows] = rssi[last]
+
+        # Latest timestamp of each group, records may arrive out of order
+        latest = np.zeros(len(unique), dtype=np.int64)
+        np.maximum.at(latest, inverse, timestamps)
+        np.maximum(columns['last_seen'][rows], latest, out=latest)
+        columns['last_seen'][rows] = latest
+
+        return rows, seen
+
+    def _lookup(self, unique):
+        '''Maps integer keys to rows, -1 for unknown keys.'''
+
+        index = self._index
+        return np.fromiter((index.get(key, -1) for key in unique.tolist()),
+                           dtype=np.int64, count=len(unique))
+
+    def _rows(self, unique, rows, statics: dict, now: int):
+        '''Allocates rows for the unknown keys among sorted unique integer keys, given their
+        rows as returned by _lookup.'''
+
+        index = self._index
+        new = np.flatnonzero(rows < 0)
+        if not len(new):
+            return rows
+
+        allocated = self._allocate(len(new))
+        rows[new] = allocated
+        index.update(zip(unique[new].tolist(), allocated.tolist()))
+        for key, row in zip(unique[new].tolist(), allocated.tolist()):
+            self._keys[row] = key
+
+        columns = self.columns
+        columns['first_seen'][allocated] = now
+        columns['last_seen'][allocated] = 0
+        columns['times_seen'][allocated] = 0
+        columns['mean'][allocated] = 0
+        columns['m2'][allocated] = 0
+        columns['live'][allocated] = True
+        for name, values in statics.items():
+            columns[name][allocated] = values[new]
+
+        return rows
+
+    def _allocate(self, count: int):
+        reused = [self._free.pop() for _ in range(min(count, len(self._free)))]
+
+        start = len(self._keys)
+        grow = count - len(reused)
+        self._keys.extend([None] * grow)
+
+        if (capacity := len(self.columns['live'])) < len(self._keys):
+            while capacity < len(self._keys):
+                capacity *= 2
+
+            for name, column in self.columns.items():
+                resized = np.zeros(capacity, dtype=column.dtype)
+                resized[:len(column)] = column
+                self.columns[name] = resized
+
+        return np.array(reused + list(range(start, start + grow)), dtype=np.int64)
+
+    def expire(self, cutoff: int) -> int:
+        '''Drops all rows last seen before cutoff. Returns the number of rows dropped.'''
+
+        size = self.size
+        columns = self.columns
+        return self._drop(np.flatnonzero(columns['live'][:size] &
+                                         (columns['last_seen'][:size] < cutoff)))
+
+    def evict(self, count: int) -> int:
+        '''Drops the count rows seen least recently. Returns the number of rows dropped.'''
+
+        rows = self.live_rows()
+        if count >= len(rows):
+            return self._drop(rows)
+
+        if count <= 0:
+            return 0
+
+        # Selecting the oldest rows is linear, sorting them is not needed
+        oldest = np.argpartition(self.columns['last_seen'][rows], count - 1)[:count]
+        return self._drop(rows[oldest])
+
+    def _drop(self, rows) -> int:
+        for row in rows.tolist():
+            del self._index[self._keys[row]]
+            self._keys[row] = None
+
+        self.columns['live'][rows] = False
+        self._free.extend(rows.tolist())
+
+        return len(rows)
+
+    def live_rows(self):
+        return np.flatnonzero(self.columns['live'][:self.size])
+
+    def export(self, rows) -> list:
+        '''Returns fingerprint objects holding the values of the given rows.'''
+        return self.build(self.snapshot(rows))
+
+    def snapshot(self, rows) -> tuple:
+        '''Copies keys and column values of the given rows. Only this step needs to be
+        protected from concurrent updates, build() can run without holding a lock.'''
+
+        columns = self.columns
+        keys = self._keys
+        return [keys[row] for row in rows.tolist()], \
+               {name: columns[name][rows] for name in
+                ['first_seen', 'last_seen', 'times_seen', 'rssi', 'mean', 'm2'] + self._static_names}
+
+    def build(self, snapshot: tuple) -> list:
+        '''Creates fingerprint objects from a snapshot.'''
+
+        keys, values = snapshot
+        keys = [self._decode_key(key) for key in keys]
+        values = {name: column.tolist() for name, column in values.items()}
+
+        fingerprints = []
+        for i, key in enumerate(keys):
+            fingerprint = self._fingerprint_cls()
+            setattr(fingerprint, self._key_field, key)
+            fingerprint.first_seen = values['first_seen'][i]
+            fingerprint.last_seen = values['last_seen'][i]
+            fingerprint.rssi = values['rssi'][i]
+            fingerprint.mean = values['mean'][i]
+            fingerprint.count = values['times_seen'][i]
+            fingerprint.m2 = values['m2'][i]
+            if hasattr(fingerprint, 'times_seen'):
+                fingerprint.times_seen = fingerprint.count
+            for name in self._static_names:
+                setattr(fingerprint, name, values[name][i])
+
+            fingerprints.append(fingerprint)
+
+        return fingerprints
+
+    def __getitem__(self, key):
+        row = self._index[self._encode_key(key)]
+        return self.export(np.array([row]))[0]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def values(self) -> list:
+        return self.export(self.live_rows())
+
+    def items(self) -> list:
+        return [(getattr(fingerprint, self._key_field), fingerprint) for fingerprint in self.values()]
+
 class Processor:
 
     default_pipe = 'pipes/pipe'
     name = 'base'
-
-    def __init__(self, *, pipe_path = "", callback=None, ut_id=0):
+    _packet_length = 0
+    _fmt = ''
+    _dtype = None
+    _cmd_fmt = ''
+    fingerprint_cls = None
+    # Location of the fingerprint key within a record
+    _key_offset, _key_size = 0, 0
+    # Whether to reopen the pipe after the writer closed it, unless it is held open
+    _reopen = False
+    # Seconds to wait for data on a held pipe before checking whether to stop
+    _poll_interval = 0.1
+    # Bytes a fingerprint takes in the table, measured with sniffer_bench.py -m, to convert
+    # a memory budget into a number of entries
+    _entry_bytes = 0
+    _columnar_entry_bytes = 225
+    # Parameters reconfigure() changes while records are processed, by the attribute
+    # holding them, None for those the processor handles itself
+    _settings = {'ttl': '_ttl', 'max_entries': '_max_entries', 'max_bytes': '_max_bytes'}
+
+    # Upper bound for a single read from the pipe. Kept a multiple of every record
+    # length so a full read never leaves a partial record behind.
+    chunk_size = 60 * 1024
+
+    def __init__(self, *, pipe_path = "", callback=None, ut_id=0, transport='fifo',
+                 ring_size=16 << 20, capture=None, max_entries=0, max_bytes=0, ttl=0):
         self._pipe = self._create_pipe(pipe_path)
         self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
         self._processing_thread = None
         self._running = False
+        # Callbacks run on worker threads so they never stall ingestion. Pass a Dispatcher
+        # to configure the pool and what happens when the callbacks fall behind.
+        if callback is not None and not isinstance(callback, Dispatcher):
+            callback = Dispatcher(callback, name=f'{self.name}.callback')
         self._callback = callback
         self._ut_id = ut_id
         self._fingerprints = None
+        # Source of the current time, replaced when replaying captured records
+        self._clock = time
         self._last_reported = int(time())
+        self._struct = struct.Struct(self._fmt) if self._fmt else None
+        self._remainder = b''
+        self._columnar = False
+        self._stats = ProcessorStats()
+        # Optional capture.CaptureWriter the raw records are copied to
+        self._capture = capture
+        # Descriptor of the pipe while it is open, to query the bytes waiting in it
+        self._pipe_fd = None
+        # Whether the pipe is held open for writing as well, see start()
+        self._hold = False
+        # Set by writer_exited() until the processing thread drained the pipe
+        self._drained = None
+        # Monotonic time of the last records read, None before the first
+        self._last_data = None
+        # Bounds of the fingerprint table, 0 for none. Enforced between reports, so the
+        # table stays bounded when results are not taken.
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._rotated = time()
+        # Time of suspend() until resume(), and whether the current report interval was
+        # partly suspended, see suspend()
+        self._suspended = None
+        self._interrupted = False
+        # Optional sketch.AdmissionFilter deciding which unknown keys get a fingerprint
+        self._admission = None
+        # Optional history.HistoryPool giving each new fingerprint an RSSI history ring
+        self._history = None
+
+        # Records have to be written to the ring by a producer supporting it, the ubertooth
+        # tools only write to FIFOs.
+        if transport == 'ring':
+            self._ring = RingBuffer(f'{self._pipe}.ring', record_size=self._packet_length,
+                                    capacity=ring_size, create=True)
+        elif transport == 'fifo':
+            self._ring = None
+        else:
+            raise ValueError(f'Unknown transport: {transport}.')
 
     def _create_pipe(self, path: str) -> str:
 
+        # Processors fed by other means than a pipe, e.g. in a worker process
+        if path is None:
+            return None
+
         path = self.default_pipe if not path else path
 
         os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
@@ -154,262 +713,1189 @@ class Processor:
 
         return path
 
-    def start(self):
-        raise NotImplementedError('Method not implemented in base class.')
+    def start(self, *, hold: bool=False):
+        '''Starts reading the pipe on a thread.
+
+        With hold, the pipe is opened for writing as well, so it never reaches EOF when its
+        writer exits and the next writer simply takes over. The reader then keeps going
+        until stop() and the supervisor of the writer calls writer_exited() on restarts.'''
+
+        self._hold = hold
+        self._running = True
+        self._processing_thread = threading.Thread(target=self.process,
+                                                   name=f'{self.name}.processor')
+        self._processing_thread.start()
 
     def process(self):
-        raise NotImplementedError('Method not implemented in base class.')
+        log.debug("Started processing.")
 
-    def stop(self):
-        self._running = False
-        self._processing_thread.join()
+        if self._ring is not None:
+            while self._running:
+                self._ring.consume(self._consume, timeout=1)
+            return
 
-    def __del__(self):
-        self.stop()
+        if self._hold:
+            self._read_held_pipe()
+            return
 
-class BtleAdvProcessor(Processor):
-    default_pipe = 'pipes/btle-adv'
-    name = 'btle-adv'
-    _packet_length = 20
-    _fmt = 'B?6sIiHH'
-    _Packet = namedtuple('Packet', ['type', 'random', 'mac', 'timestamp', 'rssi', 'service_uuid', 'company_id'])
+        while self._running:
+            with open(self._pipe, 'rb', buffering=0) as pipe:
+                self._pipe_fd = pipe.fileno()
+                try:
+                    self._read_pipe(pipe)
+                finally:
+                    self._pipe_fd = None
 
+            if not self._reopen:
+                break
 
-    def __init__(self, *, pipe_path='', callback=None, ut_id=0, seen_for=60):
-        Processor.__init__(self, pipe_path=pipe_path, callback=callback, ut_id=ut_id)
-        self.cmd = f'ubertooth-btle -M {self._pipe} -U {ut_id}'.split(' ')
-        self._fingerprints = defaultdict(BtleAdvFingerprint)
-        self.seen_for = seen_for
+    def _read_pipe(self, pipe) -> int:
+        '''Reads pipe in chunks of up to chunk_size bytes until EOF or until stopped.
 
-    def start(self):
-        self._running = True
-        self._processing_thread = threading.Thread(target=BtleAdvProcessor.process,
-                                                args=[self],
-                                                name=f'{self.name}.processor')
-        self._processing_thread.start()
+        An unbuffered read on a FIFO returns as soon as any data is available, so large
+        chunks do not add latency when traffic is sparse. Returns the number of records read.'''
 
-    def process(self):
-        log.debug("Started processing.")
-        with open(self._pipe, 'rb') as pipe:
+        records = 0
+        while self._running:
+            data = pipe.read(self.chunk_size)
+            if not data:
+                break
+
+            records += self.feed(data)
+
+        self._discard_remainder()
+
+        return records
+
+    def _read_held_pipe(self):
+        '''Reads the pipe opened for reading and writing until stopped. Waits for data in
+        short intervals, so stopping and draining do not depend on the writer.'''
+
+        fd = self._pipe_fd = os.open(self._pipe, os.O_RDWR | os.O_NONBLOCK)
+        try:
             while self._running:
+                if (drained := self._drained) is not None:
+                    self._read_available(fd, drain=True)
+                    self._discard_remainder()
+                    self._drained = None
+                    drained.set()
 
-                try:
-                    packet = pipe.read(self._packet_length)
-                    data = self._Packet._make(struct.unpack(self._fmt, packet))
-                except struct.error:
-                    if not self._running:
-                        break
+                if select.select([fd], [], [], self._poll_interval)[0]:
+                    self._read_available(fd)
+        finally:
+            self._pipe_fd = None
+            os.close(fd)
+
+    def _read_available(self, fd: int, *, drain: bool=False):
+        '''Reads a chunk from the non-blocking descriptor fd, or all it holds with drain.'''
+
+        while True:
+            try:
+                data = os.read(fd, self.chunk_size)
+            except BlockingIOError:
+                return
+
+            self.feed(data)
+            if not drain:
+                return
+
+    def retarget(self, ut_id: int):
+        '''Runs the ubertooth tool on dongle ut_id from its next start. The ut_id reported
+        in the stats stays the one the processor was created with.'''
+        self.cmd = self._cmd_fmt.format(pipe=self._pipe, ut_id=ut_id).split(' ')
+
+    def writer_exited(self, *, timeout: float=1):
+        '''Tells a processor holding its pipe that the writer went away. Returns once the
+        data left in the pipe was read and a trailing partial record dropped, so it is not
+        prepended to the records of the next writer.'''
+
+        if not self._hold or not self._running:
+            return
+
+        drained = self._drained = threading.Event()
+        if not drained.wait(timeout):
+            log.warning('Pipe of %s not drained within %.1f s.', self.name, timeout)
+
+    def _discard_remainder(self):
+        '''Drops a partial record left by a writer that went away.'''
+
+        if self._remainder:
+            log.warning('Discarding %i trailing bytes of an incomplete record.', len(self._remainder))
+            self._remainder = b''
+
+    def feed(self, data: bytes) -> int:
+        '''Decodes all complete records in data and adds them to the fingerprints.
+
+        Bytes of a trailing incomplete record are kept and prepended to the next call.
+        Returns the number of records decoded.'''
+
+        if self._remainder:
+            data = self._remainder + data
+
+        end = len(data) - len(data) % self._packet_length
+        self._remainder = bytes(data[end:])
+
+        if not end:
+            return 0
+
+        self._consume(memoryview(data)[:end])
 
-                    raise
+        return end // self._packet_length
 
-                with self._lock:
-                    if self._fingerprints[data.mac].update(data):
-                        pass#if self._callback: self._callback(self._fingerprints[data.mac])
+    def _consume(self, view: memoryview):
+        '''Decodes and ingests a buffer holding a whole number of records.'''
+
+        if self._capture is not None:
+            self._capture.write(view)
+
+        self._last_data = monotonic()
+        stats = self._stats
+        if not stats.count(len(view) // self._packet_length, len(view)):
+            with self._lock:
+                self._decode(view)
+            return
+
+        start = perf_counter()
+        with self._lock:
+            locked = perf_counter()
+            self._decode(view)
+
+        stats.lock_wait.observe(locked - start)
+        stats.decode.observe(perf_counter() - locked)
+
+    def _decode(self, view: memoryview):
+        '''Hands the records in view to the fingerprint table. Called with the lock held.'''
+
+        if self._admission is not None:
+            self._admission.roll(self._clock())
+
+        if self._ttl and self._clock() - self._rotated >= self._ttl:
+            self._stats.expirations += self._expire_idle()
+
+        if self._columnar:
+            self._ingest_columns(np.frombuffer(view, dtype=self._dtype))
+        else:
+            self._ingest(self._struct.iter_unpack(view))
+
+        # Trim after ingesting, so the table only exceeds the bound by the new fingerprints
+        # of one chunk and a table below it never loses entries
+        if limit := self.max_entries:
+            self._stats.evictions += self._evict(limit)
+
+    def _factory(self, **options):
+        '''Creates fingerprints with the options that are set, the class itself if none are.'''
+
+        if options := {name: value for name, value in options.items() if value}:
+            return partial(self.fingerprint_cls, **options)
+
+        return self.fingerprint_cls
+
+    def _init_table(self, *, columnar=False, quantiles=False, history=None, admit=None,
+                    **options):
+        '''Creates the fingerprint table. It is a ColumnarFingerprints created with options if
+        columnar is set, otherwise a Generation of fingerprints with RSSI quantiles and
+        history rings from the history.HistoryPool if given, admitted by admit.'''
+
+        if columnar and (quantiles or history):
+            raise ValueError('RSSI quantiles and histories are not supported by the columnar '
+                             'store.')
+
+        self._history = history
+
+        if columnar:
+            self._columnar = True
+            self._dtype = np.dtype(self._dtype)
+            self._fingerprints = ColumnarFingerprints(self.fingerprint_cls, **options)
+        else:
+            self._fingerprints = Generation(self._factory(quantiles=quantiles, history=history),
+                                            clock=self._clock, admit=admit)
+
+    def _ingest(self, records):
+        '''Updates the fingerprints with an iterable of unpacked records. Called with the lock held.'''
+        raise NotImplementedError('Method not implemented in base class.')
+
+    def _ingest_columns(self, batch):
+        '''Updates the columnar store with a structured array of records. Called with the lock held.'''
+        raise NotImplementedError('Columnar store not supported by this processor.')
+
+    def _qualifying_rows(self, columns, rows):
+        '''Mask of the rows of the columnar store included in the result.'''
+        raise NotImplementedError('Columnar store not supported by this processor.')
 
     @property
-    def result(self):
+    def result(self) -> list:
+        '''Returns the qualifying fingerprints seen since the last call and drops all others.
+
+        Only swapping the generations happens under the processing lock. The retired
+        generation is no longer written to by the processing thread, and its qualifying
+        fingerprints are already collected, so the result costs O(qualifying fingerprints).'''
+
+        with self._report_lock:
+            if self._columnar:
+                return self._columnar_result()
+
+            with self._lock:
+                self._last_reported = int(self._clock())
+                if self._aging():
+                    retired = self._fingerprints
+                    expired = self._rotate(self._last_reported)
+                    qualified = retired.qualified
+                    if expired is not None:
+                        self._stats.expirations += len(expired)
+                else:
+                    expired = None
+                    qualified, self._fingerprints.qualified = self._fingerprints.qualified, {}
+
+            # Drop the expired generation outside the lock
+            if expired is not None:
+                self._release(expired.qualified)
+                self._release(expired)
+
+            return list(qualified.values())
+
+    def _aging(self) -> bool:
+        '''Whether the report interval ending now was not suspended at any point, so the
+        fingerprints not seen in it may be expired. Called with the lock held.'''
+
+        aging = self._suspended is None and not self._interrupted
+        self._interrupted = self._suspended is not None
+        return aging
+
+    def suspend(self):
+        '''Stops aging the fingerprints while no records can arrive, e.g. while the sniffer is
+        paused, so a mode taking turns on a dongle keeps its devices across its slices.
+
+        Results taken while suspended, and the first one after resume(), report and reset
+        the qualifying fingerprints but neither rotate nor expire the generations. The time
+        suspended does not count towards ttl.'''
+
         with self._lock:
+            if self._suspended is None:
+                self._suspended = self._clock()
+                self._interrupted = True
+
+    def resume(self):
+        with self._lock:
+            if self._suspended is not None:
+                self._rotated += self._clock() - self._suspended
+                self._suspended = None
+
+    def _rotate(self, boundary: int) -> Generation:
+        '''Retires the active generation. Returns the expired generation, which is detached
+        from the retired one. Called with the lock held.'''
+
+        retired = self._fingerprints
+        self._fingerprints = Generation(retired.factory, retired, boundary, self._clock,
+                                        retired.admit)
+        self._rotated = self._clock()
+        expired, retired.previous = retired.previous, None
+
+        return expired
+
+    @staticmethod
+    def _release(mapping: dict, qualified: dict=None, count: int=None):
+        '''Removes count entries, all by default, from a mapping one by one, and their keys
+        from qualified. Freeing a large dict at once holds the GIL for the whole
+        deallocation, which would stall the processing thread.
+
+        A count of entries is removed oldest first, which requires an OrderedDict. When all
+        are removed, they are popped from the end of any mapping.'''
+
+        if count is None:
+            popitem, count = mapping.popitem, len(mapping)
+        else:
+            popitem = partial(mapping.popitem, last=False)
+
+        if qualified is None:
+            for _ in range(count):
+                popitem()
+            return
+
+        pop = qualified.pop
+        for _ in range(count):
+            pop(popitem()[0], None)
+
+    @property
+    def max_entries(self) -> int:
+        '''Most fingerprints kept, given by max_entries or max_bytes, 0 if unbounded.'''
+
+        limits = [self._max_entries] if self._max_entries else []
+        if self._max_bytes:
+            entry = self._columnar_entry_bytes if self._columnar else self._entry_bytes
+            limits.append(max(self._max_bytes // entry, 1))
+
+        return min(limits, default=0)
+
+    def _expire_idle(self) -> int:
+        '''Drops the fingerprints not seen for ttl seconds when results are not taken often
+        enough to expire them. Returns the number dropped. Called with the lock held.'''
 
-            now = int(time())
+        now = self._clock()
+        if self._columnar:
+            self._rotated = now
+            return self._fingerprints.expire(int(now - self._ttl))
 
-            self._fingerprints = defaultdict(BtleAdvFingerprint, { key: value
-                                    for key, value in self._fingerprints.items()
-                                    if value.last_seen >= self._last_reported })
+        return self._age()
 
+    def _age(self) -> int:
+        '''Rotates the generations between reports, dropping the previous generation. The
+        qualifying fingerprints stay pending for the next result. Returns the number of
+        fingerprints dropped. Called with the lock held.'''
+
+        retired = self._fingerprints
+        expired = self._rotate(int(self._clock()))
+        qualified = self._fingerprints.qualified = retired.qualified
+        retired.qualified = {}
+
+        if expired is None:
+            return 0
+
+        dropped = len(expired)
+        self._release(expired, qualified)
+        self._release(expired.qualified)
+
+        return dropped
+
+    def _evict(self, target: int) -> int:
+        '''Drops the fingerprints seen least recently until at most target are kept.
+        Returns the number dropped. Called with the lock held.
+
+        Fingerprints are evicted from the previous generation, all of which were seen less
+        recently than those in the active one. If it runs out, the generations are rotated.
+        Within a generation, fingerprints are evicted in the order they entered it.'''
+
+        fingerprints = self._fingerprints
+        if self._columnar:
+            excess = len(fingerprints) - target
+            if excess <= 0:
+                return 0
+
+            # Finding the oldest rows scans the table, evict ahead to amortize it
+            return fingerprints.evict(max(excess, target // 16))
+
+        evicted = 0
+        while (excess := len(fingerprints) + len(fingerprints.previous or ()) - target) > 0:
+            if not fingerprints.previous:
+                if not fingerprints:
+                    break
+
+                evicted += self._age()
+                fingerprints = self._fingerprints
+                continue
+
+            count = min(excess, len(fingerprints.previous))
+            self._release(fingerprints.previous, fingerprints.qualified, count)
+            evicted += count
+
+        return evicted
+
+    def _columnar_result(self) -> list:
+        table = self._fingerprints
+
+        with self._lock:
+            now = int(self._clock())
+            if self._aging():
+                self._stats.expirations += table.expire(self._last_reported)
             self._last_reported = now
 
-            return [ value
-                    for value in self._fingerprints.values()
-                    if value.last_seen-value.first_seen > self.seen_for]
+            rows = table.live_rows()
+            snapshot = table.snapshot(rows[self._qualifying_rows(table.columns, rows)])
+
+        return table.build(snapshot)
+
+    def set_clock(self, clock):
+        '''Makes the processor take the current time from clock instead of the system clock,
+        e.g. the capture time of replayed records. Call before feeding records.'''
 
-    def __str__(self):
         with self._lock:
-            return '=== BTLE ADVERTISEMENT ===\n' + \
-                '\n'.join(f'{":".join(hex(int(byte)).replace("0x", "") for byte in reversed(k))}'+ \
-                    f': {v}'\
-                     for k, v in self._fingerprints.items() if v.last_seen-v.first_seen > self.seen_for)+ \
-                f'\n{len(self._fingerprints)} results.'
+            self._clock = clock
+            self._last_reported = int(clock())
+            self._rotated = clock()
+            if isinstance(self._fingerprints, Generation):
+                self._fingerprints.clock = clock
 
-class BtleProcessor(Processor):
-    default_pipe = 'pipes/btle'
-    name = 'btle'
-    _packet_length = 12
-    _fmt = 'IIi'
-    _Packet = namedtuple('Packet', ['aa', 'timestamp', 'rssi'])
+    def settings(self) -> dict:
+        '''Returns the current values of the parameters reconfigure() changes.'''
+        return {name: getattr(self, attribute) for name, attribute in self._settings.items()
+                if attribute is not None}
 
-    def __init__(self, *, pipe_path='', callback: Callable=None, seen_threshold=5, ut_id=0):
-        Processor.__init__(self, pipe_path=pipe_path, callback=callback, ut_id=ut_id)
-        self.cmd = f'ubertooth-btle -m {self._pipe} -U {ut_id}'.split(' ')
-        self._fingerprints = defaultdict(BtleFingerprint)
-        self.seen_threshold = seen_threshold
+    def reconfigure(self, **settings) -> dict:
+        '''Changes parameters of a running processor without losing its fingerprints.
 
-    def start(self):
-        self._running = True
-        self._processing_thread = threading.Thread(target=BtleProcessor.process,
-                                                args=[self],
-                                                name=f'{self.name}.processor')
-        self._processing_thread.start()
+        All settings are validated before any is applied, and they are applied together
+        under the processing lock, so no record is processed with only some of them changed.
+        Fingerprints qualifying for the next result are selected again with the new
+        criteria. Returns the previous values of the settings given.
 
-    def process(self):
-        log.debug("Started processing.")
+        Raises ValueError for unknown parameters and invalid values.'''
 
-        with open(self._pipe, 'rb') as pipe:
-            while self._running:
+        self._validate(settings)
 
-                try:
-                    packet = pipe.read(self._packet_length)
-                    data = self._Packet._make(struct.unpack(self._fmt, packet))
-                except struct.error:
-                    if not self._running:
-                        break
+        with self._report_lock, self._lock:
+            previous = {name: value for name, value in self.settings().items()
+                        if name in settings}
+            self._apply(settings)
 
-                    raise
+        log.info('Reconfigured %s: %s.', self.name, ', '.join(
+            f'{name} {previous[name]} -> {value}' for name, value in settings.items()))
+
+        return previous
+
+    @classmethod
+    def _validate(cls, settings: dict):
+        for name, value in settings.items():
+            if name not in cls._settings:
+                raise ValueError(f'{cls.name} has no parameter {name}.')
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f'{name} has to be a number of at least 0, not {value!r}.')
+
+    def _apply(self, settings: dict):
+        '''Sets validated parameters. Called with the lock held.'''
+
+        for name, value in settings.items():
+            setattr(self, self._settings[name], value)
+
+        if self._columnar:
+            return
+
+        # Only fingerprints seen since the last report can be part of the next one, those in
+        # the previous generation are selected when their next record arrives
+        fingerprints = self._fingerprints
+        qualified = {key: fingerprint for key, fingerprint in fingerprints.qualified.items()
+                     if self._qualifies(fingerprint)}
+        qualified.update((key, fingerprint) for key, fingerprint in fingerprints.items()
+                         if self._qualifies(fingerprint))
+        fingerprints.qualified = qualified
+
+    def _qualifies(self, fingerprint) -> bool:
+        '''Whether fingerprint is included in the result, like the check in _ingest.'''
+        return True
+
+    def _tracked(self):
+        '''Returns all fingerprints currently kept, reported or not.'''
 
-                with self._lock:
-                    if self._fingerprints[data.aa].update(data) >= self.seen_threshold:
-                        pass#if self._callback: self._callback(self._fingerprints[data.aa])
-    @property
-    def result(self):
         with self._lock:
-            now = int(time())
+            if self._columnar:
+                return dict(self._fingerprints.items())
 
-            self._fingerprints = defaultdict(BtleFingerprint, { key: value
-                                    for key, value in self._fingerprints.items()
-                                    if value.last_seen >= self._last_reported })
+            return {**(self._fingerprints.previous or {}), **self._fingerprints}
 
-            self._last_reported = now
+    def stats(self) -> dict:
+        '''Returns the hot path counters together with the current size of the fingerprint
+        table and of the data and callbacks waiting to be processed.'''
+
+        return {
+            'processor': self.name,
+            'ut_id': self._ut_id,
+            **self._stats.to_dict(),
+            'table_size': self._table_size(),
+            'pending_bytes': self._pending_bytes(),
+            'callback_queue': len(self._callback) if self._callback is not None else 0,
+            'callbacks_dropped': self._callback.dropped if self._callback is not None else 0,
+            'filtered': self._admission.rejected if self._admission is not None else 0,
+            'history_bytes': self._history.nbytes if self._history is not None else 0,
+        }
+
+    def _notify(self, key, fingerprint):
+        '''Queues a copy of fingerprint for the callback, as the original keeps changing.'''
+        self._callback.submit(key, fingerprint.from_record(fingerprint.to_record()))
+
+    def _notify_rows(self, rows):
+        '''Queues the fingerprints in rows of the columnar store for the callback.'''
+
+        for fingerprint in self._fingerprints.export(rows):
+            self._callback.submit(getattr(fingerprint, self._fingerprints._key_field), fingerprint)
 
-            return [ value
-                    for value in self._fingerprints.values()
-                    if value.times_seen >= self.seen_threshold ]
+    def _table_size(self) -> int:
+        '''Number of fingerprints in the table.'''
+
+        fingerprints = self._fingerprints
+        if fingerprints is None:
+            return 0
+
+        if self._columnar:
+            return len(fingerprints)
+
+        return len(fingerprints) + len(fingerprints.previous or ())
+
+    def _pending_bytes(self) -> int:
+        '''Bytes written to the FIFO or ring buffer and not yet read.'''
+
+        if self._ring is not None:
+            return self._ring.backlog
+
+        if (fd := self._pipe_fd) is None:
+            return 0
+
+        try:
+            return struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0' * 4))[0]
+        except OSError:
+            return 0
+
+    def stop(self):
+        self._running = False
+        if self._processing_thread:
+            self._processing_thread.join()
+
+        if self._callback is not None:
+            self._callback.close()
+
+    def __del__(self):
+        self.stop()
+
+class BtleAdvProcessor(Processor):
+    default_pipe = 'pipes/btle-adv'
+    name = 'btle-adv'
+    _cmd_fmt = 'ubertooth-btle -M {pipe} -U {ut_id}'
+    fingerprint_cls = BtleAdvFingerprint
+    _entry_bytes = 370
+    _settings = {**Processor._settings, 'seen_for': 'seen_for'}
+    _packet_length = 20
+    # Type, random flag and MAC unpacked as one integer, see _Packet
+    _fmt = '=QIiHH'
+    _key_offset, _key_size = 2, 6
+
+    class _Packet(namedtuple('Packet', ['head', 'timestamp', 'rssi', 'service_uuid', 'company_id'])):
+        '''Record whose first 8 bytes, type, random flag and MAC, are unpacked as the
+        little-endian integer head. The MAC, the key of the table, is its upper 48 bits, so
+        no bytes object is created per record. Only created for records that are not of a
+        fingerprint in the active generation, see _ingest.'''
+
+        __slots__ = ()
+
+        type = property(lambda self: self.head & 0xff)
+        random = property(lambda self: bool(self.head >> 8 & 0xff))
+        mac = property(lambda self: self.head >> 16)
+
+    # Same layout as the records with the MAC split into its low 16 and high 32 bits
+    _dtype = [('type', 'u1'), ('random', '?'), ('mac_lo', '=u2'), ('mac_hi', '=u4'),
+              ('timestamp', '=u4'), ('rssi', '=i4'), ('service_uuid', '=u2'), ('company_id', '=u2')]
+
+    def __init__(self, *, pipe_path='', callback=None, ut_id=0, seen_for=60, columnar=False,
+                 transport='fifo', ring_size=16 << 20, capture=None, max_entries=0,
+                 max_bytes=0, ttl=0, quantiles=False, history=None):
+        Processor.__init__(self, pipe_path=pipe_path, callback=callback, ut_id=ut_id,
+                           transport=transport, ring_size=ring_size, capture=capture,
+                           max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.cmd = self._cmd_fmt.format(pipe=self._pipe, ut_id=ut_id).split(' ')
+        self.seen_for = seen_for
+
+        self._init_table(columnar=columnar, quantiles=quantiles, history=history,
+                         key_field='mac', static_fields=[('type', 'u1'), ('random', '?'),
+                                                         ('service_uuid', 'u2'),
+                                                         ('company_id', 'u2')])
+
+    def _ingest(self, records):
+        '''Most records are of devices in the active generation. Their fields are taken from
+        the unpacked tuple, only the other records are wrapped in a _Packet.'''
+
+        fingerprints = self._fingerprints
+        qualified = fingerprints.qualified
+        get = fingerprints.get
+        seen_for = self.seen_for
+        for record in records:
+            mac = record[0] >> 16
+            if (fingerprint := get(mac)) is not None:
+                fingerprint.observe(record[1], record[2])
+            else:
+                data = self._Packet._make(record)
+                if not (fingerprint := fingerprints.take(mac, data)):
+                    continue
+
+                # New device
+                if fingerprint.update(data) and self._callback is not None:
+                    self._notify(mac, fingerprint)
+
+            if fingerprint.last_seen - fingerprint.first_seen > seen_for:
+                qualified[mac] = fingerprint
+
+    def _ingest_columns(self, batch):
+        macs = batch['mac_lo'].astype(np.uint64) | (batch['mac_hi'].astype(np.uint64) << 16)
+        rows, seen = self._fingerprints.update(macs, batch['timestamp'], batch['rssi'],
+                                               {name: batch[name] for name in
+                                                ['type', 'random', 'service_uuid', 'company_id']},
+                                               now=int(self._clock()))
+
+        if self._callback is not None:
+            self._notify_rows(rows[seen == 0])
+
+    def _qualifying_rows(self, columns, rows):
+        return columns['last_seen'][rows] - columns['first_seen'][rows] > self.seen_for
+
+    def _qualifies(self, fingerprint) -> bool:
+        return fingerprint.last_seen - fingerprint.first_seen > self.seen_for
 
     def __str__(self):
-        with self._lock:
-            return '=== BTLE ===\n'+'\n'.join(f'{k:06x}: {v}' \
-                for k, v in self._fingerprints.items()\
-                if v.times_seen >= self.seen_threshold)+f'\n{len(self._fingerprints)} results.'
+        fingerprints = self._tracked()
+        return '=== BTLE ADVERTISEMENT ===\n' + \
+            '\n'.join(f'{mac_int_to_str(k)}: {v}'
+                 for k, v in fingerprints.items() if v.last_seen-v.first_seen > self.seen_for)+ \
+            f'\n{len(fingerprints)} results.'
+
+class BtleProcessor(Processor):
+    default_pipe = 'pipes/btle'
+    name = 'btle'
+    _cmd_fmt = 'ubertooth-btle -m {pipe} -U {ut_id}'
+    fingerprint_cls = BtleFingerprint
+    _entry_bytes = 280
+    # admit is the count of an AdmissionFilter, 0 for none, and admit_window its window
+    _settings = {**Processor._settings, 'seen_threshold': 'seen_threshold', 'admit': None,
+                 'admit_window': None}
+    _packet_length = 12
+    _fmt = 'IIi'
+    _key_offset, _key_size = 0, 4
+    _Packet = namedtuple('Packet', ['aa', 'timestamp', 'rssi'])
+    _dtype = [('aa', '=u4'), ('timestamp', '=u4'), ('rssi', '=i4')]
+
+    def __init__(self, *, pipe_path='', callback: Callable=None, seen_threshold=5, ut_id=0,
+                 columnar=False, transport='fifo', ring_size=16 << 20, capture=None,
+                 max_entries=0, max_bytes=0, ttl=0, admission=None, quantiles=False,
+                 history=None):
+        Processor.__init__(self, pipe_path=pipe_path, callback=callback, ut_id=ut_id,
+                           transport=transport, ring_size=ring_size, capture=capture,
+                           max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.cmd = self._cmd_fmt.format(pipe=self._pipe, ut_id=ut_id).split(' ')
+        self.seen_threshold = seen_threshold
+        # Most decoded access addresses are bit errors that are never seen again
+        self._admission = admission
+
+        self._init_table(columnar=columnar, quantiles=quantiles, history=history,
+                         admit=admission, key_field='aa')
+
+    @property
+    def _threshold(self) -> int:
+        '''Records of a fingerprint after which it qualifies. The admission filter drops the
+        first admit - 1 records of an address before its fingerprint is created, and they
+        count towards seen_threshold.'''
+
+        if self._admission is None:
+            return self.seen_threshold
+
+        return max(self.seen_threshold - (self._admission.count - 1), 1)
+
+    def _ingest(self, records):
+        fingerprints = self._fingerprints
+        qualified = fingerprints.qualified
+        threshold = self._threshold
+        for data in map(self._Packet._make, records):
+            if not (fingerprint := fingerprints.get(data.aa) or fingerprints.take(data.aa, data)):
+                continue
+
+            if (times_seen := fingerprint.update(data)) >= threshold:
+                qualified[data.aa] = fingerprint
+
+                # Crossed the threshold
+                if times_seen == threshold and self._callback is not None:
+                    self._notify(data.aa, fingerprint)
+
+    def _ingest_columns(self, batch):
+        rows, seen = self._fingerprints.update(batch['aa'], batch['timestamp'], batch['rssi'],
+                                               now=int(self._clock()),
+                                               admit=self._admission and self._admission.admit_many)
+
+        if self._callback is not None:
+            threshold = self._threshold
+            crossed = (seen < threshold) & \
+                      (self._fingerprints.columns['times_seen'][rows] >= threshold)
+            self._notify_rows(rows[crossed])
+
+    def _qualifying_rows(self, columns, rows):
+        return columns['times_seen'][rows] >= self._threshold
+
+    def _qualifies(self, fingerprint) -> bool:
+        return fingerprint.times_seen >= self._threshold
+
+    def settings(self) -> dict:
+        admission = self._admission
+        return {**Processor.settings(self),
+                'seen_threshold': self.seen_threshold,
+                'admit': admission.count if admission is not None else 0,
+                'admit_window': admission.window if admission is not None else None}
+
+    @classmethod
+    def _validate(cls, settings: dict):
+        super()._validate(settings)
+
+        if settings.get('seen_threshold', 1) < 1:
+            raise ValueError('seen_threshold has to be at least 1.')
+
+    def _apply(self, settings: dict):
+        settings = dict(settings)
+        admission = self._admission
+        admit = settings.pop('admit', admission.count if admission is not None else 0)
+        window = settings.pop('admit_window', None)
+
+        # The counts of an existing filter are kept, so admitted keys do not start over
+        if not admit:
+            admission = None
+        elif admission is None:
+            admission = AdmissionFilter(admit) if window is None else \
+                AdmissionFilter(admit, window=window)
+        else:
+            admission.count = admit
+            if window is not None:
+                admission.window = window
+
+        self._admission = admission
+        if not self._columnar:
+            self._fingerprints.admit = admission
+
+        Processor._apply(self, settings)
+
+    def __str__(self):
+        fingerprints = self._tracked()
+        return '=== BTLE ===\n'+'\n'.join(f'{k:06x}: {v}' \
+            for k, v in fingerprints.items()\
+            if v.times_seen >= self._threshold)+f'\n{len(fingerprints)} results.'
 
 class BtbrProcessor(Processor):
     default_pipe = 'pipes/btbr'
     name = 'btbr'
+    _cmd_fmt = 'ubertooth-rx -m {pipe} -U {ut_id}'
+    fingerprint_cls = BtbrFingerprint
+    _entry_bytes = 250
     _packet_length = 12
     _fmt = 'HBII'
+    _key_offset, _key_size = 4, 4
     _Packet = namedtuple('Packet', ['flags', 'uap', 'lap', 'timestamp'])
-
-    def __init__(self, *, pipe_path='', callback: Callable=None, ut_id: int=0, seen_for: int=60):
-        Processor.__init__(self, pipe_path=pipe_path, ut_id=ut_id)
-        self.cmd = f'ubertooth-rx -m {self._pipe} -U {ut_id}'.split(' ')
-        self._fingerprints = defaultdict(BtbrFingerprint)
-        self._callback = callback
+    _reopen = True
+    _settings = {**Processor._settings, 'seen_for': 'seen_for'}
+
+    def __init__(self, *, pipe_path='', callback: Callable=None, ut_id: int=0, seen_for: int=60,
+                 transport='fifo', ring_size=16 << 20, capture=None, max_entries=0,
+                 max_bytes=0, ttl=0):
+        Processor.__init__(self, pipe_path=pipe_path, callback=callback, ut_id=ut_id,
+                           transport=transport, ring_size=ring_size, capture=capture,
+                           max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.cmd = self._cmd_fmt.format(pipe=self._pipe, ut_id=ut_id).split(' ')
+        self._init_table()
         self.seen_for = seen_for
 
-    def start(self):
-        self._running = True
-        self._processing_thread = threading.Thread(target=BtbrProcessor.process,
-                                                args=[self],
-                                                name=f'{self.name}.processor')
+    def _ingest(self, records):
+        fingerprints = self._fingerprints
+        qualified = fingerprints.qualified
+        for data in map(self._Packet._make, records):
+            if not (fingerprint := fingerprints.get(data.lap) or fingerprints.take(data.lap, data)):
+                continue
 
-        self._processing_thread.start()
+            # New device
+            if fingerprint.update(data) and self._callback is not None:
+                self._notify(data.lap, fingerprint)
 
-    def process(self):
-        log.debug("Started processing.")
-        while self._running:
-            with open(self._pipe, 'rb') as pipe:
-                while self._running:
+            if fingerprint.last_seen - fingerprint.first_seen > self.seen_for:
+                qualified[data.lap] = fingerprint
 
-                    try:
-                        packet = pipe.read(self._packet_length)
-                        data = self._Packet._make(struct.unpack(self._fmt, packet))
-                    except struct.error:
-                        break
+    def _qualifies(self, fingerprint) -> bool:
+        return fingerprint.last_seen - fingerprint.first_seen > self.seen_for
 
-                    with self._lock:
-                        if self._fingerprints[data.lap].update(data):
-                            pass#if self._callback: self._callback(self._fingerprints[data.lap])
+    def __str__(self):
+        fingerprints = self._tracked()
+        return '=== BTBR ===\n' + \
+            '\n'.join(f'{k:06x}: {v}' for k, v in fingerprints.items()) + \
+            f'\n{len(fingerprints)} results.'
+
+class Supervisor:
+    '''Decides when the subprocess of a sniffer is restarted and keeps restart metrics.
+
+    A subprocess is restarted when it exits, or when no data arrived for stall_timeout
+    seconds while it ran, which catches a wedged ubertooth tool that stays alive. A restart
+    right after one that brought no data is delayed by backoff seconds, doubling with every
+    further one up to max_backoff, so a broken dongle is not restarted in a tight loop. Once
+    data arrives, the next restart is immediate again.
+
+    The downtime of an outage runs from the last data before the first restart to the first
+    data after the last one. It is measured when check() is called, so to within the
+    interval the caller polls at.
+
+    Positional arguments:\n
+    processor -- the processor reading the output of the subprocess\n
+
+    Keyword arguments:\n
+    stall_timeout -- seconds without data after which the subprocess is restarted, 0 to
+    only restart it when it exits\n
+    backoff -- delay before the second of consecutive restarts in seconds\n
+    max_backoff -- longest delay before a restart in seconds\n
+    clock -- source of monotonic time'''
+
+    def __init__(self, processor: 'Processor', *, stall_timeout: float=0, backoff: float=0.5,
+                 max_backoff: float=30, clock=monotonic):
+        self._processor = processor
+        self.stall_timeout = stall_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self.restarts = 0
+        self.stalls = 0
+        self.downtime = Histogram(DOWNTIME_BUCKETS)
+        # Consecutive restarts without data in between
+        self._failures = 0
+        self._started = clock()
+        # Time of the last data before an ongoing outage
+        self._outage = None
+
+    def started(self):
+        '''Called whenever the subprocess was started.'''
+        self._started = self._clock()
+
+    def _received(self) -> bool:
+        '''Whether data arrived since the subprocess was last started.'''
+        return (last := self._processor._last_data) is not None and last >= self._started
+
+    def check(self) -> bool:
+        '''Records the downtime of an outage that ended. Returns whether the subprocess
+        stalled and should be restarted.'''
+
+        if self._outage is not None and self._received():
+            self.downtime.observe(self._processor._last_data - self._outage)
+            self._outage = None
+
+        if not self.stall_timeout:
+            return False
+
+        last = self._processor._last_data
+        quiet_since = self._started if last is None else max(last, self._started)
+        return self._clock() - quiet_since >= self.stall_timeout
+
+    def restart(self, *, stalled: bool=False) -> float:
+        '''Records a restart after the subprocess exited, failed to start or stalled.
+        Returns the seconds to wait before starting it again.'''
+
+        self.restarts += 1
+        self.stalls += stalled
+
+        if self._received():
+            self._failures = 0
+
+        if self._outage is None:
+            last = self._processor._last_data
+            self._outage = self._started if last is None else last
+
+        delay = min(self.backoff * 2 ** (self._failures - 1), self.max_backoff) \
+            if self._failures else 0
+        self._failures += 1
+
+        return delay
+
+    def to_dict(self) -> dict:
+        return {
+            'restarts': self.restarts,
+            'stalls': self.stalls,
+            'downtime_seconds': self.downtime.to_dict(),
+            'outage_seconds': self._clock() - self._outage if self._outage is not None else 0,
+        }
+
+class AsyncRuntime:
+    '''Runs the subprocesses and pipe readers of any number of sniffers on one asyncio event
+    loop in a single thread, instead of a watcher and a processing thread per sniffer.
+
+    Child exits are noticed as soon as they happen. Pipes are opened read-write, so the
+    reader never sees EOF while a child restarts (Linux FIFO semantics). Stalls and backoff
+    are handled by the Supervisor of each sniffer.'''
 
-    @property
-    def result(self):
-        with self._lock:
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._tasks = {}
 
-            now = int(time())
+    def add(self, sniffer):
+        '''Starts the subprocess of sniffer and reading its pipe.'''
 
-            self._fingerprints = defaultdict(BtbrFingerprint, { key: value
-                                    for key, value in self._fingerprints.items()
-                                    if value.last_seen >= self._last_reported
-            })
+        if sniffer._processor._ring is not None:
+            raise ValueError('The asyncio runtime only supports the fifo transport.')
 
-            self._last_reported = now
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop.run_forever, name='sniffers',
+                                            daemon=True)
+            self._thread.start()
 
-            return [ value
-                    for value in self._fingerprints.values()
-                    if value.last_seen-value.first_seen > self.seen_for]
+        asyncio.run_coroutine_threadsafe(self._add(sniffer), self._loop).result()
 
-    def __str__(self):
-        with self._lock:
-            return '=== BTBR ===\n' + \
-                '\n'.join(f'{k:06x}: {v}' for k, v in self._fingerprints.items()) + \
-                f'\n{len(self._fingerprints)} results.'
+    def remove(self, sniffer):
+        '''Terminates the subprocess of sniffer and stops reading its pipe.'''
+        asyncio.run_coroutine_threadsafe(self._remove(sniffer), self._loop).result()
+
+    def close(self):
+        for sniffer in list(self._tasks):
+            self.remove(sniffer)
+
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+        self._loop.close()
+
+    async def _add(self, sniffer):
+        stopping = asyncio.Event()
+        self._tasks[sniffer] = stopping, self._loop.create_task(self._supervise(sniffer, stopping))
+
+    async def _remove(self, sniffer):
+        stopping, task = self._tasks.pop(sniffer)
+        stopping.set()
+        await task
+
+    async def _supervise(self, sniffer, stopping: asyncio.Event):
+        processor = sniffer._processor
+        supervisor = sniffer.supervisor
+        fd = processor._pipe_fd = os.open(processor._pipe, os.O_RDWR | os.O_NONBLOCK)
+        self._loop.add_reader(fd, processor._read_available, fd)
+
+        try:
+            while not stopping.is_set():
+                try:
+                    process = await asyncio.create_subprocess_exec(*processor.cmd)
+                except OSError as error:
+                    log.error('Unable to start %s: %s', processor.cmd[0], error)
+                    await self._wait(stopping, max(supervisor.restart(), 1))
+                    continue
+
+                supervisor.started()
+                stalled = False
+                exited = asyncio.ensure_future(process.wait())
+                stop = asyncio.ensure_future(stopping.wait())
+                while not (exited.done() or stop.done()):
+                    await asyncio.wait({exited, stop}, timeout=sniffer.poll_interval,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not (exited.done() or stop.done()) and (stalled := supervisor.check()):
+                        break
+
+                if stopping.is_set():
+                    await self._terminate(process)
+                    break
+
+                stop.cancel()
+                if stalled:
+                    log.warning('No data for %.1f s. Restarting...', supervisor.stall_timeout)
+                    await self._terminate(process)
+                else:
+                    log.warning('Process exited unexpectedly with code %i. Restarting...',
+                                process.returncode)
+
+                # Anything the child wrote is already in the pipe, a partial record is garbage
+                processor._read_available(fd, drain=True)
+                processor._discard_remainder()
+
+                if delay := supervisor.restart(stalled=stalled):
+                    log.debug('Waiting %.1f s before restarting.', delay)
+                    await self._wait(stopping, delay)
+        finally:
+            self._loop.remove_reader(fd)
+            processor._pipe_fd = None
+            os.close(fd)
+
+    @staticmethod
+    async def _wait(stopping: asyncio.Event, delay: float):
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stopping.wait(), delay)
+
+    @staticmethod
+    async def _terminate(process):
+        if process.returncode is None:
+            try:
+                process.terminate()
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                log.warning('Process did not stop normally, killing...')
+                process.kill()
+                await process.wait()
+            except ProcessLookupError:
+                pass
+
+        log.debug('Process exited with code %i', process.returncode)
 
 class Sniffer:
+    '''Runs the ubertooth tool of a processor as a subprocess and restarts it when it exits
+    or stalls, see Supervisor.
+
+    A sniffer on threads can be paused, which terminates the subprocess and frees its dongle
+    while the processor and its fingerprints stay alive, and resumed on any dongle. The
+    fingerprints do not age while paused, see Processor.suspend. The share of time the
+    subprocess was meant to run is reported as its duty cycle.
 
-    def __init__(self, *, processor: Processor):
+    Keyword arguments:\n
+    processor -- the processor reading the output of the subprocess\n
+    runtime -- AsyncRuntime to run on, by default a watcher and a processing thread\n
+    stall_timeout, backoff, max_backoff -- see Supervisor'''
+
+    # Seconds between checks of the subprocess
+    poll_interval = 0.25
+
+    def __init__(self, *, processor: Processor, runtime: AsyncRuntime=None,
+                 stall_timeout: float=0, backoff: float=0.5, max_backoff: float=30):
         self._processor = processor
+        self._runtime = runtime
         self._running  = False
+        self._stopping = threading.Event()
         self._sniff_thread = None
         self._watcher_thread = None
+        self.supervisor = Supervisor(processor, stall_timeout=stall_timeout, backoff=backoff,
+                                     max_backoff=max_backoff)
+        # Set while the subprocess should run, cleared by pause()
+        self._active = threading.Event()
+        # Set while no subprocess is running
+        self._idle = threading.Event()
+        self._idle.set()
+        # Monotonic times of start() and of the last resume, seconds active before it
+        self._started_at = None
+        self._active_since = None
+        self._active_seconds = 0.0
+
+    def start(self, *, paused: bool=False):
+        '''Starts the processor and, unless paused, the subprocess.'''
 
-    def start(self):
         log.debug('Starting sniffer %s.', self._processor.name)
         self._running = True
+        self._stopping.clear()
+        self._started_at = monotonic()
+        if not paused:
+            self._active_since = self._started_at
+            self._active.set()
+
+        if self._runtime:
+            if paused:
+                raise ValueError('Only sniffers running on threads can be paused.')
+
+            self._runtime.add(self)
+            return
+
         self._watcher_thread = threading.Thread(target=Sniffer._watch_subprocess,
                                                args=[self],
                                                name=f'{self._processor.name}.watcher')
         self._watcher_thread.start()
 
-        self._processor.start()
+        self._processor.start(hold=True)
 
     def stop(self):
         log.debug('Stopping sniffer %s.', self._processor.name)
 
         self._running = False
+        self._stopping.set()
+
+        if self._runtime:
+            self._runtime.remove(self)
+            # Nothing is read on a processing thread, but the callback pool has to be closed
+            self._processor.stop()
+            return
 
         self._processor.stop()
         self._watcher_thread.join()
 
+    def pause(self, *, timeout: float=10):
+        '''Terminates the subprocess and keeps it from restarting until resume(). Returns
+        once it exited, so its dongle is free for another sniffer.'''
+
+        if self._runtime:
+            raise ValueError('Only sniffers running on threads can be paused.')
+
+        if not self._active.is_set():
+            return
+
+        self._active.clear()
+        self._active_seconds += monotonic() - self._active_since
+        self._active_since = None
+        self._processor.suspend()
+
+        if not self._idle.wait(timeout):
+            log.warning('Subprocess of %s did not exit within %.1f s.', self._processor.name,
+                        timeout)
+
+    def resume(self, ut_id: int=None):
+        '''Starts the subprocess of a paused sniffer again, on dongle ut_id if given.'''
+
+        if self._runtime:
+            raise ValueError('Only sniffers running on threads can be paused.')
+
+        if self._active.is_set():
+            return
+
+        if ut_id is not None:
+            self._processor.retarget(ut_id)
+
+        self._processor.resume()
+        self._active_since = monotonic()
+        self._active.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._active.is_set()
+
     def _watch_subprocess(self):
-        process = subprocess.Popen(args=self._processor.cmd)
+        supervisor = self.supervisor
 
-        while True:
-            # Process exited
-            if (exit_code := process.poll()) is not None:
-                # Should be running
-                if self._running:
-                    log.warning('Process exited unexpectedly with code %i. Restarting...',
-                                exit_code)
-                    process = subprocess.Popen(args=self._processor.cmd)
-                # Should not be running
-                else:
-                    log.debug('Process exited with code %i', exit_code)
+        while self._running:
+            if not self._active.is_set():
+                self._active.wait(self.poll_interval)
+                continue
+
+            try:
+                process = subprocess.Popen(args=self._processor.cmd)
+            except OSError as error:
+                log.error('Unable to start %s: %s', self._processor.cmd[0], error)
+                self._stopping.wait(max(supervisor.restart(), 1))
+                continue
+
+            self._idle.clear()
+            supervisor.started()
+            stalled = False
+            while self._running and self._active.is_set():
+                with suppress(subprocess.TimeoutExpired):
+                    process.wait(timeout=self.poll_interval)
+
+                if process.returncode is not None or (stalled := supervisor.check()):
                     break
 
-            else:
-                # Should terminate
-                if not self._running:
-                    try:
-                        process.terminate()
-                        process.communicate(timeout=5)
-                        log.debug('Process exited with code %i', process.returncode)
-                    except subprocess.TimeoutExpired:
-                        log.warning('Process did not stop normally, killing...')
-                        process.kill()
-                        log.debug('Process exited with code %i', process.poll())
+            paused = not self._active.is_set()
+            if not self._running or paused or stalled:
+                self._terminate(process)
+            self._idle.set()
 
-                    break
+            if not self._running:
+                break
 
-            sleep(1)
+            self._processor.writer_exited()
+            if paused:
+                log.debug('Paused sniffer %s.', self._processor.name)
+                continue
+
+            if stalled:
+                log.warning('No data for %.1f s. Restarting...', supervisor.stall_timeout)
+            else:
+                log.warning('Process exited unexpectedly with code %i. Restarting...',
+                            process.returncode)
+
+            if delay := supervisor.restart(stalled=stalled):
+                log.debug('Waiting %.1f s before restarting.', delay)
+                self._stopping.wait(delay)
+
+    @staticmethod
+    def _terminate(process):
+        if process.poll() is None:
+            try:
+                process.terminate()
+                process.communicate(timeout=5)
+            except subprocess.TimeoutExpired:
+                log.warning('Process did not stop normally, killing...')
+                process.kill()
+                process.wait()
+
+        log.debug('Process exited with code %i', process.returncode)
 
     result = property(lambda self: self._processor.result)
 
+    def stats(self) -> dict:
+        '''Returns the counters of the processor, see Processor.stats, of the restarts of the
+        subprocess, see Supervisor, and the time the subprocess was meant to run.'''
+
+        now = monotonic()
+        active = self._active_seconds
+        if (since := self._active_since) is not None:
+            active += now - since
+        elapsed = now - self._started_at if self._started_at is not None else 0
+
+        return {**self._processor.stats(), **self.supervisor.to_dict(),
+                'active_seconds': active, 'duty_cycle': active / elapsed if elapsed else 0.0}
+
     def __str__(self):
         return str(self._processor)
 
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3.8
+
+import argparse
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import types
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from collections import namedtuple
+from sniffer import BtbrProcessor, BtleProcessor, BtleAdvProcessor, mac_bytes_to_str, mac_int_to_str
+from sharding import ShardedProcessor
+from ringbuffer import RingBuffer
+from loadgen import MODES, RecordGenerator, write_paced
+from sketch import AdmissionFilter
+
+PROCESSORS = {
+    'btbr': BtbrProcessor,
+    'btle': BtleProcessor,
+    'btle-adv': BtleAdvProcessor,
+}
+
+def generate_records(mode: str, count: int, *, addresses: int=1000, seed: int=0,
+                     **generator) -> bytes:
+    '''Generates count binary records in the format ubertooth-rx/ubertooth-btle writes for
+    mode, see loadgen.RecordGenerator for the options.'''
+
+    return bytes(RecordGenerator(mode, addresses=addresses, seed=seed, **generator).records(count))
+
+def _legacy_process(processor):
+    '''Per-record read loop as used before the chunked reader, kept for comparison.'''
+
+    with open(processor._pipe, 'rb') as pipe:
+        while processor._running:
+            try:
+                packet = pipe.read(processor._packet_length)
+                data = struct.unpack(processor._fmt, packet)
+            except struct.error:
+                break
+
+            with processor._lock:
+                processor._ingest((data,))
+
+def _chunked_process(processor):
+    '''Single pass of Processor.process. BtbrProcessor would otherwise reopen the pipe after EOF.'''
+
+    with open(processor._pipe, 'rb', buffering=0) as pipe:
+        processor._read_pipe(pipe)
+
+def _ring_process(processor, length: int):
+    '''Consumes the ring buffer of processor until length bytes went through it.'''
+
+    while processor._ring.tail < length:
+        processor._ring.consume(processor._consume, timeout=0.1)
+
+def _ring_write(path: str, data: bytes, write_size: int):
+    '''Writes data into the ring buffer at path like a producer would, retrying records
+    dropped because the buffer was full so every transport processes the same records.'''
+
+    ring = RingBuffer(path)
+    view = memoryview(data)
+    # The ring only takes whole records
+    write_size -= write_size % ring.record_size
+    for i in range(0, len(data), write_size):
+        chunk = view[i:i+write_size]
+        while chunk:
+            chunk = chunk[ring.write(chunk) * ring.record_size:]
+
+    ring.close()
+
+def replay(mode: str, data: bytes, *, legacy: bool=False, write_size: int=4096,
+           workers: int=0, transport: str='fifo', **options) -> float:
+    '''Writes data through a FIFO or ring buffer into a fresh processor created with options,
+    sharded over worker processes if workers is given. Returns records per second.'''
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'pipe')
+        if workers:
+            processor = ShardedProcessor(PROCESSORS[mode], workers=workers, pipe_path=path,
+                                         transport=transport, **options)
+        else:
+            processor = PROCESSORS[mode](pipe_path=path, transport=transport, **options)
+
+        processor._running = True
+        if transport == 'ring':
+            target, arguments = _ring_process, [processor, len(data)]
+        else:
+            target, arguments = _legacy_process if legacy else _chunked_process, [processor]
+
+        reader = threading.Thread(target=target, args=arguments, name=f'{mode}.bench')
+        reader.start()
+
+        start = perf_counter()
+        if transport == 'ring':
+            _ring_write(processor._ring.path, data, write_size)
+        else:
+            with open(processor._pipe, 'wb') as pipe:
+                for i in range(0, len(data), write_size):
+                    pipe.write(data[i:i+write_size])
+
+        reader.join()
+        if workers:
+            # Round trip to the workers, which returns once they processed all records
+            processor.result
+
+        elapsed = perf_counter() - start
+        processor.stop()
+        if processor._ring is not None:
+            processor._ring.close()
+
+    return len(data) / processor._packet_length / elapsed
+
+@contextmanager
+def _reading(mode: str, **options):
+    '''Creates a processor on a FIFO in a temporary directory and reads the FIFO on a
+    thread until the writer closes it.'''
+
+    with tempfile.TemporaryDirectory() as directory:
+        processor = PROCESSORS[mode](pipe_path=os.path.join(directory, 'pipe'), **options)
+        processor._running = True
+        reader = threading.Thread(target=_chunked_process, args=[processor], name=f'{mode}.bench')
+        reader.start()
+
+        try:
+            yield processor
+        finally:
+            reader.join()
+            processor.stop()
+
+def _sustains(mode: str, rate: float, duration: float, generator: dict, options: dict) -> bool:
+    '''Whether a processor keeps up with the stand-in writing at rate for duration seconds.
+
+    The stand-in runs in its own process, like ubertooth-btle would. Writes to the FIFO
+    block once its buffer is full, so a processor that falls behind makes the stand-in
+    write fewer records before its time is up.'''
+
+    with _reading(mode, **options) as processor:
+        subprocess.run(_stand_in(mode, processor._pipe, rate, duration, generator), check=True,
+                       stderr=subprocess.DEVNULL)
+
+    return processor._stats.records >= 0.95 * rate * duration
+
+def _stand_in(mode: str, pipe: str, rate: float, duration: float, generator: dict) -> list:
+    '''Command line of loadgen.py writing to pipe.'''
+
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadgen.py'),
+            mode, pipe, f'--rate={rate}', f'--duration={duration}',
+            *[f'--{name}={value}' for name, value in generator.items()]]
+
+def sustainable_rate(mode: str, *, duration: float=2, start: float=10000, steps: int=4,
+                     generator: dict={}, **options) -> float:
+    '''Finds the highest rate a processor keeps up with by doubling the rate from start
+    until it falls behind and bisecting the last interval steps times.'''
+
+    low, high = 0, start
+    while _sustains(mode, high, duration, generator, options):
+        low, high = high, high * 2
+
+    for _ in range(steps):
+        rate = (low + high) / 2
+        if _sustains(mode, rate, duration, generator, options):
+            low = rate
+        else:
+            high = rate
+
+    return low
+
+def ingest_latency(mode: str, rate: float, *, duration: float=2, generator: dict={},
+                   **options) -> list:
+    '''Writes records at rate for duration seconds and returns, for each batch written,
+    the seconds until the processor ingested its last record.'''
+
+    records = RecordGenerator(mode, rate=rate, **generator)
+    records.preload(int(rate * duration) + int(rate))
+
+    written = []
+    ingested = []
+
+    with _reading(mode, **options) as processor:
+        consume = processor._consume
+
+        def timed_consume(view):
+            consume(view)
+            ingested.append((processor._stats.records, perf_counter()))
+
+        processor._consume = timed_consume
+
+        with open(processor._pipe, 'wb', buffering=0) as pipe:
+            write_paced(pipe, records, rate, duration=duration,
+                        on_batch=lambda total: written.append((total, perf_counter())))
+
+    latencies = []
+    chunk = 0
+    for total, sent in written:
+        while ingested[chunk][0] < total:
+            chunk += 1
+        latencies.append(ingested[chunk][1] - sent)
+
+    return latencies
+
+def _dict_fingerprint_cls(fingerprint_cls):
+    '''Copy of a fingerprint class keeping its attributes in an instance dict, as they were
+    before the classes used slots. Kept for comparison.'''
+
+    namespace = {}
+    for cls in reversed(fingerprint_cls.__mro__[:-1]):
+        namespace.update((name, value) for name, value in vars(cls).items()
+                         if name != '__slots__' and
+                            not isinstance(value, types.MemberDescriptorType))
+
+    return type(f'Dict{fingerprint_cls.__name__}', (), namespace)
+
+def memory_per_fingerprint(mode: str, addresses: int, *, legacy: bool=False, **options) -> float:
+    '''Returns the bytes allocated per fingerprint when a processor tracks addresses distinct
+    fingerprints, including the fingerprint tables. With legacy, the fingerprints keep
+    their attributes in an instance dict.'''
+
+    data = generate_records(mode, addresses, addresses=addresses, sequential=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        processor = PROCESSORS[mode](pipe_path=os.path.join(directory, 'pipe'), **options)
+
+    if legacy:
+        processor._fingerprints.factory = _dict_fingerprint_cls(processor.fingerprint_cls)
+
+    chunk = 4096 * processor._packet_length
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(0, len(data), chunk):
+            processor.feed(data[i:i+chunk])
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return (after - before) / processor.stats()['table_size']
+
+def admission_cost(records: int, *, addresses: int, noise: float, admit: int=0,
+                   **options) -> tuple:
+    '''Feeds btle records, a fraction noise of them with one-off access addresses, through a
+    processor admitting addresses after admit occurrences, or without a filter if admit is 0.
+
+    Returns the records ingested per second, the fingerprints in the table and the bytes the
+    processor allocated, including the sketch.'''
+
+    data = generate_records('btle', records, addresses=addresses, noise=noise)
+    chunk = 4096 * BtleProcessor._packet_length
+
+    def create():
+        with tempfile.TemporaryDirectory() as directory:
+            return BtleProcessor(pipe_path=os.path.join(directory, 'pipe'),
+                                 admission=AdmissionFilter(admit) if admit else None, **options)
+
+    processor = create()
+    start = perf_counter()
+    for i in range(0, len(data), chunk):
+        processor.feed(data[i:i+chunk])
+    rate = records / (perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        processor = create()
+        for i in range(0, len(data), chunk):
+            processor.feed(data[i:i+chunk])
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return rate, processor.stats()['table_size'], allocated
+
+_BytesPacket = namedtuple('Packet', ['type', 'random', 'mac', 'timestamp', 'rssi', 'service_uuid',
+                                     'company_id'])
+
+def mac_key_cost(records: int, *, addresses: int, reports: int=10) -> dict:
+    '''Micro-benchmark of the btle-adv hot path with MACs unpacked as 6 byte strings, as
+    before, and as integers. Times decoding the records and looking up their fingerprint
+    key, and formatting the MACs of all addresses reports times, like periodic reporting.
+
+    Returns records and formatted MACs per second for each variant.'''
+
+    data = generate_records('btle-adv', records, addresses=addresses)
+    unpack_bytes = struct.Struct(MODES['btle-adv']).iter_unpack
+    unpack_int = struct.Struct(BtleAdvProcessor._fmt).iter_unpack
+    Packet = BtleAdvProcessor._Packet
+
+    def decode_bytes():
+        table = {}
+        for packet in map(_BytesPacket._make, unpack_bytes(data)):
+            if table.get(packet.mac) is None:
+                table[packet.mac] = packet
+        return table
+
+    def decode_int():
+        # Like BtleAdvProcessor._ingest, only records of unknown keys get a Packet
+        table = {}
+        for record in unpack_int(data):
+            mac = record[0] >> 16
+            if table.get(mac) is None:
+                table[mac] = Packet._make(record)
+        return table
+
+    results = {}
+    for name, decode, format_mac in [('bytes', decode_bytes, mac_bytes_to_str),
+                                     ('int', decode_int, mac_int_to_str)]:
+        start = perf_counter()
+        keys = list(decode())
+        decoded = perf_counter() - start
+
+        start = perf_counter()
+        for _ in range(reports):
+            for key in keys:
+                format_mac(key)
+        formatted = perf_counter() - start
+
+        results[name] = records / decoded, reports * len(keys) / formatted
+
+    return results
+
+def result_cost(mode: str, rate: float, *, duration: float=5, interval: float=0.5,
+                generator: dict={}, **options) -> tuple:
+    '''Calls result every interval seconds while records arrive at rate. Returns the
+    durations of the result calls and the average rate at which records were ingested,
+    which falls below rate if result stalls ingestion.'''
+
+    durations = []
+
+    with _reading(mode, **options) as processor:
+        stand_in = subprocess.Popen(_stand_in(mode, processor._pipe, rate, duration, generator),
+                                    stderr=subprocess.DEVNULL)
+
+        while stand_in.poll() is None:
+            sleep(interval)
+            before = perf_counter()
+            processor.result
+            durations.append(perf_counter() - before)
+
+    return durations, processor._stats.records / duration
+
+def _percentile(values: list, percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+def run_suite(mode: str, *, rate: float, addresses: int, generator: dict, options: dict):
+    '''Prints the sizing figures of a processor.'''
+
+    generator = {'addresses': addresses, **generator}
+
+    sustainable = sustainable_rate(mode, generator=generator, **options)
+    print(f'{mode:>8}: sustainable {sustainable:12,.0f} rec/s')
+
+    latencies = ingest_latency(mode, rate, generator=generator, **options)
+    print(f'{"":>8}  latency at {rate:,.0f} rec/s  p50 {_percentile(latencies, 50)*1e3:7.2f} ms  '
+          f'p99 {_percentile(latencies, 99)*1e3:7.2f} ms  max {max(latencies)*1e3:7.2f} ms')
+
+    for count in (10000, 100000):
+        memory = memory_per_fingerprint(mode, count, **options)
+        print(f'{"":>8}  memory with {count:>7,} fingerprints  {memory:7.0f} B/fingerprint')
+
+    durations, ingested = result_cost(mode, rate, generator=generator, **options)
+    print(f'{"":>8}  result at {rate:,.0f} rec/s  median {statistics.median(durations)*1e3:7.2f} ms  '
+          f'max {max(durations)*1e3:7.2f} ms  ingested {ingested:12,.0f} rec/s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sniffer processor throughput benchmark.')
+    parser.add_argument('modes', type=str, nargs='*', default=list(PROCESSORS),
+                        help='Processors to benchmark. One or more of btbr, btle, btle-adv.')
+    parser.add_argument('-n', '--records', type=int, default=500000,
+                        help='Number of records to replay.')
+    parser.add_argument('-a', '--addresses', type=int, default=1000,
+                        help='Number of distinct addresses in the generated records.')
+    parser.add_argument('-c', '--columnar', action='store_true',
+                        help='Also benchmark the columnar fingerprint store (requires numpy).')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Also benchmark processors sharded over this many worker processes.')
+    parser.add_argument('-r', '--ring', action='store_true',
+                        help='Also benchmark the memory-mapped ring buffer transport.')
+    parser.add_argument('-m', '--memory', action='store_true',
+                        help='Measure memory per fingerprint at 10k, 100k and 1M fingerprints, '
+                             'with and without slots.')
+    parser.add_argument('-s', '--suite', action='store_true',
+                        help='Measure sustainable rate, ingest latency, memory per fingerprint '
+                             'and result cost instead of raw throughput.')
+    parser.add_argument('-f', '--admission', type=int, default=0,
+                        help='Compare btle without and with an admission filter admitting '
+                             'addresses seen this many times, on records with --noise.')
+    parser.add_argument('-k', '--mac-keys', action='store_true',
+                        help='Micro-benchmark btle-adv MAC keys as bytes and as integers.')
+    parser.add_argument('--noise', type=float, default=0.5,
+                        help='Fraction of records with one-off addresses for --admission.')
+    parser.add_argument('--rate', type=float, default=50000,
+                        help='Records per second for the latency and result cost measurements.')
+    parser.add_argument('--rssi', type=str, default='gauss',
+                        help='RSSI distribution of the generated records.')
+    parser.add_argument('--skew', type=float, default=0,
+                        help='Maximum deviation of generated timestamps in seconds.')
+
+    args = parser.parse_args()
+
+    if args.memory:
+        for mode in args.modes:
+            for count in (10000, 100000, 1000000):
+                legacy = memory_per_fingerprint(mode, count, legacy=True)
+                slots = memory_per_fingerprint(mode, count)
+                print(f'{mode:>8}: {count:>9,} fingerprints  dict {legacy:6.0f} B  '
+                      f'slots {slots:6.0f} B  saved {1 - slots/legacy:4.0%}', end='')
+
+                if args.columnar and mode != 'btbr':
+                    columnar = memory_per_fingerprint(mode, count, columnar=True)
+                    print(f'  columnar {columnar:6.0f} B', end='')
+
+                print()
+        sys.exit(0)
+
+    if args.admission:
+        options = {'columnar': True} if args.columnar else {}
+        for admit in (0, args.admission):
+            rate, fingerprints, allocated = admission_cost(args.records, addresses=args.addresses,
+                                                           noise=args.noise, admit=admit, **options)
+            print(f'    btle: {"admit " + str(admit) if admit else "no filter":>9}  '
+                  f'{rate:12,.0f} rec/s  {fingerprints:>9,} fingerprints  '
+                  f'{allocated / 2**20:8.1f} MiB')
+        sys.exit(0)
+
+    if args.mac_keys:
+        for name, (decoded, formatted) in mac_key_cost(args.records,
+                                                       addresses=args.addresses).items():
+            print(f'btle-adv: {name:>5} keys  decode {decoded:12,.0f} rec/s  '
+                  f'format {formatted:12,.0f} MAC/s')
+        sys.exit(0)
+
+    if args.suite:
+        for mode in args.modes:
+            options = {'columnar': True} if args.columnar and mode != 'btbr' else {}
+            run_suite(mode, rate=args.rate, addresses=args.addresses,
+                      generator={'rssi': args.rssi, 'skew': args.skew}, options=options)
+        sys.exit(0)
+
+    for mode in args.modes:
+        records = generate_records(mode, args.records, addresses=args.addresses)
+        legacy = replay(mode, records, legacy=True)
+        chunked = replay(mode, records)
+        print(f'{mode:>8}: per-record {legacy:12,.0f} rec/s  chunked {chunked:12,.0f} rec/s  '
+              f'speedup {chunked/legacy:5.2f}x', end='')
+
+        if args.columnar and mode != 'btbr':
+            columnar = replay(mode, records, columnar=True)
+            print(f'  columnar {columnar:12,.0f} rec/s  speedup {columnar/legacy:5.2f}x', end='')
+
+        if args.ring:
+            ring = replay(mode, records, transport='ring')
+            print(f'  ring {ring:12,.0f} rec/s  speedup {ring/legacy:5.2f}x', end='')
+
+        if args.workers:
+            sharded = replay(mode, records, workers=args.workers)
+            print(f'  {args.workers} workers {sharded:12,.0f} rec/s  speedup {sharded/legacy:5.2f}x', end='')
+
+        print()
@@ -0,0 +1,794 @@
+import struct
+import sys
+import threading
+from time import perf_counter, sleep, time
+import pytest
+import sniffer
+from dispatch import Dispatcher
+from sketch import AdmissionFilter
+from loadgen import MODES
+from history import HistoryPool
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+def btbr_record(flags: int, uap: int, lap: int, timestamp: int) -> bytes:
+    return struct.pack(sniffer.BtbrProcessor._fmt, flags, uap, lap, timestamp)
+
+def btle_adv_record(mac: int, timestamp: int, rssi: int, *, random=True,
+                    service_uuid=0xfd6f, company_id=0x4c) -> bytes:
+    return struct.pack(MODES['btle-adv'], 0, random, mac.to_bytes(6, 'little'), timestamp, rssi,
+                       service_uuid, company_id)
+
+@pytest.fixture
+def pipe_path(tmp_path):
+    return str(tmp_path / 'pipes' / 'pipe')
+
+
+class TestChunkedReader:
+    def test_feed_handles_split_records(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+        data = b''.join(btle_record(0x8e89bed6, 1000+i, -60-i) for i in range(10))
+
+        # Split at positions that are not multiples of the record length
+        assert processor.feed(data[:5]) == 0, 'No complete record in first chunk'
+        assert processor.feed(data[5:31]) == 2, 'Two complete records expected'
+        assert processor.feed(data[31:]) == 8, 'Remaining records expected'
+
+        fingerprint = processor._fingerprints[0x8e89bed6]
+        assert fingerprint.times_seen == 10, 'All records should have been ingested'
+        assert fingerprint.last_seen == 1009, 'Last timestamp should be used'
+        assert fingerprint.rssi == -69, 'Last rssi should be used'
+
+    def test_feed_decodes_all_formats(self, pipe_path):
+        btbr = sniffer.BtbrProcessor(pipe_path=pipe_path)
+        btbr.feed(btbr_record(0b1, 0x42, 0x9e8b33, 1000) + btbr_record(0, 0, 0x123456, 1001))
+        assert btbr._fingerprints[0x9e8b33].uap == 0x42, 'UAP not decoded'
+        assert btbr._fingerprints[0x123456].last_seen == 1001, 'Timestamp not decoded'
+
+        mac = 0x060504030201
+        adv = sniffer.BtleAdvProcessor(pipe_path=pipe_path)
+        adv.feed(btle_adv_record(mac, 1000, -70))
+        fingerprint = adv._fingerprints[mac]
+        assert fingerprint.service_uuid == 0xfd6f, 'Service UUID not decoded'
+        assert fingerprint.company_id == 0x4c, 'Company id not decoded'
+        assert fingerprint.rssi == -70, 'RSSI not decoded'
+        assert (fingerprint.mac, fingerprint.random) == (mac, True), 'MAC or random flag not decoded'
+        assert sniffer.mac_int_to_str(mac) == '06:05:04:03:02:01' == \
+            sniffer.mac_bytes_to_str(mac.to_bytes(6, 'little')), 'MAC formatted differently'
+
+    def test_process_reads_fifo_until_eof(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+        records = 50000
+        data = b''.join(btle_record(i % 100, 1000, -50) for i in range(records))
+
+        processor.start()
+        with open(pipe_path, 'wb') as pipe:
+            # Odd write sizes so records straddle reads
+            for i in range(0, len(data), 4097):
+                pipe.write(data[i:i+4097])
+
+        processor._processing_thread.join(timeout=10)
+        assert not processor._processing_thread.is_alive(), 'Processor did not stop at EOF'
+        processor.stop()
+
+        assert sum(fp.times_seen for fp in processor._fingerprints.values()) == records, \
+            'Records lost while reading in chunks'
+
+
+class TestFingerprints:
+    @pytest.mark.parametrize('fingerprint_cls', [sniffer.BtbrFingerprint, sniffer.BtleFingerprint,
+                                                 sniffer.BtleAdvFingerprint])
+    def test_no_instance_dict(self, fingerprint_cls):
+        fingerprint = fingerprint_cls(1000)
+        assert not hasattr(fingerprint, '__dict__'), 'Fingerprints should only use slots'
+        assert fingerprint.first_seen == 1000 and fingerprint.last_seen == 0, 'Not initialized'
+
+    def test_statistics_survive_slots(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+        processor.feed(btle_record(1, 1000, -70) + btle_record(1, 1001, -74))
+
+        fingerprint = processor._fingerprints[1]
+        copy = fingerprint.from_record(fingerprint.to_record())
+        assert (copy.mean, copy.std, copy.count) == (-72, 2, 2), 'Statistics lost'
+
+
+class TestRunningStats:
+    def test_no_drift(self):
+        # A large offset makes a naive sum of squares lose all precision
+        values = [1e6 + (i % 7) for i in range(100000)]
+        stats = sniffer.RunningStats()
+        for value in values:
+            stats.update(value)
+
+        # Exact, the variance does not depend on the offset
+        offsets = [i % 7 for i in range(100000)]
+        mean = sum(offsets) / len(offsets)
+        variance = sum((v - mean) ** 2 for v in offsets) / len(offsets)
+        assert stats.mean - 1e6 == pytest.approx(mean, abs=1e-6), 'Mean drifted'
+        assert stats.variance == pytest.approx(variance, rel=1e-9), 'Variance drifted'
+
+    def test_merged_parts_match_whole(self):
+        values = [-70 + (i * 37) % 23 for i in range(1000)]
+        whole = sniffer.RunningStats()
+        for value in values:
+            whole.update(value)
+
+        merged = sniffer.RunningStats()
+        for start in range(0, len(values), 300):
+            part = sniffer.RunningStats()
+            part.update_many(values[start:start+300])
+            merged.merge(part)
+        merged.merge(sniffer.RunningStats())
+
+        assert merged.count == whole.count, 'Values lost while merging'
+        assert merged.mean == pytest.approx(whole.mean, rel=1e-12), 'Merged mean differs'
+        assert merged.std == pytest.approx(whole.std, rel=1e-12), 'Merged std differs'
+
+    def test_update_many_with_numpy(self):
+        np = pytest.importorskip('numpy')
+        stats = sniffer.RunningStats()
+        stats.update(-60)
+        stats.update_many(np.array([-70, -80], dtype=np.int32))
+        stats.update_many(np.array([], dtype=np.int32))
+
+        assert (stats.count, stats.mean) == (3, -70), 'Wrong count or mean'
+        assert stats.variance == pytest.approx(200 / 3), 'Wrong variance'
+
+
+class TestQuantiles:
+    def test_median_and_iqr(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, quantiles=True)
+        # An outlier moves the mean but not the median
+        processor.feed(b''.join(btle_record(1, 1000, rssi)
+                                for rssi in [-60, -62, -64, -66] * 5 + [-99]))
+
+        fingerprint = processor._fingerprints[1]
+        assert fingerprint.median == pytest.approx(-64, abs=1), 'Wrong median'
+        assert fingerprint.iqr == pytest.approx(4, abs=1), 'Wrong interquartile range'
+
+        copy = fingerprint.from_record(fingerprint.to_record())
+        assert (copy.median, copy.iqr) == (fingerprint.median, fingerprint.iqr), \
+            'Digest lost in record'
+
+    def test_disabled_by_default(self, pipe_path):
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path)
+        processor.feed(btle_adv_record(0, 1000, -70))
+
+        fingerprint = processor._fingerprints[0]
+        assert fingerprint.median is None and fingerprint.iqr is None, 'No digest expected'
+        assert fingerprint.from_record(fingerprint.to_record()).digest is None, \
+            'Record should not create a digest'
+
+    def test_not_supported_by_columnar_store(self, pipe_path):
+        pytest.importorskip('numpy')
+        with pytest.raises(ValueError):
+            sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True, quantiles=True)
+
+
+class TestHistory:
+    def test_result_has_history(self, pipe_path):
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, seen_for=0,
+                                             history=HistoryPool(length=8, interval=10))
+        processor.set_clock(lambda: 1000)
+        processor.feed(b''.join(btle_adv_record(1, timestamp, rssi) for timestamp, rssi in
+                                [(1000, -60), (1005, -62), (1011, -70), (1031, -66)]))
+
+        fingerprint, = processor.result
+        assert fingerprint.history.samples() == [-61, -70, None, -66], 'Wrong history'
+
+        copy = fingerprint.from_record(fingerprint.to_record())
+        assert copy.history.encode() == fingerprint.history.encode(), 'History lost in record'
+
+    def test_budget_across_devices(self, pipe_path):
+        pool = HistoryPool(length=16)
+        pool.max_bytes = 10 * pool.ring_bytes
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, history=pool)
+        processor.feed(b''.join(btle_record(aa, 1000, -50) for aa in range(20)))
+
+        fingerprints = processor._tracked().values()
+        assert sum(fp.history is not None for fp in fingerprints) == 10, 'Budget not enforced'
+        assert processor.stats()['history_bytes'] == 10 * pool.ring_bytes, 'Wrong memory'
+
+    def test_not_columnar(self, pipe_path):
+        with pytest.raises(ValueError):
+            sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True, history=HistoryPool())
+
+
+class TestColumnarFingerprints:
+    def records(self, count: int):
+        np = pytest.importorskip('numpy')
+        rng = np.random.default_rng(1)
+        aas = rng.integers(0, 50, count)
+        rssis = rng.integers(-90, -40, count)
+        return [(int(aa), 1000 + i // 100, int(rssi)) for i, (aa, rssi) in enumerate(zip(aas, rssis))]
+
+    def test_btle_matches_dict_store(self, pipe_path):
+        records = self.records(5000)
+        data = b''.join(btle_record(*record) for record in records)
+
+        reference = sniffer.BtleProcessor(pipe_path=pipe_path)
+        columnar = sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True)
+        reference.feed(data)
+        # Several batches so rows are merged with previous state
+        for i in range(0, len(data), 1200):
+            columnar.feed(data[i:i+1200])
+
+        assert len(columnar._fingerprints) == len(reference._fingerprints), 'Wrong number of rows'
+        for aa, expected in reference._fingerprints.items():
+            actual = columnar._fingerprints[aa]
+            assert actual.times_seen == expected.times_seen, 'times_seen differs'
+            assert actual.last_seen == expected.last_seen, 'last_seen differs'
+            assert actual.rssi == expected.rssi, 'rssi differs'
+            assert actual.mean == pytest.approx(expected.mean), 'mean differs'
+            assert actual.std == pytest.approx(expected.std), 'std differs'
+
+    def test_btle_adv_result_returns_fingerprints(self, pipe_path):
+        pytest.importorskip('numpy')
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, seen_for=-1, columnar=True)
+        mac = 0x008368fdf5ef
+        processor.feed(btle_adv_record(mac, 2**31, -70) + btle_adv_record(mac, 2**31, -74))
+
+        results = processor.result
+        assert len(results) == 1, 'One fingerprint expected'
+        assert isinstance(results[0], sniffer.BtleAdvFingerprint), 'Wrong fingerprint type'
+        assert results[0].mac == mac, 'MAC not preserved'
+        assert results[0].mean == -72 and results[0].std == 2, 'Wrong statistics'
+        assert results[0].company_id == 0x4c and results[0].random, 'Static fields not preserved'
+
+    def test_expired_rows_are_reused(self, pipe_path):
+        pytest.importorskip('numpy')
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1, columnar=True)
+        processor.feed(btle_record(1, 0, -50) + btle_record(2, 2**31, -50))
+
+        assert [fp.aa for fp in processor.result] == [2], 'Stale row should have expired'
+        processor.feed(btle_record(3, 2**31, -50))
+        assert processor._fingerprints.size == 2, 'Expired row should have been reused'
+        assert sorted(fp.aa for fp in processor._fingerprints.values()) == [2, 3], 'Wrong live rows'
+
+
+class TestGenerations:
+    def test_unseen_fingerprints_expire_after_one_interval(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        processor.feed(btle_record(1, now, -50) + btle_record(2, now, -50))
+        assert sorted(fp.aa for fp in processor.result) == [1, 2], 'Both should be reported'
+
+        processor.feed(btle_record(2, now+1, -60))
+        first = {fp.aa: fp for fp in processor.result}
+        assert list(first) == [2], 'Only fingerprints seen since the last report expected'
+        assert first[2].times_seen == 2, 'Fingerprint state should survive the report'
+
+        assert processor.result == [], 'Nothing seen since the last report'
+        processor.feed(btle_record(2, now+2, -60))
+        assert processor.result[0].times_seen == 1, 'Expired fingerprint should start over'
+
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_suspended_mode_keeps_devices_across_slices(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+
+        # One of three modes taking turns on a dongle in slices of 30 s, reported every 15 s
+        clock = Clock(0)
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, seen_for=60, columnar=columnar)
+        processor.set_clock(clock)
+        reported = []
+        for now in range(900):
+            clock.now = now
+            if now % 90 == 0:
+                processor.resume()
+            elif now % 90 == 30:
+                processor.suspend()
+
+            if now % 90 < 30:
+                processor.feed(btle_adv_record(0xabc, now, -60))
+            if now % 15 == 0:
+                reported += [fp.last_seen for fp in processor.result]
+
+        assert 0xabc in processor._tracked(), 'Device expired while its mode was suspended'
+        assert reported and reported[0] < 180, 'Device seen across slices not reported'
+        assert processor.stats()['expirations'] == 0, 'Nothing should have expired'
+
+    def test_report_does_not_stall_ingestion(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(300000)))
+        processor.result
+        processor.feed(b''.join(btle_record(aa, now+10, -50) for aa in range(300000)))
+
+        chunk = b''.join(btle_record(aa, now+20, -50) for aa in range(100))
+        pauses = []
+        stop = threading.Event()
+
+        def ingest():
+            last = perf_counter()
+            while not stop.is_set():
+                processor.feed(chunk)
+                now = perf_counter()
+                pauses.append(now - last)
+                last = now
+
+        # Switch threads often so pauses reflect lock contention rather than GIL scheduling
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(0.0001)
+        try:
+            ingester = threading.Thread(target=ingest)
+            ingester.start()
+            sleep(0.05)
+
+            start = perf_counter()
+            results = processor.result
+            duration = perf_counter() - start
+            sleep(0.05)
+
+            stop.set()
+            ingester.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        assert len(results) == 300000, 'All fingerprints should have been reported'
+        assert max(pauses) < duration / 2, \
+            f'Ingestion paused {max(pauses)*1000:.1f} ms during a {duration*1000:.1f} ms report'
+
+
+class TestLastSeenIndex:
+    def test_out_of_order_timestamps(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, seen_for=5)
+        mac = 0
+        processor.feed(btle_adv_record(mac, now+10, -50) + btle_adv_record(mac, now+3, -50))
+
+        fingerprint = processor._fingerprints[mac]
+        assert fingerprint.last_seen == now+10, 'last_seen must not move backwards'
+        assert processor.result == [fingerprint], 'Fingerprint qualifies on its latest timestamp'
+
+    def test_late_records_do_not_extend_lifetime(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        processor.feed(btle_record(1, now-5, -50) + btle_record(2, now-5, -50))
+        processor.result
+
+        # Burst of records from before the report, plus one current record
+        processor.feed(btle_record(1, now-4, -50) * 3 + btle_record(2, now+1, -50))
+        assert [fp.aa for fp in processor.result] == [2], 'Late records must not be reported again'
+        assert list(processor._tracked()) == [2], 'Fingerprint seen only late should have expired'
+
+    def test_result_skips_unqualified(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=3)
+        processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(1000)) +
+                       btle_record(7, now, -50) * 2)
+
+        assert [fp.aa for fp in processor.result] == [7], 'Only the repeated address qualifies'
+        assert len(processor._tracked()) == 1000, 'Unqualified fingerprints are still tracked'
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class TestBoundedTables:
+    def test_evicts_least_recently_seen(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, max_entries=100)
+        processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(100)))
+        processor.result
+
+        processor.feed(b''.join(btle_record(aa, now+1, -50) for aa in range(50, 100)))
+        processor.feed(b''.join(btle_record(aa, now+1, -50) for aa in range(1000, 1020)))
+
+        # The table is trimmed after each chunk, oldest first, so only stale entries are dropped
+        tracked = processor._tracked()
+        assert set(tracked) == set(range(20, 100)) | set(range(1000, 1020)), \
+            'Recently seen fingerprints were evicted'
+        assert processor.stats()['evictions'] == 20, 'Evictions not counted'
+
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_full_chunks_below_bound(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, columnar=columnar,
+                                          max_entries=1000)
+        chunk = b''.join(btle_record(aa, now, -50) for aa in range(100)) * 51
+        for _ in range(3):
+            processor.feed(chunk)
+
+        assert processor.stats()['evictions'] == 0, 'Table below max_entries was evicted'
+        assert {fp.times_seen for fp in processor._tracked().values()} == {153}, \
+            'Fingerprints lost their counts'
+
+    def test_evicts_in_insertion_order(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, max_entries=3)
+        for aa in [0xa, 0xb, 0xc, 0xd]:
+            processor.feed(btle_record(aa, now, -50))
+
+        assert set(processor._tracked()) == {0xb, 0xc, 0xd}, 'Oldest fingerprint not evicted'
+
+        for aa in [0xe, 0xf]:
+            processor.feed(btle_record(aa, now, -50))
+
+        assert set(processor._tracked()) == {0xd, 0xe, 0xf}, 'Not evicted oldest first'
+
+    def test_bounded_without_results(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1, max_entries=10)
+        for aa in range(100):
+            processor.feed(btle_record(aa, now + aa, -50))
+            assert len(processor._tracked()) <= 10, 'Table exceeded max_entries'
+
+        results = [fp.aa for fp in processor.result]
+        assert 99 in results, 'Newest fingerprint should be kept'
+        assert set(results) <= set(range(90, 100)), 'Evicted fingerprints must not be reported'
+        assert processor.stats()['evictions'] == 90, 'Evictions not counted'
+
+    def test_byte_budget(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path,
+                                          max_bytes=10 * sniffer.BtleProcessor._entry_bytes)
+        assert processor.max_entries == 10, 'Budget not converted to entries'
+
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, max_entries=5, max_bytes=1 << 20)
+        assert processor.max_entries == 5, 'The tighter bound applies'
+
+    def test_ttl_drops_idle_fingerprints(self, pipe_path):
+        clock = Clock(1000)
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1, ttl=10)
+        processor.set_clock(clock)
+        processor.feed(btle_record(1, 1000, -50) + btle_record(2, 1000, -50))
+
+        for now in [1011, 1022]:
+            clock.now = now
+            processor.feed(btle_record(2, now, -50))
+
+        assert list(processor._tracked()) == [2], 'Idle fingerprint should have expired'
+        assert [fp.aa for fp in processor.result] == [2], 'Expired fingerprint reported'
+        assert processor.stats()['expirations'] == 1, 'Expiration not counted'
+
+    def test_columnar_evicts_oldest_rows(self, pipe_path):
+        pytest.importorskip('numpy')
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True, max_entries=100)
+        for start in range(0, 200, 10):
+            processor.feed(b''.join(btle_record(aa, 1000 + aa, -50)
+                                    for aa in range(start, start + 10)))
+
+        tracked = processor._tracked()
+        assert len(tracked) <= 100, 'Table exceeded max_entries'
+        assert min(tracked) >= 100 and 199 in tracked, 'Oldest rows should be evicted'
+        assert len(tracked) + processor.stats()['evictions'] == 200, 'Evictions not counted'
+
+    def test_columnar_ttl(self, pipe_path):
+        pytest.importorskip('numpy')
+        clock = Clock(1000)
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True, ttl=10)
+        processor.set_clock(clock)
+        processor.feed(btle_record(1, 1000, -50) + btle_record(2, 1000, -50))
+
+        clock.now = 1011
+        processor.feed(btle_record(2, 1011, -50))
+
+        assert list(processor._tracked()) == [2], 'Idle row should have expired'
+
+
+class TestAdmission:
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_one_off_addresses_get_no_fingerprint(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1,
+                                          columnar=columnar, admission=AdmissionFilter(3))
+        processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(1000, 1100)) +
+                       btle_record(1, now, -50) * 2)
+        processor.feed(btle_record(1, now, -50) * 2)
+
+        assert list(processor._tracked()) == [1], 'Only the repeated address should be admitted'
+        assert processor._tracked()[1].times_seen == 2, 'Records from admission on are counted'
+        assert processor.stats()['filtered'] == 102, 'Filtered records not counted'
+
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_filtered_records_count_towards_threshold(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=5,
+                                          columnar=columnar, admission=AdmissionFilter(3))
+        processor.feed(btle_record(1, now, -50) * 2 + btle_record(2, now, -50) * 4)
+        processor.feed(btle_record(1, now, -50) * 3 + btle_record(2, now, -50))
+
+        assert sorted((fp.aa, fp.times_seen) for fp in processor.result) == [(1, 3), (2, 3)], \
+            'Addresses seen seen_threshold times should qualify'
+
+        processor.feed(btle_record(3, now, -50) * 4)
+        assert 3 not in [fp.aa for fp in processor.result], 'Address seen fewer times qualified'
+
+    def test_known_addresses_bypass_the_filter(self, pipe_path):
+        now = int(time())
+        admission = AdmissionFilter(2, window=10)
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1,
+                                          admission=admission)
+        processor.feed(btle_record(1, now, -50) * 2)
+        processor.result
+
+        # Counts are cleared, the fingerprint in the previous generation is still known
+        admission.sketch.reset()
+        processor.feed(btle_record(1, now + 1, -50))
+        assert [fp.times_seen for fp in processor.result] == [2], 'Known address was filtered'
+
+
+class TestReconfigure:
+    def test_threshold_applies_to_kept_fingerprints(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=5)
+        processor.feed(btle_record(1, now, -50) * 3 + btle_record(2, now, -50) * 6)
+
+        assert processor.reconfigure(seen_threshold=3) == {'seen_threshold': 5}, \
+            'Previous value not returned'
+        assert sorted(fp.aa for fp in processor.result) == [1, 2], \
+            'Kept fingerprints not selected with the new threshold'
+
+        processor.feed(btle_record(1, now + 1, -50) + btle_record(2, now + 1, -50))
+        processor.reconfigure(seen_threshold=8)
+        processor.feed(btle_record(2, now + 1, -50))
+        assert [(fp.aa, fp.times_seen) for fp in processor.result] == [(2, 8)], \
+            'Counts lost or unqualified fingerprint reported'
+
+    def test_invalid_settings_change_nothing(self, pipe_path):
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, seen_for=60, ttl=10)
+
+        for settings in [{'seen_for': 30, 'seen_threshold': 3}, {'ttl': 5, 'seen_for': -1},
+                         {'seen_for': '30'}]:
+            with pytest.raises(ValueError):
+                processor.reconfigure(**settings)
+
+        assert processor.settings() == {'ttl': 10, 'max_entries': 0, 'max_bytes': 0,
+                                        'seen_for': 60}, 'Settings partially applied'
+
+    def test_admission_filter(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        processor.reconfigure(admit=2, admit_window=0)
+        processor.feed(btle_record(1, now, -50) + btle_record(2, now, -50) * 2)
+        assert list(processor._tracked()) == [2], 'Admission filter not enabled'
+
+        admission = processor._admission
+        processor.reconfigure(admit=3)
+        assert processor._admission is admission, 'Counts of the filter should be kept'
+        processor.feed(btle_record(1, now, -50) * 2)
+        assert sorted(processor._tracked()) == [1, 2], 'Earlier occurrences not counted'
+
+        processor.reconfigure(admit=0)
+        processor.feed(btle_record(3, now, -50))
+        assert 3 in processor._tracked() and processor.settings()['admit'] == 0, \
+            'Admission filter not disabled'
+
+    def test_while_processing(self, pipe_path):
+        now = int(time())
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        processor.start()
+        with open(pipe_path, 'wb') as pipe:
+            for i in range(100):
+                pipe.write(b''.join(btle_record(aa, now, -50) for aa in range(100)))
+                if i == 50:
+                    processor.reconfigure(seen_threshold=200, ttl=3600)
+
+        processor._processing_thread.join(timeout=10)
+        processor.stop()
+
+        assert sum(fp.times_seen for fp in processor._tracked().values()) == 10000, \
+            'Records lost while reconfiguring'
+        assert not processor.result, 'Old threshold still applied'
+
+
+class TestCallbacks:
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_btle_threshold_crossing(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+
+        events = []
+        dispatcher = Dispatcher(events.append)
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=3,
+                                          columnar=columnar, callback=dispatcher)
+        now = int(time())
+        processor.feed(btle_record(1, now, -50) * 2 + btle_record(2, now, -50))
+        processor.feed(btle_record(1, now, -50) * 5 + btle_record(2, now, -50))
+        processor.stop()
+
+        # The columnar store notifies with the state at the end of the batch
+        expected = [(1, 7)] if columnar else [(1, 3)]
+        assert [(fp.aa, fp.times_seen) for fp in events] == expected, \
+            'One event when the threshold is crossed'
+
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_btle_adv_new_device(self, pipe_path, columnar):
+        if columnar:
+            pytest.importorskip('numpy')
+
+        events = []
+        processor = sniffer.BtleAdvProcessor(pipe_path=pipe_path, columnar=columnar,
+                                             callback=Dispatcher(events.append))
+        macs = [i * 0x010101010101 for i in range(3)]
+        processor.feed(b''.join(btle_adv_record(mac, 1000, -50) for mac in macs * 2))
+        processor.stop()
+
+        assert sorted(fp.mac for fp in events) == macs, 'One event per new device'
+
+    def test_slow_callback_does_not_stall_ingestion(self, pipe_path):
+        release = threading.Event()
+        processor = sniffer.BtbrProcessor(pipe_path=pipe_path,
+                                          callback=Dispatcher(lambda fp: release.wait(5), maxsize=10))
+
+        start = perf_counter()
+        processor.feed(b''.join(btbr_record(0, 0, lap, 1000) for lap in range(100)))
+        elapsed = perf_counter() - start
+
+        stats = processor.stats()
+        release.set()
+        processor.stop()
+
+        assert elapsed < 1, 'Ingestion waited for the callback'
+        assert stats['callback_queue'] == 10, 'Queue should be full'
+        # The worker may or may not have taken the first event off the queue
+        assert stats['callbacks_dropped'] in (89, 90), 'Dropped callbacks not counted'
+
+
+def writer_cmd(pipe_path: str, data: bytes, *, linger: float=0) -> list:
+    '''Command standing in for ubertooth-btle: writes data to the pipe, then sleeps for linger seconds.'''
+    script = 'import sys, time\n' \
+             'with open(sys.argv[1], "wb") as pipe: pipe.write(bytes.fromhex(sys.argv[2]))\n' \
+             'time.sleep(float(sys.argv[3]))'
+    return [sys.executable, '-c', script, pipe_path, data.hex(), str(linger)]
+
+def wait_for(condition, timeout: float=5) -> bool:
+    end = perf_counter() + timeout
+    while not condition():
+        if perf_counter() > end:
+            return False
+        sleep(0.01)
+
+    return True
+
+
+class TestAsyncRuntime:
+    def test_sniffers_share_one_loop(self, tmp_path):
+        runtime = sniffer.AsyncRuntime()
+        now = int(time())
+        sniffers = []
+        for i in range(3):
+            processor = sniffer.BtleProcessor(pipe_path=str(tmp_path / f'pipe{i}'), seen_threshold=1)
+            processor.cmd = writer_cmd(processor._pipe, btle_record(i, now, -50) * 10, linger=60)
+            sniffers.append(sniffer.Sniffer(processor=processor, runtime=runtime))
+
+        threads = threading.active_count()
+        for s in sniffers:
+            s.start()
+
+        try:
+            assert wait_for(lambda: all(len(s._processor._tracked()) == 1 for s in sniffers)), \
+                'Records not read'
+            assert threading.active_count() - threads <= 1 + len(sniffers), \
+                'Runtime should not start reader threads'
+            assert [fp.times_seen for s in sniffers for fp in s.result] == [10] * 3, \
+                'Wrong results'
+        finally:
+            start = perf_counter()
+            for s in sniffers:
+                s.stop()
+            runtime.close()
+
+        assert perf_counter() - start < 5, 'Children should have been terminated'
+
+    def test_child_exit_restarts_immediately(self, pipe_path):
+        runtime = sniffer.AsyncRuntime()
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        # Exits right away, leaving half a record behind
+        processor.cmd = writer_cmd(pipe_path, btle_record(1, int(time()), -50) + b'\x00' * 6)
+        runner = sniffer.Sniffer(processor=processor, runtime=runtime)
+
+        runner.start()
+        try:
+            assert wait_for(lambda: sum(fp.times_seen for fp in processor._tracked().values()) >= 3,
+                            timeout=2.5), 'Child should have been restarted without delay'
+        finally:
+            runner.stop()
+            runtime.close()
+
+        assert set(processor._tracked()) == {1}, 'Partial records must not be decoded'
+
+    def test_stop_closes_callback_pool(self, pipe_path):
+        runtime = sniffer.AsyncRuntime()
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, callback=lambda fingerprint: None)
+        processor.cmd = writer_cmd(pipe_path, btle_record(1, int(time()), -50), linger=60)
+        runner = sniffer.Sniffer(processor=processor, runtime=runtime)
+        workers = processor._callback._workers
+
+        runner.start()
+        runner.stop()
+        runtime.close()
+
+        assert not any(worker.is_alive() for worker in workers), 'Callback workers leaked'
+
+
+class TestSupervisor:
+    class Source:
+        _last_data = None
+
+    def test_backoff_is_capped_and_reset_by_data(self):
+        clock = Clock(100)
+        source = self.Source()
+        supervisor = sniffer.Supervisor(source, backoff=0.5, max_backoff=2, clock=clock)
+
+        delays = []
+        for _ in range(6):
+            supervisor.started()
+            delays.append(supervisor.restart())
+        assert delays == [0, 0.5, 1, 2, 2, 2], 'Delays should double up to the cap'
+
+        supervisor.started()
+        clock.now += 10
+        source._last_data = clock.now
+        supervisor.check()
+        assert supervisor.restart() == 0, 'Restart after data should be immediate'
+        assert supervisor.downtime.count == 1, 'Outage not measured'
+        assert supervisor.downtime.sum == pytest.approx(10), 'Wrong downtime'
+
+    def test_stall_detection(self):
+        clock = Clock(100)
+        source = self.Source()
+        supervisor = sniffer.Supervisor(source, stall_timeout=5, clock=clock)
+        supervisor.started()
+
+        clock.now += 4
+        source._last_data = clock.now
+        clock.now += 4
+        assert not supervisor.check(), 'Data arrived within the timeout'
+
+        clock.now += 1
+        assert supervisor.check(), 'Stall not detected'
+        assert not sniffer.Supervisor(source, clock=clock).check(), \
+            'Stall detection should be off by default'
+
+    @pytest.mark.parametrize('use_runtime', [False, True])
+    def test_wedged_child_is_restarted(self, pipe_path, use_runtime):
+        runtime = sniffer.AsyncRuntime() if use_runtime else None
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        # Writes once, then hangs without exiting
+        processor.cmd = writer_cmd(pipe_path, btle_record(1, int(time()), -50), linger=60)
+        runner = sniffer.Sniffer(processor=processor, runtime=runtime, stall_timeout=0.5)
+
+        runner.start()
+        try:
+            assert wait_for(lambda: processor.stats()['records'] >= 2, timeout=10), \
+                'Wedged child should have been restarted'
+            assert wait_for(lambda: runner.stats()['downtime_seconds']['count'] >= 1), \
+                'Downtime not recorded'
+        finally:
+            runner.stop()
+            if runtime:
+                runtime.close()
+
+        stats = runner.stats()
+        assert stats['stalls'] >= 1 and stats['restarts'] >= stats['stalls'], 'Restarts not counted'
+        assert stats['downtime_seconds']['sum'] >= 0.5, 'Downtime shorter than the stall timeout'
+
+    def test_child_exit_restarts_immediately(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, seen_threshold=1)
+        # Exits right away, leaving half a record behind
+        processor.cmd = writer_cmd(pipe_path, btle_record(1, int(time()), -50) + b'\x00' * 6)
+        runner = sniffer.Sniffer(processor=processor)
+
+        runner.start()
+        try:
+            assert wait_for(lambda: sum(fp.times_seen for fp in processor._tracked().values()) >= 3,
+                            timeout=5), 'Child should have been restarted without delay'
+        finally:
+            runner.stop()
+
+        assert set(processor._tracked()) == {1}, 'Partial records must not be decoded'
+        assert runner.stats()['stalls'] == 0, 'Exits are not stalls'
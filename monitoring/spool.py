@@ -0,0 +1,189 @@
+#!/usr/bin/env python3.8
+
+import os
+import sqlite3
+import threading
+from collections import deque
+from time import monotonic
+import logging as log
+
+__all__ = ['Spool']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+class Spool:
+    '''Durable first-in first-out queue of requests in an SQLite database in WAL mode, so
+    requests survive outages of the backend and restarts.
+
+    Requests are put into a write buffer and committed together once sync_items are
+    buffered or the oldest was buffered sync_interval seconds ago, so a burst of requests
+    costs one fsync. take() hands out committed requests oldest first. They stay in the
+    database until they are acknowledged with ack(), or are handed out again after
+    release(). Requests neither acknowledged nor released when the process ends are
+    handed out again by the next process opening the spool.
+
+    At most memory_items requests are handed out and not yet acknowledged at a time, which
+    together with the write buffer bounds the memory held however long the backlog grows.
+
+    Acknowledged requests are deleted along with the next commit. Once the spool is empty,
+    or compact_items requests were deleted, the free pages are returned to the file system
+    and the write-ahead log is truncated.
+
+    Positional arguments:\n
+    path -- of the database, created if missing\n
+
+    Keyword arguments:\n
+    memory_items -- most requests handed out and not acknowledged\n
+    sync_items -- buffered requests and acknowledgements that trigger a commit\n
+    sync_interval -- seconds after which buffered requests are committed\n
+    compact_items -- deleted requests after which the file is compacted'''
+
+    def __init__(self, path: str, *, memory_items: int=10000, sync_items: int=1000,
+                 sync_interval: float=1.0, compact_items: int=100000):
+        self.path = path
+        self.memory_items = memory_items
+        self.sync_items = sync_items
+        self.sync_interval = sync_interval
+        self.compact_items = compact_items
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Only takes effect on a new database, before the table is created
+        self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS requests '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, endpoint TEXT, data TEXT)')
+
+        # Requests and acknowledgements not committed yet, and when the oldest was buffered
+        self._buffer = []
+        self._acked = []
+        self._buffered = None
+        # Highest id handed out, requests released to be handed out again
+        self._cursor = 0
+        self._released = deque()
+        self.in_flight = 0
+        self._deleted = 0
+
+        self.items, self.bytes = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM requests').fetchone()
+        if self.items:
+            log.info('Replaying %i requests (%i bytes) from %s.', self.items, self.bytes, path)
+
+    def put(self, endpoint: str, data: str):
+        with self._lock:
+            self._buffer.append((endpoint, data))
+            self.items += 1
+            self.bytes += len(data)
+
+            if self._buffered is None:
+                self._buffered = monotonic()
+
+            if len(self._buffer) >= self.sync_items:
+                self._commit()
+
+    def take(self) -> list:
+        '''Returns (id, endpoint, data) of the requests to send next, oldest first and as many
+        as memory_items allows.'''
+
+        with self._lock:
+            room = self.memory_items - self.in_flight
+            taken = [self._released.popleft() for _ in range(min(room, len(self._released)))]
+            room -= len(taken)
+
+            if room > 0:
+                rows = self._select(room)
+                # Only commit buffered requests early when nothing else is left to send
+                if len(rows) < room and self._buffer:
+                    self._commit()
+                    rows += self._select(room - len(rows))
+                taken += rows
+
+            self.in_flight += len(taken)
+
+        return taken
+
+    def _select(self, count: int) -> list:
+        rows = self._db.execute('SELECT id, endpoint, data FROM requests WHERE id > ? '
+                                'ORDER BY id LIMIT ?', (self._cursor, count)).fetchall()
+        if rows:
+            self._cursor = rows[-1][0]
+
+        return rows
+
+    def ack(self, items: list):
+        '''Deletes the requests taken as (id, endpoint, data) with the next commit.'''
+
+        with self._lock:
+            self._acked.extend(id for id, _, _ in items)
+            self.in_flight -= len(items)
+            self.items -= len(items)
+            self.bytes -= sum(len(data) for _, _, data in items)
+
+            if len(self._acked) >= self.sync_items:
+                self._commit()
+
+    def release(self, items: list):
+        '''Hands the requests taken as (id, endpoint, data) out again, before any others.'''
+
+        with self._lock:
+            self._released.extend(items)
+            self.in_flight -= len(items)
+
+    def sync(self, *, force: bool=False):
+        '''Commits the buffer if sync_interval passed since the oldest request was buffered,
+        or if forced. Commits pending acknowledgements along with it.'''
+
+        with self._lock:
+            due = self._buffered is not None and \
+                monotonic() - self._buffered >= self.sync_interval
+            # Acknowledgements are committed early once everything taken was sent
+            if force or due or (self._acked and not self.in_flight):
+                self._commit()
+
+    def _commit(self):
+        '''Writes the buffer and deletes the acknowledged requests in one transaction. Called
+        with the lock held.'''
+
+        if not self._buffer and not self._acked:
+            return
+
+        with self._db:
+            self._db.executemany('INSERT INTO requests (endpoint, data) VALUES (?, ?)',
+                                 self._buffer)
+            self._db.executemany('DELETE FROM requests WHERE id = ?',
+                                 [(id,) for id in self._acked])
+
+        self._deleted += len(self._acked)
+        self._buffer, self._acked, self._buffered = [], [], None
+
+        if self._deleted and (not self.items or self._deleted >= self.compact_items):
+            self._compact()
+
+    def _compact(self):
+        '''Frees the pages of deleted requests and truncates the log. Called with the lock held.'''
+
+        # execute() would only free the first page
+        self._db.executescript('PRAGMA incremental_vacuum;')
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        log.debug('Compacted %s after deleting %i requests.', self.path, self._deleted)
+        self._deleted = 0
+
+    @property
+    def file_bytes(self) -> int:
+        '''Size of the database and its write-ahead log.'''
+        return sum(os.path.getsize(path) for path in [self.path, self.path + '-wal']
+                   if os.path.exists(path))
+
+    def stats(self) -> dict:
+        return {'backlog_items': self.items, 'backlog_bytes': self.bytes,
+                'in_flight': self.in_flight, 'spool_bytes': self.file_bytes}
+
+    def close(self):
+        '''Commits the buffer. Requests taken and not acknowledged are handed out again when
+        the spool is opened next time.'''
+
+        with self._lock:
+            self._commit()
+            self._db.close()
@@ -0,0 +1,77 @@
+import sqlite3
+from time import sleep
+from spool import Spool
+
+def committed(path) -> int:
+    with sqlite3.connect(str(path)) as db:
+        return db.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+
+class TestSpool:
+    def test_fifo_with_release(self, tmp_path):
+        spool = Spool(str(tmp_path / 'spool.db'))
+        for i in range(5):
+            spool.put('Btle', f'{{"id": {i}}}')
+
+        first = spool.take()
+        assert [data for _, _, data in first] == [f'{{"id": {i}}}' for i in range(5)], \
+            'Requests not handed out in order'
+        assert not spool.take(), 'Requests handed out twice'
+
+        spool.ack(first[:2])
+        spool.release(first[2:])
+        assert spool.take() == first[2:], 'Released requests not handed out again'
+        assert (spool.items, spool.bytes) == (3, 27), 'Backlog depth wrong'
+
+    def test_commits_in_batches(self, tmp_path):
+        path = tmp_path / 'spool.db'
+        spool = Spool(str(path), sync_items=10, sync_interval=0.05)
+        for i in range(15):
+            spool.put('Btle', '{}')
+        assert committed(path) == 10, 'Expected one commit of sync_items requests'
+
+        spool.sync()
+        assert committed(path) == 10, 'Committed before sync_interval passed'
+        sleep(0.06)
+        spool.sync()
+        assert committed(path) == 15, 'Not committed after sync_interval'
+
+    def test_replay_after_restart(self, tmp_path):
+        path = str(tmp_path / 'spool.db')
+        spool = Spool(path)
+        for i in range(10):
+            spool.put('MacAddr', str(i))
+        taken = spool.take()
+        spool.ack(taken[:4])
+        spool.put('MacAddr', '10')
+        spool.close()
+
+        spool = Spool(path)
+        assert spool.items == 7, 'Backlog not restored'
+        assert [data for _, _, data in spool.take()] == [str(i) for i in range(4, 11)], \
+            'Unacknowledged requests not replayed in order'
+
+    def test_memory_bound(self, tmp_path):
+        spool = Spool(str(tmp_path / 'spool.db'), memory_items=100, sync_items=1000)
+        for i in range(1000):
+            spool.put('Btle', '{}')
+
+        taken = spool.take()
+        assert len(taken) == 100 and spool.in_flight == 100, 'More requests held than allowed'
+        spool.ack(taken[:30])
+        assert len(spool.take()) == 30, 'Room of acknowledged requests not refilled'
+
+    def test_compaction(self, tmp_path):
+        path = str(tmp_path / 'spool.db')
+        spool = Spool(path, sync_items=5000)
+        for i in range(20000):
+            spool.put('Btle', 'x' * 200)
+        spool.sync(force=True)
+        full = spool.file_bytes
+
+        while taken := spool.take():
+            spool.ack(taken)
+        spool.sync()
+
+        assert spool.items == 0 and committed(path) == 0, 'Acknowledged requests not deleted'
+        assert spool.file_bytes < full / 10, 'Spool not compacted once empty'
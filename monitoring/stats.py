@@ -0,0 +1,200 @@
+#!/usr/bin/env python3.8
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging as log
+
+__all__ = ['Histogram', 'ProcessorStats', 'format_prometheus', 'serve_prometheus']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+# Upper bounds in seconds of the timing histograms, from 10us to 1s
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+                5e-2, 0.1, 0.25, 0.5, 1.0)
+# Upper bounds in seconds of the sniffer downtime histogram, from 100ms to 10min
+DOWNTIME_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+class Histogram:
+    '''Counts observations in buckets with fixed upper bounds, like a Prometheus histogram.
+
+    Positional arguments:\n
+    bounds -- ascending upper bounds of the buckets, an implicit +Inf bucket is added'''
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple=TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative(self) -> list:
+        '''Returns (upper bound, observations at or below it) pairs, ending with +Inf.'''
+
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+
+        return buckets
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'buckets': self.cumulative()}
+
+class ProcessorStats:
+    '''Counters of a processor's hot path.
+
+    Counters are updated once per chunk of records, not per record. Decode time and lock
+    wait are only timed for one in sample_every chunks, so the histograms hold a sample
+    of the chunks and the clock is read a handful of times per second at most.
+
+    Only the processing thread writes the counters, except for expirations and evictions,
+    which are written by whichever thread holds the processing lock. Readers may see them a
+    chunk behind.
+
+    Keyword arguments:\n
+    sample_every -- time every n-th chunk'''
+
+    def __init__(self, *, sample_every: int=16):
+        self.sample_every = sample_every
+        self.records = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.decode = Histogram()
+        self.lock_wait = Histogram()
+
+    def count(self, records: int, length: int) -> bool:
+        '''Adds a chunk of records. Returns whether the chunk should be timed.'''
+
+        self.records += records
+        self.bytes += length
+        self.chunks += 1
+
+        return not self.chunks % self.sample_every
+
+    def to_dict(self) -> dict:
+        return {
+            'records': self.records,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+            'decode_seconds': self.decode.to_dict(),
+            'lock_wait_seconds': self.lock_wait.to_dict(),
+        }
+
+# Name, type and help of every exported metric, keyed by its field in Sniffer.stats()
+_METRICS = {
+    'records': ('sniffer_records_total', 'counter', 'Records read from the pipe.'),
+    'bytes': ('sniffer_bytes_total', 'counter', 'Bytes of complete records read from the pipe.'),
+    'chunks': ('sniffer_chunks_total', 'counter', 'Reads from the pipe.'),
+    'expirations': ('sniffer_expirations_total', 'counter', 'Fingerprints dropped after not being seen.'),
+    'evictions': ('sniffer_evictions_total', 'counter', 'Fingerprints dropped to stay within the table bounds.'),
+    'decode_seconds': ('sniffer_decode_seconds', 'histogram', 'Time to decode and ingest a chunk, sampled.'),
+    'lock_wait_seconds': ('sniffer_lock_wait_seconds', 'histogram', 'Time waiting for the table lock, sampled.'),
+    'table_size': ('sniffer_table_entries', 'gauge', 'Entries in the fingerprint table.'),
+    'pending_bytes': ('sniffer_pending_bytes', 'gauge', 'Bytes waiting in the FIFO or ring buffer.'),
+    'callback_queue': ('sniffer_callback_queue', 'gauge', 'Callbacks waiting to run.'),
+    'callbacks_dropped': ('sniffer_callbacks_dropped_total', 'counter',
+                          'Callbacks dropped because the queue was full.'),
+    'filtered': ('sniffer_filtered_records_total', 'counter',
+                 'Records of addresses not yet admitted into the fingerprint table.'),
+    'history_bytes': ('sniffer_history_bytes', 'gauge', 'Memory held by RSSI history rings.'),
+    'restarts': ('sniffer_restarts_total', 'counter', 'Restarts of the sniffer subprocess.'),
+    'stalls': ('sniffer_stalls_total', 'counter',
+               'Restarts because the subprocess produced no data for too long.'),
+    'downtime_seconds': ('sniffer_downtime_seconds', 'histogram',
+                         'Time without data around each restart, from the last data before it '
+                         'to the first after it.'),
+    'outage_seconds': ('sniffer_outage_seconds', 'gauge',
+                       'Time since the last data of an ongoing outage, 0 if there is none.'),
+    'active_seconds': ('sniffer_active_seconds_total', 'counter',
+                       'Time the sniffer had a dongle assigned.'),
+    'duty_cycle': ('sniffer_duty_cycle', 'gauge',
+                   'Share of the time since start the sniffer had a dongle assigned.'),
+}
+
+# Metrics of the uplink, keyed by their field in networking.RequestHandler.stats()
+_UPLINK_METRICS = {
+    'queued': ('uplink_queued_requests', 'Requests with callbacks queued in memory.'),
+    'backlog_items': ('uplink_backlog_requests', 'Requests in the spool not sent yet.'),
+    'backlog_bytes': ('uplink_backlog_bytes', 'Payload bytes of the requests in the spool.'),
+    'in_flight': ('uplink_in_flight_requests', 'Requests taken from the spool being sent.'),
+    'spool_bytes': ('uplink_spool_file_bytes', 'Size of the spool database and its log.'),
+}
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+def format_prometheus(sniffers: list, uplink: dict=None) -> str:
+    '''Renders the stats of all sniffers, and those of the uplink if given, in the Prometheus
+    text exposition format.'''
+
+    stats = [sniffer.stats() for sniffer in sniffers]
+    lines = []
+
+    for field, (name, kind, description) in _METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+
+        for values in stats:
+            labels = f'processor="{values["processor"]}",ut_id="{values["ut_id"]}"'
+            value = values[field]
+
+            if kind != 'histogram':
+                lines.append(f'{name}{{{labels}}} {value}')
+                continue
+
+            for bound, count in value['buckets']:
+                lines.append(f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {value["sum"]}')
+            lines.append(f'{name}_count{{{labels}}} {value["count"]}')
+
+    for field, (name, description) in _UPLINK_METRICS.items() if uplink is not None else ():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {uplink[field]}')
+
+    return '\n'.join(lines) + '\n'
+
+def serve_prometheus(sniffers: list, port: int, *, host: str='127.0.0.1',
+                     uplink=None) -> ThreadingHTTPServer:
+    '''Serves the stats of sniffers, and those returned by uplink if given, on
+    http://host:port/metrics from a daemon thread. Call shutdown() on the returned server
+    to stop it.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = format_prometheus(sniffers, uplink() if uplink else None).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug('Metrics request: ' + format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    log.debug('Serving metrics on %s:%i.', host, server.server_address[1])
+
+    return server
@@ -0,0 +1,108 @@
+import os
+import struct
+import urllib.request
+from time import time
+import pytest
+import sniffer
+from stats import Histogram, format_prometheus, serve_prometheus
+
+def btle_record(aa: int, timestamp: int, rssi: int) -> bytes:
+    return struct.pack(sniffer.BtleProcessor._fmt, aa, timestamp, rssi)
+
+@pytest.fixture
+def pipe_path(tmp_path):
+    return str(tmp_path / 'pipes' / 'pipe')
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram((1, 2, 3))
+        for value in (0.5, 1, 1.5, 2.5, 10):
+            histogram.observe(value)
+
+        assert histogram.cumulative() == [(1, 2), (2, 3), (3, 4), (float('inf'), 5)], \
+            'Wrong bucket counts'
+        assert histogram.count == 5 and histogram.sum == 15.5, 'Wrong count or sum'
+
+
+class TestProcessorStats:
+    def test_counts_records_and_samples_timing(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+        now = int(time())
+
+        for i in range(64):
+            processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(10)))
+
+        stats = sniffer.Sniffer(processor=processor).stats()
+        assert stats['records'] == 640 and stats['bytes'] == 640 * 12, 'Records not counted'
+        assert stats['chunks'] == 64, 'Chunks not counted'
+        assert stats['decode_seconds']['count'] == 64 // processor._stats.sample_every, \
+            'Only every n-th chunk should be timed'
+        assert stats['lock_wait_seconds']['count'] == stats['decode_seconds']['count'], \
+            'Lock wait and decode are sampled together'
+        assert stats['table_size'] == 10, 'Wrong table size'
+
+    def test_counts_expirations(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+        now = int(time())
+        processor.feed(b''.join(btle_record(aa, now, -50) for aa in range(10)))
+        processor.result
+
+        # Only half of the fingerprints are seen again, the others expire on the next report
+        processor.feed(b''.join(btle_record(aa, now + 10, -50) for aa in range(5)))
+        processor.result
+
+        assert processor.stats()['expirations'] == 5, 'Expired fingerprints not counted'
+
+    def test_counts_columnar_expirations(self, pipe_path):
+        pytest.importorskip('numpy')
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path, columnar=True)
+        processor.feed(b''.join(btle_record(aa, 1000, -50) for aa in range(10)))
+        processor.result
+
+        assert processor.stats()['expirations'] == 10, 'Expired rows not counted'
+
+    def test_pending_bytes_of_fifo(self, pipe_path):
+        processor = sniffer.BtleProcessor(pipe_path=pipe_path)
+
+        fd = processor._pipe_fd = os.open(pipe_path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(fd, btle_record(1, 1000, -50) * 3)
+            assert processor.stats()['pending_bytes'] == 36, 'Bytes waiting in FIFO not reported'
+        finally:
+            processor._pipe_fd = None
+            os.close(fd)
+
+        assert processor.stats()['pending_bytes'] == 0, 'Closed pipe should report nothing'
+
+
+class TestPrometheus:
+    def test_endpoint_serves_all_sniffers(self, tmp_path):
+        sniffers = [sniffer.Sniffer(processor=sniffer.BtleProcessor(pipe_path=str(tmp_path / 'btle'))),
+                    sniffer.Sniffer(processor=sniffer.BtbrProcessor(pipe_path=str(tmp_path / 'btbr'),
+                                                                    ut_id=1))]
+        sniffers[0]._processor.feed(btle_record(1, 1000, -50) * 7)
+
+        server = serve_prometheus(sniffers, 0)
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+            with urllib.request.urlopen(url, timeout=5) as response:
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert body == format_prometheus(sniffers), 'Endpoint should serve the formatted stats'
+        assert 'sniffer_records_total{processor="btle",ut_id="0"} 7' in body, 'Counter missing'
+        assert 'sniffer_records_total{processor="btbr",ut_id="1"} 0' in body, 'Sniffer missing'
+        assert 'sniffer_decode_seconds_bucket{processor="btle",ut_id="0",le="+Inf"} 0' in body, \
+            'Histogram missing'
+        assert '# TYPE sniffer_table_entries gauge' in body, 'Metric type missing'
+
+    def test_uplink_metrics(self):
+        body = format_prometheus([], {'queued': 1, 'backlog_items': 20, 'backlog_bytes': 4096,
+                                      'in_flight': 5, 'spool_bytes': 16384})
+
+        assert 'uplink_backlog_requests 20' in body, 'Backlog depth in items missing'
+        assert 'uplink_backlog_bytes 4096' in body, 'Backlog depth in bytes missing'
+        assert 'uplink_' not in format_prometheus([]), 'Uplink metrics without uplink'
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3.8
+
+import math
+import struct
+from array import array
+from collections import Counter
+
+__all__ = ['TDigest']
+
+__author__ = "Severin Marti <severin.marti@ost.ch"
+__status__  = "development"
+
+class TDigest:
+    '''Streaming quantile estimator of bounded size, a merging t-digest.
+
+    Values are buffered and merged into centroids once the buffer is full. Centroids near
+    the tails hold few values and those around the median many, so the extreme quantiles
+    stay accurate. The number of centroids stays around compression, regardless of how
+    many values were added. Digests can be merged, e.g. the RSSI of a device seen by
+    several processes or antennas, with the same error as a digest of all values.
+
+    Reading quantiles does not change the digest, so they can be read on another thread
+    than the one adding values. A read racing a merge may miss the values being merged.
+
+    Keyword arguments:\n
+    compression -- approximate maximum number of centroids\n
+    buffer -- number of values buffered before they are merged'''
+
+    __slots__ = ('compression', '_limit', '_centroids', '_buffer', 'min', 'max')
+
+    def __init__(self, *, compression: int=20, buffer: int=32):
+        self.compression = compression
+        self._limit = buffer
+        # Mean and weight of each centroid in turn, ordered by mean
+        self._centroids = array('d')
+        self._buffer = array('d')
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, value: float):
+        self._buffer.append(value)
+        if len(self._buffer) >= self._limit:
+            self._merge()
+
+    def merge(self, other: 'TDigest'):
+        '''Adds the values of another digest to this one.'''
+
+        other._merge()
+        self._merge(other._centroids)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _merge(self, centroids: array=None):
+        '''Merges the buffered values and further centroids into the centroids.'''
+
+        if self._buffer or centroids:
+            self._centroids, self.min, self.max = self._merged(centroids)
+            del self._buffer[:]
+
+    def _merged(self, centroids: array=None) -> tuple:
+        '''Returns the centroids, min and max with the buffered values and further centroids
+        merged in, without changing the digest.'''
+
+        # Copied in one step, values may be added on another thread
+        buffer = array('d', self._buffer)
+        current = self._centroids
+        if not buffer and not centroids:
+            return current, self.min, self.max
+
+        low, high = self.min, self.max
+        if buffer:
+            low = min(low, min(buffer))
+            high = max(high, max(buffer))
+
+        # Values like RSSI repeat a lot, equal values are merged before sorting
+        items = list(Counter(buffer).items())
+        items.extend(zip(current[::2], current[1::2]))
+        if centroids:
+            items.extend(zip(centroids[::2], centroids[1::2]))
+        items.sort()
+
+        return self._compress(items, self.compression), low, high
+
+    @staticmethod
+    def _compress(items: list, compression: float) -> array:
+        '''Merges sorted (mean, weight) pairs into as few centroids as the k1 scale function
+        allows, each spanning at most one unit of k.'''
+
+        total = sum(weight for _, weight in items)
+        scale = compression / (2 * math.pi)
+        merged = array('d')
+
+        mean, weight = items[0]
+        before = 0.0
+        limit = total * TDigest._q_limit(0.0, scale)
+        for value, count in items[1:]:
+            if before + weight + count <= limit:
+                weight += count
+                mean += (value - mean) * count / weight
+                continue
+
+            merged.extend((mean, weight))
+            before += weight
+            limit = total * TDigest._q_limit(before / total, scale)
+            mean, weight = value, count
+
+        merged.extend((mean, weight))
+        return merged
+
+    @staticmethod
+    def _q_limit(q: float, scale: float) -> float:
+        '''Largest quantile a centroid starting at q may extend to, one unit of k further.'''
+
+        k = scale * math.asin(2 * q - 1) + 1
+        if k >= scale * math.pi / 2:
+            return 1.0
+
+        return (math.sin(k / scale) + 1) / 2
+
+    @property
+    def count(self) -> float:
+        return sum(self._centroids[1::2]) + len(self._buffer)
+
+    def quantile(self, q: float) -> float:
+        '''Estimates the value below which a fraction q of the values lie, None if empty.'''
+
+        centroids, low, high = self._merged()
+        if not centroids:
+            return None
+
+        means, weights = centroids[::2], centroids[1::2]
+        if len(means) == 1:
+            return means[0]
+
+        target = q * sum(weights)
+        # Each centroid's mean sits at the middle of its weight, the extremes at the ends
+        position = weights[0] / 2
+        if target <= position:
+            return self._interpolate(low, means[0], target / position if position else 1)
+
+        for i in range(1, len(means)):
+            step = (weights[i-1] + weights[i]) / 2
+            if target <= position + step:
+                return self._interpolate(means[i-1], means[i], (target - position) / step)
+            position += step
+
+        rest = weights[-1] / 2
+        return self._interpolate(means[-1], high, (target - position) / rest if rest else 0)
+
+    @staticmethod
+    def _interpolate(low: float, high: float, fraction: float) -> float:
+        return low + (high - low) * min(max(fraction, 0.0), 1.0)
+
+    # Fixed size encoding used in fingerprint records
+    _header = struct.Struct('=Bdd')
+    _centroid = struct.Struct('=fd')
+
+    @classmethod
+    def packed_size(cls, centroids: int) -> int:
+        return cls._header.size + centroids * cls._centroid.size
+
+    def pack(self, centroids: int) -> bytes:
+        '''Encodes the digest in packed_size(centroids) bytes, merging centroids if needed.'''
+
+        self._merge()
+        packed = self._centroids
+        compression = min(self.compression, centroids)
+        while len(packed) // 2 > centroids:
+            compression -= 1
+            packed = self._compress(list(zip(packed[::2], packed[1::2])), compression)
+
+        count = len(packed) // 2
+        data = self._header.pack(count, self.min, self.max) + \
+            b''.join(self._centroid.pack(packed[i], packed[i+1]) for i in range(0, len(packed), 2))
+
+        return data.ljust(self.packed_size(centroids), b'\0')
+
+    @classmethod
+    def unpack(cls, data: bytes, **options) -> 'TDigest':
+        digest = cls(**options)
+        count, digest.min, digest.max = cls._header.unpack_from(data)
+        for mean, weight in cls._centroid.iter_unpack(
+                data[cls._header.size:cls._header.size + count * cls._centroid.size]):
+            digest._centroids.extend((mean, weight))
+
+        return digest
@@ -0,0 +1,77 @@
+import random
+import pytest
+from tdigest import TDigest
+
+def exact_quantile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def rssi_values(count: int, seed: int=1) -> list:
+    rng = random.Random(seed)
+    # Multipath outliers far below a device at a typical distance
+    return [int(rng.gauss(-70, 4)) if rng.random() < 0.9 else int(rng.gauss(-95, 3))
+            for _ in range(count)]
+
+
+class TestTDigest:
+    def test_quantiles_of_rssi(self):
+        values = rssi_values(50000)
+        digest = TDigest()
+        for value in values:
+            digest.update(value)
+
+        for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+            assert digest.quantile(q) == pytest.approx(exact_quantile(values, q), abs=1), \
+                f'Quantile {q} off'
+        assert len(digest._centroids) // 2 <= 2 * digest.compression, 'Digest not bounded'
+
+    def test_few_values(self):
+        digest = TDigest()
+        assert digest.quantile(0.5) is None, 'Empty digest has no quantiles'
+
+        for value in [-60, -62, -64]:
+            digest.update(value)
+        assert digest.quantile(0.5) == -62, 'Median of three values should be exact'
+        assert (digest.quantile(0), digest.quantile(1)) == (-64, -60), 'Extremes not kept'
+
+    def test_quantile_does_not_change_digest(self):
+        digest = TDigest()
+        for value in rssi_values(100):
+            digest.update(value)
+        state = list(digest._centroids), list(digest._buffer), digest.min, digest.max
+
+        median = digest.quantile(0.5)
+        assert (list(digest._centroids), list(digest._buffer), digest.min, digest.max) == state, \
+            'Reading a quantile changed the digest'
+
+        digest._merge()
+        assert digest.quantile(0.5) == median, 'Buffered values not included in the quantile'
+
+    def test_merged_digests_match_one_digest(self):
+        values = rssi_values(20000)
+        merged, whole = TDigest(), TDigest()
+        parts = [TDigest() for _ in range(4)]
+        for i, value in enumerate(values):
+            parts[i % 4].update(value)
+            whole.update(value)
+
+        for part in parts:
+            merged.merge(part)
+
+        assert merged.count == len(values), 'Values lost while merging'
+        for q in [0.25, 0.5, 0.75]:
+            assert merged.quantile(q) == pytest.approx(whole.quantile(q), abs=1), \
+                f'Quantile {q} of merged digests differs'
+
+    def test_pack_roundtrip(self):
+        digest = TDigest(compression=50)
+        for value in rssi_values(5000):
+            digest.update(value)
+
+        data = digest.pack(10)
+        assert len(data) == TDigest.packed_size(10), 'Packed size not fixed'
+
+        unpacked = TDigest.unpack(data)
+        assert len(unpacked._centroids) // 2 <= 10, 'Centroids not reduced to fit'
+        assert unpacked.quantile(0.5) == pytest.approx(digest.quantile(0.5), abs=1), \
+            'Median not preserved'